@@ -0,0 +1,169 @@
+# Circuit breakers for remote endpoints.
+#
+# Each remote endpoint (device, cloud API, MQTT broker or database) gets its own breaker.
+# After repeated failures the breaker opens and calls fail fast without touching the network.
+# When the reset timeout has passed, a single probe call is let through (half-open state).
+# If the probe succeeds, the breaker closes immediately. If it fails, the breaker opens again
+# with a doubled reset timeout, up to a maximum.
+
+import asyncio
+import logging
+import time
+import urllib.parse
+
+import prometheus
+import task
+
+logger = logging.getLogger("app.circuitbreaker")
+
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+
+
+class EndpointException(task.TaskException):
+    """Call to a remote endpoint failed."""
+
+    def __init__(self, endpoint: str, retry_in: float, message: str = ""):
+        super().__init__(message or f"call to {endpoint} failed")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class CircuitOpenException(EndpointException):
+    """Call was rejected because the circuit breaker of the endpoint is open."""
+
+    def __init__(self, endpoint: str, retry_in: float):
+        super().__init__(endpoint, retry_in, f"circuit open for {endpoint}, retry in {retry_in:.1f} seconds")
+
+
+class CircuitBreaker(object):
+    def __init__(
+        self, endpoint: str, failure_threshold: int = 3, reset_timeout: float = 10, max_reset_timeout: float = 5 * 60
+    ):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.initial_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+        # Statistics exported as metrics.
+        self.failures_total = 0
+        self.opened_total = 0
+
+    def retry_in(self) -> float:
+        """Seconds until the next call is allowed through."""
+        if self.state == OPEN:
+            return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+        if self.state == HALF_OPEN and self.probe_in_flight:
+            return self.reset_timeout
+        return 0.0
+
+    def check(self) -> None:
+        """Check if a call is allowed.
+
+        Must be followed by a call to record_success() or record_failure().
+
+        :raises CircuitOpenException: If the call is not allowed.
+        """
+        if self.state == OPEN:
+            if self.retry_in() > 0:
+                raise CircuitOpenException(self.endpoint, self.retry_in())
+            logger.info(f"Probing endpoint={self.endpoint}")
+            self.state = HALF_OPEN
+
+        if self.state == HALF_OPEN:
+            # Only one probe at a time.
+            if self.probe_in_flight:
+                raise CircuitOpenException(self.endpoint, self.retry_in())
+            self.probe_in_flight = True
+
+    def record_success(self) -> None:
+        if self.state != CLOSED:
+            logger.info(f"Circuit closed endpoint={self.endpoint}")
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.reset_timeout = self.initial_reset_timeout
+        self.probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures_total += 1
+        self.consecutive_failures += 1
+        self.probe_in_flight = False
+
+        if self.state == HALF_OPEN:
+            # Probe failed, wait longer before the next one.
+            self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+            self.open()
+        elif self.state == CLOSED and self.consecutive_failures >= self.failure_threshold:
+            self.open()
+
+    def open(self) -> None:
+        logger.warning(f"Circuit opened endpoint={self.endpoint} reset_timeout_sec={self.reset_timeout}")
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.opened_total += 1
+
+    def failure(self, e: BaseException) -> EndpointException:
+        """Record a failure and return an exception describing it.
+
+        :param e: The exception that caused the failure.
+        :return: Exception to raise to the caller.
+        """
+        self.record_failure()
+        return EndpointException(self.endpoint, self.retry_in(), f"call to {self.endpoint} failed: {e!r}")
+
+    async def call(self, func):
+        """Call an async function through the circuit breaker.
+
+        :param func: The function to call.
+        :return: The return value of the function.
+        :raises EndpointException: If the call failed or was not allowed.
+        :raises task.AuthenticationException: If the endpoint rejected the credentials.
+        """
+        self.check()
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            self.probe_in_flight = False
+            raise
+        except task.AuthenticationException:
+            # The endpoint answered, the supervisor retries with a long delay.
+            self.record_success()
+            raise
+        except Exception as e:
+            raise self.failure(e) from e
+        self.record_success()
+        return result
+
+
+# Global registry of circuit breakers, one per remote endpoint.
+breakers: dict[str, CircuitBreaker] = {}
+
+
+def get(endpoint: str) -> CircuitBreaker:
+    if endpoint not in breakers:
+        breakers[endpoint] = CircuitBreaker(endpoint)
+    return breakers[endpoint]
+
+
+def for_url(url: str) -> CircuitBreaker:
+    """Get the circuit breaker for the endpoint that serves the given URL."""
+    # Leave out possible credentials from the endpoint name since it is used in logs and metrics.
+    u = urllib.parse.urlsplit(url)
+    return get(f"{u.scheme}://{u.hostname}" + (f":{u.port}" if u.port else ""))
+
+
+def collect(metrics: prometheus.Metrics) -> None:
+    state = metrics.gauge("circuit_breaker_state", "Circuit breaker state (0=closed, 1=half-open, 2=open)")
+    failures = metrics.counter("circuit_breaker_failures_total", "Failed calls to the endpoint")
+    opened = metrics.counter("circuit_breaker_opened_total", "Number of times the circuit breaker opened")
+    for b in breakers.values():
+        labels = {"endpoint": b.endpoint}
+        state.add(b.state, labels=labels)
+        failures.add(b.failures_total, labels=labels)
+        opened.add(b.opened_total, labels=labels)
@@ -0,0 +1,219 @@
+# Validation of the configuration file.
+#
+# The configuration is checked and converted to typed settings at startup, before any task is started.
+# Settings are frozen dataclasses: each task class declares its settings as nested class Settings,
+# and the runtime section is described by Runtime below. The fields are filled from the keys of the
+# configuration file, where underscores in the field name are written as hyphens (poll_period is
+# poll-period), unless the field gives the key explicitly.
+#
+# Values are converted according to the field type:
+# - datetime.timedelta is written as interval string, for example "5m", and must be positive.
+# - datetime.time is written as "HH:MM".
+# - Nested dataclasses are written as mappings, and lists and dicts are converted element by element.
+#
+# Numbers can be limited with minimum (inclusive) or greater_than (exclusive) given to setting().
+#
+# Unknown keys, missing required keys and values of wrong type or out of range are reported as ConfigException.
+
+import dataclasses
+import datetime
+import types
+import typing
+from dataclasses import dataclass
+from typing import Any
+
+import utils
+import yaml
+
+
+class ConfigException(Exception):
+    pass
+
+
+def setting(
+    default: Any = dataclasses.MISSING,
+    *,
+    key: str | None = None,
+    choices: tuple | None = None,
+    minimum: float | None = None,
+    greater_than: float | None = None,
+) -> Any:
+    """Declare a settings field that needs more than a default value.
+
+    :param default: Default value, copied for each instance if it is a list or dict.
+    :param key: Key in the configuration file, when it is not the field name with hyphens.
+    :param choices: Allowed values.
+    :param minimum: Smallest allowed value.
+    :param greater_than: Value must be greater than this.
+    """
+    metadata = {"key": key, "choices": choices, "minimum": minimum, "greater_than": greater_than}
+    if isinstance(default, (list, dict)):
+        return dataclasses.field(default_factory=lambda: type(default)(default), metadata=metadata)
+    return dataclasses.field(default=default, metadata=metadata)
+
+
+def keys(cls: type) -> dict[str, dataclasses.Field]:
+    """Return the fields of settings class by their key in the configuration file."""
+    return {f.metadata.get("key") or f.name.replace("_", "-"): f for f in dataclasses.fields(cls)}
+
+
+def parse(cls: type, data: Any, context: str) -> Any:
+    """Convert a section of the configuration file to settings.
+
+    :param cls: Settings dataclass.
+    :param data: The section of the configuration file.
+    :param context: Location of the section, for error messages.
+    :raises ConfigException: If the section is not valid.
+    """
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        raise ConfigException(f"{context}: expected mapping, got {type(data).__name__}")
+
+    fields = keys(cls)
+    unknown = sorted(set(data) - set(fields))
+    if unknown:
+        raise ConfigException(f"{context}: unknown setting: {', '.join(unknown)}")
+
+    values = {}
+    for key, f in fields.items():
+        if key in data:
+            value = convert(f.type, data[key], f"{context}.{key}")
+            choices = f.metadata.get("choices")
+            if choices and value not in choices:
+                raise ConfigException(f"{context}.{key}: must be one of {', '.join(map(str, choices))}, got {value}")
+            check_range(f, value, f"{context}.{key}")
+            values[f.name] = value
+        elif f.default is dataclasses.MISSING and f.default_factory is dataclasses.MISSING:
+            raise ConfigException(f"{context}: missing required setting: {key}")
+    return cls(**values)
+
+
+def check_range(f: dataclasses.Field, value: Any, context: str) -> None:
+    if value is None:
+        return
+    minimum = f.metadata.get("minimum")
+    if minimum is not None and value < minimum:
+        raise ConfigException(f"{context}: must be at least {minimum}, got {value}")
+    greater_than = f.metadata.get("greater_than")
+    if greater_than is not None and value <= greater_than:
+        raise ConfigException(f"{context}: must be greater than {greater_than}, got {value}")
+
+
+def convert(tp: Any, value: Any, context: str) -> Any:
+    """Convert a value to the given type."""
+    origin = typing.get_origin(tp)
+    args = typing.get_args(tp)
+
+    if tp is Any:
+        return value
+    if origin in (typing.Union, types.UnionType):
+        if value is None and type(None) in args:
+            return None
+        return convert(next(a for a in args if a is not type(None)), value, context)
+    if dataclasses.is_dataclass(tp):
+        return parse(tp, value, context)
+    if tp is datetime.timedelta:
+        try:
+            interval = utils.parse_timedelta(str(value))
+        except (ValueError, IndexError):
+            raise ConfigException(f"{context}: invalid interval {value!r}, expected for example 30s, 5m, 1h or 1d")
+        if interval <= datetime.timedelta(0):
+            raise ConfigException(f"{context}: interval must be positive, got {value!r}")
+        return interval
+    if tp is datetime.time:
+        try:
+            return datetime.datetime.strptime(str(value), "%H:%M").time()
+        except ValueError:
+            raise ConfigException(f"{context}: invalid time {value!r}, expected HH:MM")
+    if origin is list or tp is list:
+        if not isinstance(value, list):
+            raise ConfigException(f"{context}: expected list, got {type(value).__name__}")
+        return [convert(args[0], v, f"{context}[{i}]") for i, v in enumerate(value)] if args else value
+    if origin is dict or tp is dict:
+        if not isinstance(value, dict):
+            raise ConfigException(f"{context}: expected mapping, got {type(value).__name__}")
+        if not args:
+            return value
+        return {convert(args[0], k, context): convert(args[1], v, f"{context}.{k}") for k, v in value.items()}
+    if tp is float and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if tp is str and isinstance(value, (int, float)) and not isinstance(value, bool):
+        # YAML reads for example device ids and passwords consisting of digits as numbers.
+        return str(value)
+    if not isinstance(value, tp) or (tp is int and isinstance(value, bool)):
+        raise ConfigException(f"{context}: expected {tp.__name__}, got {type(value).__name__}")
+    return value
+
+
+@dataclass(frozen=True, kw_only=True)
+class Runtime:
+    # Period for pushing metrics about the application itself.
+    self_metrics_period: datetime.timedelta = datetime.timedelta(minutes=1)
+    event_loop: str = setting("asyncio", choices=("asyncio", "uvloop"))
+
+    # Event loop monitoring (seconds).
+    loop_lag_interval: float = setting(0.5, minimum=0)
+    slow_callback_threshold: float = setting(0.5, greater_than=0)
+
+    # Offloading CPU heavy work from the event loop.
+    offload_pool: str = setting("thread", choices=("thread", "process", "none"))
+    offload_workers: int = setting(2, minimum=1)
+    offload_threshold: int = setting(64 * 1024, minimum=0)
+
+    sink_compression: str = setting("none", choices=("gzip", "none"))
+
+    # In-memory cache of recent metrics, disabled if port is not set.
+    cache_listen_address: str = "127.0.0.1"
+    cache_listen_port: int | None = setting(None, minimum=1)
+    cache_capacity: int = setting(256, minimum=1)
+    cache_window: datetime.timedelta = datetime.timedelta(minutes=15)
+    cache_retention: datetime.timedelta = datetime.timedelta(minutes=15)
+    cache_metrics_endpoint: bool = True
+
+    # Reset handling for counters read from meters.
+    monotonic_counters: list[str] = setting(["electric_consumption_kwh"])
+    counter_state_file: str | None = None
+    counter_monotonic: bool = False
+    counter_rate: bool = False
+
+    # Liveness tracking of sensors.
+    liveness_timeout: datetime.timedelta = datetime.timedelta(minutes=10)
+    liveness_timeouts: dict[str, datetime.timedelta] = setting({})
+    liveness_tick: float = setting(1.0, greater_than=0)
+
+    # Number of worker processes, 0 to run everything in one process.
+    workers: int = setting(0, minimum=0)
+
+    # Time for writing the queued metrics at shutdown, and file for the metrics that could not be written.
+    shutdown_timeout: datetime.timedelta = datetime.timedelta(seconds=8)
+    spool_file: str | None = None
+
+
+@dataclass(frozen=True, kw_only=True)
+class Sensor:
+    type: str
+    name: str = ""
+    # Settings of the task, converted when the task is created.
+    config: dict = setting({})
+
+
+@dataclass(frozen=True, kw_only=True)
+class Config:
+    # Settings that apply to all sensors that have them, such as database_url.
+    global_config: dict = setting({}, key="global")
+    runtime: Runtime = dataclasses.field(default_factory=Runtime)
+    sensors: list[Sensor]
+
+
+def load(path: str) -> Config:
+    """Load and check the configuration file.
+
+    :raises ConfigException: If the file is not valid.
+    """
+    try:
+        with open(path) as f:
+            data = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError) as e:
+        raise ConfigException(f"cannot read {path}: {e}")
+    return parse(Config, data, path)
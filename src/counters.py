@@ -0,0 +1,181 @@
+# Reset handling for counters that are read directly from meters.
+#
+# Energy meters report their total consumption, which is written as counter with the value read
+# from the device. When the device reboots or the counter rolls over, the value drops back to zero.
+# The resets are detected at ingest by comparing each value to the previous value of the series,
+# and optionally following metrics are derived from the counter:
+#
+# - <name>_monotonic: Counter that continues from the previous value over resets.
+# - <name>_rate_per_hour: Increase of the counter per hour since the previous sample, for example
+#   average power in kW for a counter in kWh.
+#
+# The previous values are persisted to a file, so that resets while the application is not running
+# are also detected.
+
+import atexit
+import json
+import logging
+import os
+import time
+
+import config
+import prometheus
+import sink
+
+logger = logging.getLogger("app.counters")
+
+# Decrease smaller than this fraction of the previous value is rounding jitter, not reset.
+JITTER = 0.001
+
+
+class CounterTracker(object):
+    def __init__(
+        self,
+        names: list[str],
+        path: str | None = None,
+        monotonic: bool = False,
+        rate: bool = False,
+        save_interval: float = 60,
+    ):
+        """
+        :param names: Names of the counter metrics to track.
+        :param path: File to persist the state to.
+        :param monotonic: Emit counter that is adjusted over resets.
+        :param rate: Emit increase per hour.
+        :param save_interval: Minimum seconds between writing the state file.
+        """
+        self.names = set(names)
+        self.path = path
+        self.monotonic = monotonic
+        self.rate = rate
+        self.save_interval = save_interval
+        self.last_saved = time.monotonic()
+
+        # Per series: last value read from the device, offset added over resets and time of the sample (msec).
+        self.state: dict[str, dict] = {}
+
+        # Statistics exported as metrics.
+        self.resets: dict[str, int] = {}
+
+        if path:
+            self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as f:
+                self.state = json.load(f)
+            logger.info(f"Loaded counter state: path={self.path} series={len(self.state)}")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load counter state, starting from empty state: path={self.path} error={e}")
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        self.last_saved = time.monotonic()
+        try:
+            # Write to temporary file and rename, to not leave a partial file behind.
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.state, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.error(f"Failed to save counter state: path={self.path} error={e}")
+
+    def process(self, metrics: prometheus.Metrics) -> None:
+        """Detect resets and add the derived metrics, called for all metrics written to the database."""
+        now = int(time.time() * 1000)
+        derived = []
+        for family in list(metrics.families.values()):
+            if family["type"] != "counter" or family["name"] not in self.names:
+                continue
+            for samples in family["samples"]:
+                for sample in samples.samples:
+                    labels = {**samples.common_labels_for_all_samples, **sample["labels"]}
+                    timestamp = sample["timestamp"] or now
+                    adjusted, rate = self.update(family["name"], labels, sample["value"], timestamp)
+                    derived.append((family, labels, timestamp, adjusted, rate))
+
+        for family, labels, timestamp, adjusted, rate in derived:
+            name = family["name"]
+            if self.monotonic:
+                metrics.counter(f"{name}_monotonic", f"{family['description']} Adjusted over counter resets.").add(
+                    adjusted, labels=labels, timestamp_msec=timestamp
+                )
+            if self.rate and rate is not None:
+                metrics.gauge(f"{name}_rate_per_hour", f"Increase of {name} per hour.").add(
+                    rate, labels=labels, timestamp_msec=timestamp
+                )
+
+        if time.monotonic() - self.last_saved > self.save_interval:
+            self.save()
+
+    def update(self, name: str, labels: dict[str, str], value: float, timestamp: int) -> tuple[float, float | None]:
+        """Update the state of the series.
+
+        :return: Value adjusted over resets, and increase per hour since previous sample or None.
+        """
+        key = name + "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+        prev = self.state.get(key)
+        if prev is None:
+            self.state[key] = {"last": value, "offset": 0.0, "time": timestamp}
+            return value, None
+
+        previous_adjusted = prev["last"] + prev["offset"]
+        if value < prev["last"] * (1 - JITTER):
+            # Counter started again from zero, continue from the previous value.
+            prev["offset"] += prev["last"]
+            self.resets[name] = self.resets.get(name, 0) + 1
+            logger.info(
+                "Counter reset: series=%s previous=%s value=%s",
+                key,
+                prev["last"],
+                value,
+                extra={"sensor": labels.get("sensor")},
+            )
+        elif value < prev["last"]:
+            # Ignore jitter, keep the counter monotonic.
+            value = prev["last"]
+
+        rate = None
+        adjusted = value + prev["offset"]
+        if timestamp > prev["time"]:
+            rate = (adjusted - previous_adjusted) / ((timestamp - prev["time"]) / (60 * 60 * 1000))
+
+        prev["last"] = value
+        prev["time"] = max(timestamp, prev["time"])
+        return adjusted, rate
+
+
+tracker: CounterTracker | None = None
+
+
+def configure(runtime: config.Runtime) -> None:
+    """Start tracking counters.
+
+    :param runtime: Runtime settings: monotonic_counters, counter_state_file, counter_monotonic and counter_rate.
+    """
+    global tracker
+    tracker = CounterTracker(
+        runtime.monotonic_counters,
+        path=runtime.counter_state_file,
+        monotonic=runtime.counter_monotonic,
+        rate=runtime.counter_rate,
+    )
+    sink.register(tracker.process)
+
+
+@atexit.register
+def save() -> None:
+    """Write the counter state to file."""
+    if tracker:
+        tracker.save()
+
+
+def collect(metrics: prometheus.Metrics) -> None:
+    if tracker is None:
+        return
+    resets = metrics.counter("counter_resets_total", "Number of detected counter resets")
+    for name, count in tracker.resets.items():
+        resets.add(count, labels={"metric": name})
@@ -0,0 +1,184 @@
+# Compiler for declarative metric mapping specs.
+#
+# A spec describes how values are picked from a JSON document and turned into metrics.
+# It is compiled once into plain functions, so that extracting the values from each response
+# does not need to interpret the spec again.
+#
+# Example spec:
+#
+#   labels:                         # labels for all metrics
+#     sensor: "{instance_name}"     # variables are substituted when the spec is compiled
+#   metrics:
+#   - type: gauge                   # gauge (default) or counter
+#     name: electric_power_w
+#     help: Instantaneous power in Watt.
+#     labels: {}                    # labels for all samples of this metric
+#     samples:
+#     - path: emeters[0].power      # value selector
+#       labels: {phase: "1"}
+#     - sum: emeters[*].power       # sum of values, selector or list of selectors
+#       labels: {phase: all}
+#     - path: emeters[0].total
+#       scale: 0.001                # multiply the value
+#       integer: false              # truncate the value to integer
+#       when: {path: emeters[0].is_valid, equals: true}  # skip the sample unless the condition holds...
+#       otherwise: 0                # ...or use this value instead
+#
+# Selectors are dotted paths of object keys and list indices, for example "result.switch:0.aenergy.total"
+# or "nrg[7]". The wildcard index "[*]" selects the value from all items of a list.
+
+import operator
+import re
+from typing import Any, Callable, Optional
+
+import prometheus
+
+Selector = Callable[[Any], Any]
+Extractor = Callable[[Any], Optional[float]]
+
+_PATH_RE = re.compile(r"^(?:[^.\[\]]+|\[(?:\d+|\*)\])(?:\.[^.\[\]]+|\[(?:\d+|\*)\])*$")
+_TOKEN_RE = re.compile(r"\[(\d+|\*)\]|([^.\[\]]+)")
+
+
+def parse_path(path: str) -> list:
+    """Parse a selector path into a list of keys.
+
+    :param path: The selector, for example "emeters[0].power".
+    :return: List of keys, where integers are list indices and None is the wildcard index.
+    """
+    if not isinstance(path, str) or not _PATH_RE.match(path):
+        raise ValueError(f"Invalid selector: {path!r}")
+
+    keys = []
+    for index, key in _TOKEN_RE.findall(path):
+        if key:
+            keys.append(key)
+        elif index == "*":
+            keys.append(None)
+        else:
+            keys.append(int(index))
+    return keys
+
+
+def _compile_keys(keys: list) -> Selector:
+    if None in keys:
+        i = keys.index(None)
+        head = _compile_keys(keys[:i])
+        tail = _compile_keys(keys[i + 1 :])
+        return lambda d: [tail(item) for item in head(d)]
+
+    if not keys:
+        return lambda d: d
+
+    if len(keys) == 1:
+        return operator.itemgetter(keys[0])
+
+    keys = tuple(keys)
+
+    def get(d):
+        for k in keys:
+            d = d[k]
+        return d
+
+    return get
+
+
+def compile_selector(path: str) -> Selector:
+    """Compile a selector path into a function that returns the selected value from a document."""
+    return _compile_keys(parse_path(path))
+
+
+def compile_condition(spec: dict) -> Callable[[Any], bool]:
+    if "path" not in spec or "equals" not in spec:
+        raise ValueError(f"Condition must have 'path' and 'equals': {spec!r}")
+    get = compile_selector(spec["path"])
+    expected = spec["equals"]
+    return lambda d: get(d) == expected
+
+
+def compile_value(spec: dict) -> Extractor:
+    """Compile a sample spec into a function that returns the value of the sample.
+
+    :param spec: The sample spec.
+    :return: Function that returns the value, or None if the sample should be skipped.
+    """
+    if "path" in spec:
+        get = compile_selector(spec["path"])
+    elif "sum" in spec:
+        paths = spec["sum"] if isinstance(spec["sum"], list) else [spec["sum"]]
+        getters = [compile_selector(p) for p in paths]
+
+        def get(d):
+            total = 0
+            for g in getters:
+                v = g(d)
+                total += sum(v) if isinstance(v, list) else v
+            return total
+
+    else:
+        raise ValueError(f"Sample must have 'path' or 'sum': {spec!r}")
+
+    value = get
+    if "scale" in spec:
+        scale = float(spec["scale"])
+        unscaled = value
+        value = lambda d: unscaled(d) * scale
+
+    if spec.get("integer", False):
+        non_integer = value
+        value = lambda d: int(non_integer(d))
+
+    if "when" in spec:
+        condition = compile_condition(spec["when"])
+        otherwise = spec.get("otherwise")
+        unconditional = value
+        value = lambda d: unconditional(d) if condition(d) else otherwise
+
+    return value
+
+
+def render_labels(labels: Optional[dict], variables: dict) -> dict[str, str]:
+    """Substitute variables such as {instance_name} in label values."""
+    return {str(k): str(v).format_map(variables) for k, v in (labels or {}).items()}
+
+
+def compile_metrics(spec: dict, variables: dict) -> Callable[[Any, prometheus.Metrics], None]:
+    """Compile a metrics spec into a function that adds the metrics from a document.
+
+    :param spec: The spec, see the beginning of this module.
+    :param variables: Variables to substitute in label values.
+    :return: Function that takes the document and the metrics to add to.
+        It raises KeyError, IndexError or TypeError if a selected value is missing from the document.
+    """
+    common_labels = render_labels(spec.get("labels"), variables)
+
+    families = []
+    for m in spec.get("metrics", []):
+        if "name" not in m:
+            raise ValueError(f"Metric must have 'name': {m!r}")
+
+        kind = m.get("type", "gauge")
+        if kind not in ("gauge", "counter"):
+            raise ValueError(f"Invalid metric type for {m['name']}: {kind}")
+
+        labels = {**common_labels, **render_labels(m.get("labels"), variables)}
+        samples = [(compile_value(s), render_labels(s.get("labels"), variables)) for s in m.get("samples", [])]
+        families.append((kind, m["name"], m.get("help", ""), labels, samples))
+
+    if not families:
+        raise ValueError("Spec does not define any metrics")
+
+    def extract(doc: Any, metrics: prometheus.Metrics) -> None:
+        # Pick all values before adding any, so that nothing is added if the document is incomplete.
+        values = [[value(doc) for value, _ in samples] for _, _, _, _, samples in families]
+
+        for (kind, name, description, labels, samples), family_values in zip(families, values):
+            if kind == "counter":
+                s = metrics.counter(name, description, labels=labels)
+            else:
+                s = metrics.gauge(name, description, labels=labels)
+            for (_, sample_labels), v in zip(samples, family_values):
+                if v is not None:
+                    s.add(v, labels=sample_labels)
+
+    return extract
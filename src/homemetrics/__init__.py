@@ -1,2 +1,2 @@
 # Import all task classes to get them to execute registration code.
-from . import spothinta, skoda, goecharger, shelly1, shelly2, zwave, zigbee, melcloud
+from . import spothinta, skoda, goecharger, shelly1, shelly2, shellypush, httppoller, zwave, zigbee, melcloud
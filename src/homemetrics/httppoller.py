@@ -0,0 +1,5 @@
+import poller
+import task
+
+# Generic HTTP poller, the spec is given in the configuration file.
+task.register(poller.HttpPoller, "http-poller")
@@ -1,9 +1,14 @@
 import asyncio
 import logging
+from dataclasses import dataclass
 
 import datetime
-import httpx
+import circuitbreaker
+import config
+import httpclient
+import offload
 import prometheus
+import sink
 import task
 import utils
 
@@ -14,12 +19,20 @@ logger = logging.getLogger("app.melcloud")
 
 
 class Melcloud(object):
-    def configure(self, instance_name, config):
+    @dataclass(frozen=True, kw_only=True)
+    class Settings:
+        database_url: str = config.setting(key="database_url")
+        username: str
+        password: str
+        poll_period: datetime.timedelta = datetime.timedelta(hours=1)
+
+    def configure(self, instance_name, settings):
         self.instance_name = instance_name if instance_name else "melcloud"
-        self.username = config["username"]
-        self.password = config["password"]
-        self.poll_period = utils.parse_timedelta(config.get("poll-period", "1h"))
-        self.database_url = config["database_url"]
+        self.username = settings.username
+        self.password = settings.password
+        self.poll_period = settings.poll_period
+        self.sink = sink.get(settings.database_url)
+        self.breaker = circuitbreaker.for_url(MELCLOUD_URI)
 
     async def start(self):
         logger.info(f"Starting Melcloud instance_name={self.instance_name} poll_period_sec={self.poll_period}")
@@ -32,9 +45,38 @@ class Melcloud(object):
             await asyncio.sleep(delay.total_seconds())
 
     async def update_metrics(self):
+        res = await self.breaker.call(self.fetch)
+        dev = res[0]["Structure"]["Devices"][0]["Device"]
+
+        last_report_utc = (
+            datetime.datetime.fromisoformat(dev["LastTimeStamp"]).astimezone().replace(tzinfo=datetime.timezone.utc)
+        )
+        timestamp = last_report_utc.timestamp() * 1000
+
+        metrics = prometheus.Metrics()
+
+        metrics.gauge(
+            "temperature_celsius",
+            "Temperature in Celsius",
+            labels={"sensor": self.instance_name},
+        ).add(dev["RoomTemperature"], timestamp_msec=timestamp)
+
+        metrics.gauge(
+            "target_temperature_celsius",
+            "Target temperature in Celsius",
+            labels={"sensor": self.instance_name},
+        ).add(dev["SetTemperature"], timestamp_msec=timestamp)
+
+        metrics.gauge(
+            "electric_consumption_kwh", "Energy consumption in kWh", labels={"sensor": self.instance_name}
+        ).add(dev["CurrentEnergyConsumed"] / 1000, timestamp_msec=timestamp)
+
+        await self.sink.write(metrics)
+
+    async def fetch(self):
         logger.debug(f"loggin in: username={self.username} password={'<redacted>' if self.password else 'None'}")
 
-        client = httpx.AsyncClient()
+        client = httpclient.get()
         response = await client.post(
             f"{MELCLOUD_URI}/Login/ClientLogin",
             json={
@@ -43,14 +85,18 @@ class Melcloud(object):
                 "Password": self.password,
             },
         )
+        if response.status_code in (401, 403):
+            raise task.AuthenticationException(f"failed to login: {response.status_code}")
         if response.status_code != 200:
             logger.error(f"failed to login: {response.status_code}")
             raise task.TaskException(f"failed to login: {response.status_code}")
 
         res = response.json()
         if res["ErrorId"]:
-            logger.error(f"failed to login ErrorId={res['ErrorId']} ErrorMessagre={res['ErrorMessage']}")
-            raise task.TaskException(f"failed to login ErrorId={res['ErrorId']} ErrorMessagre={res['ErrorMessage']}")
+            # Wrong credentials or too many failed attempts.
+            raise task.AuthenticationException(
+                f"failed to login ErrorId={res['ErrorId']} ErrorMessage={res['ErrorMessage']}"
+            )
 
         logger.debug(f"getting devices")
         response = await client.get(
@@ -64,34 +110,7 @@ class Melcloud(object):
             logger.error(f"failed to get devices: {response.status_code}")
             raise task.TaskException(f"failed to get devices: {response.status_code}")
 
-        res = response.json()
-        dev = res[0]["Structure"]["Devices"][0]["Device"]
-
-        last_report_utc = (
-            datetime.datetime.fromisoformat(dev["LastTimeStamp"]).astimezone().replace(tzinfo=datetime.timezone.utc)
-        )
-        timestamp = last_report_utc.timestamp() * 1000
-
-        metrics = prometheus.Metrics()
-
-        metrics.gauge(
-            "temperature_celsius",
-            "Temperature in Celsius",
-            labels={"sensor": self.instance_name},
-        ).add(dev["RoomTemperature"], timestamp_msec=timestamp)
-
-        metrics.gauge(
-            "target_temperature_celsius",
-            "Target temperature in Celsius",
-            labels={"sensor": self.instance_name},
-        ).add(dev["SetTemperature"], timestamp_msec=timestamp)
-
-        metrics.gauge(
-            "electric_consumption_kwh", "Energy consumption in kWh", labels={"sensor": self.instance_name}
-        ).add(dev["CurrentEnergyConsumed"] / 1000, timestamp_msec=timestamp)
-
-        logger.info(f"Storing metrics: url={self.database_url}")
-        await client.post(self.database_url, content=metrics.format())
+        return await offload.json_loads(response.content)
 
 
 task.register(Melcloud, "melcloud")
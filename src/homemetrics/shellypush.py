@@ -0,0 +1,301 @@
+# Event driven ingestion for Shelly devices.
+#
+# Instead of polling, the devices push their status changes:
+#
+# - Shelly 2nd gen devices connect to us with outbound websocket, or publish to MQTT broker.
+#   They send NotifyFullStatus when the websocket connects and NotifyStatus with the changed
+#   fields afterwards. Over MQTT, the full status of a component is published to <prefix>/status/<component>
+#   when "Generic status update over MQTT" is enabled in the device.
+#   https://shelly-api-docs.shelly.cloud/gen2/General/Notifications
+# - Shelly 1st gen devices publish each value to its own MQTT topic, for example shellies/<id>/emeter/0/power.
+#   https://shelly-api-docs.shelly.cloud/gen1/#shelly-3em-mqtt
+#
+# The full status of each device is kept in memory and updated incrementally from the pushed changes.
+# Metrics are then extracted from the status with the same spec as used by the polling tasks,
+# labeled with the name given to the device in the configuration, or with the device id.
+# Changes arriving close to each other are written to the database in one batch.
+
+import asyncio
+import json
+import logging
+from dataclasses import dataclass
+
+import aiomqtt
+import circuitbreaker
+import config
+import extract
+import mqtt
+import prometheus
+import sink
+import task
+from aiohttp import WSCloseCode, WSMsgType, web
+
+from . import shelly1, shelly2
+
+logger = logging.getLogger("app.shelly-push")
+
+
+def merge(state: dict, delta: dict) -> None:
+    """Merge changed fields into the state, recursing into nested objects."""
+    for k, v in delta.items():
+        if isinstance(v, dict) and isinstance(state.get(k), dict):
+            merge(state[k], v)
+        else:
+            state[k] = v
+
+
+class ShellyPush(object):
+    # Subclasses override these to describe a device type.
+    description = ""
+    spec: dict = {}
+
+    @dataclass(frozen=True, kw_only=True)
+    class Settings:
+        database_url: str = config.setting(key="database_url")
+        spec: dict | None = None
+        flush_delay: float = config.setting(1.0, minimum=0)
+        # Names for the devices by their id. Devices that are not listed are named by their id.
+        devices: dict[str, str] = config.setting({})
+
+    def configure(self, instance_name, settings):
+        self.instance_name = instance_name
+        self.sink = sink.get(settings.database_url)
+        self.spec = self.spec if settings.spec is None else settings.spec
+        self.flush_delay = settings.flush_delay
+        self.device_names = settings.devices
+
+        self.states: dict[str, dict] = {}
+        self.extractors = {}
+        self.dirty: set[str] = set()
+        self.flusher: asyncio.Task | None = None
+        self.stopping = asyncio.Event()
+
+        # Check the spec at startup instead of when the first device connects.
+        extract.compile_metrics(self.spec, {"instance_name": instance_name})
+
+    def document(self, device_id: str) -> dict:
+        """Return the document that the spec is applied to."""
+        return self.states[device_id]
+
+    def stop(self):
+        """Handle the updates already received, write the pending changes and return from start."""
+        self.stopping.set()
+
+    def changed(self, device_id: str) -> None:
+        """Schedule writing the metrics of the device."""
+        self.dirty.add(device_id)
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        self.flusher = None
+        await self.flush()
+
+    async def flush_now(self):
+        """Write the pending changes without waiting for the flush delay."""
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        await self.flush()
+
+    async def flush(self):
+        dirty, self.dirty = self.dirty, set()
+
+        metrics = prometheus.Metrics()
+        for device_id in dirty:
+            if device_id not in self.extractors:
+                name = self.device_names.get(device_id, device_id)
+                self.extractors[device_id] = extract.compile_metrics(self.spec, {"instance_name": name})
+            try:
+                self.extractors[device_id](self.document(device_id), metrics)
+            except (KeyError, IndexError, TypeError):
+                # Status is not complete yet, wait for more updates.
+                logger.debug("Incomplete status: device=%s", device_id, extra={"sensor": device_id})
+
+        await self.sink.write(metrics)
+
+
+class Shelly2Push(ShellyPush):
+    description = "Shelly 2nd Gen push"
+    spec = shelly2.SPEC
+
+    @dataclass(frozen=True, kw_only=True)
+    class Settings(ShellyPush.Settings):
+        mode: str = config.setting("websocket", choices=("websocket", "mqtt"))
+        listen_address: str = "0.0.0.0"
+        listen_port: int = config.setting(8765, minimum=1)
+        path: str = "/shelly"
+        server: str | None = None
+        port: int = config.setting(1883, minimum=1)
+        topic: str = "#"
+
+    def configure(self, instance_name, settings):
+        super().configure(instance_name, settings)
+        self.mode = settings.mode
+        if self.mode == "websocket":
+            self.listen_address = settings.listen_address
+            self.listen_port = settings.listen_port
+            self.path = settings.path
+            self.websockets: set[web.WebSocketResponse] = set()
+        else:
+            if not settings.server:
+                raise task.TaskException("missing server for mode mqtt")
+            self.server = settings.server
+            self.port = settings.port
+            self.topic = settings.topic
+            self.breaker = circuitbreaker.get(f"mqtt://{self.server}:{self.port}")
+
+    def document(self, device_id):
+        # Same layout as the response to Shelly.GetStatus, to use the spec of the polling task.
+        return {"result": self.states[device_id]}
+
+    async def start(self):
+        logger.info(f"Starting {self.description} instance_name={self.instance_name} mode={self.mode}")
+
+        if self.mode == "websocket":
+            await self.serve_websocket()
+        else:
+            self.breaker.check()
+            try:
+                await self.subscribe()
+            except aiomqtt.MqttError as e:
+                raise self.breaker.failure(e) from e
+        await self.flush_now()
+
+    async def serve_websocket(self):
+        app = web.Application()
+        app.router.add_get(self.path, self.handle_websocket)
+        # Connections are closed before cleanup, do not wait for the handlers for long.
+        runner = web.AppRunner(app, shutdown_timeout=1)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.listen_address, self.listen_port).start()
+            logger.info(f"Listening for devices: address={self.listen_address}:{self.listen_port} path={self.path}")
+            await self.stopping.wait()
+
+            # Write the pending changes before closing the connections, devices reconnect after restart.
+            await self.flush_now()
+            await asyncio.gather(
+                *(ws.close(code=WSCloseCode.GOING_AWAY) for ws in list(self.websockets)), return_exceptions=True
+            )
+        finally:
+            await runner.cleanup()
+
+    async def handle_websocket(self, request):
+        ws = web.WebSocketResponse(heartbeat=60)
+        await ws.prepare(request)
+        logger.info(f"Device connected: address={request.remote}")
+
+        self.websockets.add(ws)
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    frame = json.loads(message.data)
+                except json.JSONDecodeError:
+                    logger.debug("Received non-JSON message: %s", message.data)
+                    continue
+                self.notification(frame.get("src", ""), frame)
+        finally:
+            self.websockets.discard(ws)
+
+        logger.info(f"Device disconnected: address={request.remote}")
+        return ws
+
+    async def subscribe(self):
+        async with aiomqtt.Client(self.server, self.port) as client:
+            await client.subscribe(self.topic)
+            self.breaker.record_success()
+            async for message in mqtt.receive(client, self.stopping):
+                self.message(str(message.topic), message.payload)
+
+    def message(self, topic: str, payload: bytes) -> None:
+        # Topics: <prefix>/events/rpc and <prefix>/status/<component>
+        parts = topic.rsplit("/", 2)
+        if len(parts) != 3:
+            return
+        try:
+            data = json.loads(payload)
+        except (json.JSONDecodeError, TypeError):
+            return
+        if parts[1] == "events" and parts[2] == "rpc":
+            self.notification(parts[0], data)
+        elif parts[1] == "status":
+            self.states.setdefault(parts[0], {})[parts[2]] = data
+            self.changed(parts[0])
+
+    def notification(self, device_id: str, frame: dict) -> None:
+        method = frame.get("method")
+        params = dict(frame.get("params", {}))
+        params.pop("ts", None)
+
+        if method == "NotifyFullStatus":
+            self.states[device_id] = params
+        elif method == "NotifyStatus":
+            merge(self.states.setdefault(device_id, {}), params)
+        else:
+            # Events such as button presses do not carry status.
+            return
+
+        self.changed(device_id)
+
+
+class Shelly1Mqtt(ShellyPush):
+    description = "Shelly 1st Gen MQTT"
+    spec = shelly1.SPEC
+
+    @dataclass(frozen=True, kw_only=True)
+    class Settings(ShellyPush.Settings):
+        server: str
+        port: int = config.setting(1883, minimum=1)
+        topic: str = "shellies/+/emeter/+/+"
+
+    def configure(self, instance_name, settings):
+        super().configure(instance_name, settings)
+        self.server = settings.server
+        self.port = settings.port
+        self.topic = settings.topic
+        self.breaker = circuitbreaker.get(f"mqtt://{self.server}:{self.port}")
+
+    async def start(self):
+        logger.info(
+            f"Starting {self.description} instance_name={self.instance_name} server={self.server} topic={self.topic}"
+        )
+
+        self.breaker.check()
+        try:
+            await self.subscribe()
+        except aiomqtt.MqttError as e:
+            raise self.breaker.failure(e) from e
+        await self.flush_now()
+
+    async def subscribe(self):
+        async with aiomqtt.Client(self.server, self.port) as client:
+            await client.subscribe(self.topic)
+            self.breaker.record_success()
+            async for message in mqtt.receive(client, self.stopping):
+                self.message(str(message.topic), message.payload)
+
+    def message(self, topic: str, payload: bytes) -> None:
+        # Topic: shellies/<id>/emeter/<index>/<property>
+        parts = topic.split("/")
+        if len(parts) != 5 or parts[2] != "emeter" or not parts[3].isdigit():
+            return
+        try:
+            value = float(payload)
+        except (ValueError, TypeError):
+            return
+
+        # Keep the status in the same layout as the /status response, to use the spec of the polling task.
+        device_id, index, property = parts[1], int(parts[3]), parts[4]
+        emeters = self.states.setdefault(device_id, {}).setdefault("emeters", [])
+        while len(emeters) <= index:
+            emeters.append({})
+        emeters[index][property] = value
+        self.changed(device_id)
+
+
+task.register(Shelly2Push, "shelly2-push")
+task.register(Shelly1Mqtt, "shelly1-mqtt")
@@ -1,27 +1,40 @@
 import asyncio
 import datetime
 import logging
+from dataclasses import dataclass
 
+import circuitbreaker
+import config
 import prometheus
+import sink
 import task
 import utils
 from aiohttp import ClientSession
 from skodaconnect import Connection
+from skodaconnect.exceptions import SkodaAccountLockedException, SkodaAuthenticationException, SkodaEULAException
 
 logger = logging.getLogger("app.skoda")
 
 
 class Skoda(object):
-    def configure(self, instance_name, config):
+    @dataclass(frozen=True, kw_only=True)
+    class Settings:
+        database_url: str = config.setting(key="database_url")
+        username: str
+        password: str
+        vin: str
+        debug: bool = False
+        poll_schedule: list[datetime.time] = config.setting([datetime.time(0, 0), datetime.time(12, 0)])
+
+    def configure(self, instance_name, settings):
         self.instance_name = instance_name
-        self.username = config["username"]
-        self.password = config["password"]
-        self.vin = config["vin"]
-        self.api_debug = config.get("debug", False)
-        self.database_url = config["database_url"]
-        self.poll_schedule = []
-        for t in config.get("poll-schedule", ["0:00", "12:00"]):
-            self.poll_schedule.append(datetime.datetime.strptime(t, "%H:%M").time())
+        self.username = settings.username
+        self.password = settings.password
+        self.vin = settings.vin
+        self.api_debug = settings.debug
+        self.sink = sink.get(settings.database_url)
+        self.breaker = circuitbreaker.get("skodaconnect")
+        self.poll_schedule = sorted(settings.poll_schedule)
 
     async def start(self):
         logger.info(
@@ -40,6 +53,29 @@ class Skoda(object):
             await asyncio.sleep(delay.total_seconds())
 
     async def update_metrics(self):
+        res_vehicle_status, res_charging_status = await self.breaker.call(self.fetch)
+
+        # Create record of vehicle data to send to timeseries database.
+        metrics = prometheus.Metrics()
+
+        time_of_report = (
+            datetime.datetime.fromisoformat(res_vehicle_status["vehicle_remote"]["capturedAt"]).timestamp() * 1000
+        )
+
+        samples = metrics.counter("odometer_km", "Odometer (km)", labels={"sensor": "car"})
+        samples.add(res_vehicle_status["vehicle_remote"]["mileageInKm"], timestamp_msec=time_of_report)
+
+        samples = metrics.gauge("battery_percentage", "State of charge (%)", labels={"sensor": "car"})
+        samples.add(res_charging_status["battery"]["stateOfChargeInPercent"], timestamp_msec=time_of_report)
+
+        samples = metrics.gauge("range_km", "Estimated range (km)", labels={"sensor": "car"})
+        samples.add(
+            res_charging_status["battery"]["cruisingRangeElectricInMeters"] / 1000, timestamp_msec=time_of_report
+        )
+
+        await self.sink.write(metrics)
+
+    async def fetch(self):
         # Create HTTP session.
         async with ClientSession() as session:
             # Create connection to Skoda Connect API.
@@ -47,40 +83,23 @@ class Skoda(object):
 
             # Login with credentials.
             logger.debug(f'Logging in: username={self.username} password={"<redacted>" if self.password else "None"}')
-            await conn.doLogin()
+            try:
+                if not await conn.doLogin():
+                    raise task.TaskException("failed to login")
+            except (SkodaAuthenticationException, SkodaAccountLockedException, SkodaEULAException) as e:
+                raise task.AuthenticationException(f"failed to login: {e}") from e
 
             # Get vehicle status.
             logger.debug(f"Getting vehicle status: vin={self.vin}")
             res_vehicle_status = await conn.getVehicleStatus(self.vin)
-            logger.debug(f"Result: {res_vehicle_status}")
+            logger.debug("Result: %s", res_vehicle_status)
 
             # Get charging status.
             logger.debug(f"Getting changing status: vin={self.vin}")
             res_charging_status = await conn.getCharging(self.vin)
-            logger.debug(f"Result: {res_charging_status}")
-
-            # Create record of vehicle data to send to timeseries database.
-            metrics = prometheus.Metrics()
-
-            time_of_report = (
-                datetime.datetime.fromisoformat(res_vehicle_status["vehicle_remote"]["capturedAt"]).timestamp() * 1000
-            )
-
-            samples = metrics.counter("odometer_km", "Odometer (km)", labels={"sensor": "car"})
-            samples.add(res_vehicle_status["vehicle_remote"]["mileageInKm"], timestamp_msec=time_of_report)
-
-            samples = metrics.gauge("battery_percentage", "State of charge (%)", labels={"sensor": "car"})
-            samples.add(res_charging_status["battery"]["stateOfChargeInPercent"], timestamp_msec=time_of_report)
-
-            samples = metrics.gauge("range_km", "Estimated range (km)", labels={"sensor": "car"})
-            samples.add(
-                res_charging_status["battery"]["cruisingRangeElectricInMeters"] / 1000, timestamp_msec=time_of_report
-            )
-
-            logger.info(f"Storing metrics: url={self.database_url}")
+            logger.debug("Result: %s", res_charging_status)
 
-            async with ClientSession() as request:
-                await request.post(self.database_url, data=metrics.format())
+            return res_vehicle_status, res_charging_status
 
 
 task.register(Skoda, "skoda")
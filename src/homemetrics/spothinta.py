@@ -1,9 +1,14 @@
 import asyncio
 import logging
-from datetime import datetime
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 
-import httpx
+import circuitbreaker
+import config
+import httpclient
+import offload
 import prometheus
+import sink
 import task
 import utils
 
@@ -12,12 +17,27 @@ SPOT_HINTA_URI = "https://api.spot-hinta.fi/TodayAndDayForward"
 logger = logging.getLogger("app.spot-hinta")
 
 
+@dataclass(frozen=True, kw_only=True)
+class Rates:
+    # Transmission prices and electricity tax (euros per kWh).
+    day: float
+    night: float
+    tax: float
+
+
 class SpotHinta(object):
-    def configure(self, instance_name, config):
+    @dataclass(frozen=True, kw_only=True)
+    class Settings:
+        database_url: str = config.setting(key="database_url")
+        poll_period: timedelta = timedelta(hours=8)
+        rates: Rates
+
+    def configure(self, instance_name, settings):
         self.instance_name = instance_name
-        self.poll_period = utils.parse_timedelta(config.get("poll-period", "8h"))
-        self.database_url = config["database_url"]
-        self.rates = config["rates"]
+        self.poll_period = settings.poll_period
+        self.sink = sink.get(settings.database_url)
+        self.breaker = circuitbreaker.for_url(SPOT_HINTA_URI)
+        self.rates = settings.rates
 
     async def start(self):
         logger.info(f"Starting SpotHinta instance_name={self.instance_name} poll_period_sec={self.poll_period}")
@@ -32,11 +52,7 @@ class SpotHinta(object):
     async def update_metrics(self):
         logger.debug(f"Fetching data: url={SPOT_HINTA_URI}")
 
-        client = httpx.AsyncClient()
-        response = await client.get(SPOT_HINTA_URI)
-        response.raise_for_status()
-
-        res = response.json()
+        res = await self.breaker.call(self.fetch)
 
         metrics = prometheus.Metrics()
         samples = metrics.gauge(
@@ -66,17 +82,21 @@ class SpotHinta(object):
 
         current_time = datetime.now()
         for i in range(24):
-            t = current_time + utils.parse_timedelta(f"{i}h")
+            t = current_time + timedelta(hours=i)
             t = t.replace(minute=0, second=0, microsecond=0)
             if 7 <= t.hour <= 21:
-                transmission.add(self.rates["day"], labels={"rate": "day"}, timestamp_msec=t.timestamp() * 1000)
+                transmission.add(self.rates.day, labels={"rate": "day"}, timestamp_msec=t.timestamp() * 1000)
             else:
-                transmission.add(self.rates["night"], labels={"rate": "night"}, timestamp_msec=t.timestamp() * 1000)
+                transmission.add(self.rates.night, labels={"rate": "night"}, timestamp_msec=t.timestamp() * 1000)
+
+            tax.add(self.rates.tax, timestamp_msec=t.timestamp() * 1000)
 
-            tax.add(self.rates["tax"], timestamp_msec=t.timestamp() * 1000)
+        await self.sink.write(metrics)
 
-        logger.info(f"Storing metrics: url={self.database_url}")
-        await client.post(self.database_url, content=metrics.format())
+    async def fetch(self):
+        response = await httpclient.get().get(SPOT_HINTA_URI)
+        response.raise_for_status()
+        return await offload.json_loads(response.content)
 
 
 task.register(SpotHinta, "spot-hinta")
@@ -1,74 +1,204 @@
 import asyncio
 import json
 import logging
+from dataclasses import dataclass
+from typing import Any, Callable
 
 import aiomqtt
-import httpx
+import circuitbreaker
+import config
+import extract
+import mqtt
 import prometheus
+import sink
 import task
 
 logger = logging.getLogger("app.zigbee")
 
+# Values of enum attributes that are written as 1 or 0, for example state of a switch.
+BOOLEANS = {"ON": 1, "OFF": 0, "OPEN": 1, "CLOSE": 0, "LOCK": 1, "UNLOCK": 0}
+
+
+@dataclass(frozen=True, kw_only=True)
+class Attribute:
+    # Metric the attribute is written as.
+    name: str
+    help: str = ""
+    type: str = config.setting("gauge", choices=("gauge", "counter"))
+    # Multiply the value, for example to convert millivolts to volts.
+    scale: float = 1.0
+
+
+# Zigbee attribute name to Prometheus metric mapping for all devices.
+ATTRIBUTES = {
+    "temperature": Attribute(name="temperature_celsius", help="Temperature in Celsius"),
+    "battery": Attribute(name="battery_percentage", help="Battery level in percent"),
+    "humidity": Attribute(name="humidity_percentage", help="Relative humidity in percent"),
+    "pressure": Attribute(name="pressure_hpa", help="Air pressure in hPa"),
+    "occupancy": Attribute(name="occupancy_boolean", help="Occupancy detected"),
+    "contact": Attribute(name="contact_boolean", help="Contact closed"),
+    "illuminance_lux": Attribute(name="illuminance_lux", help="Illuminance in lux"),
+    "linkquality": Attribute(name="linkquality_dbm", help="Link quality"),
+    "consumption": Attribute(name="electric_consumption_kwh", help="Total consumed energy in kWh"),
+    "power": Attribute(name="electric_power_w", help="Instantaneous power in Watt"),
+    # Not "voltage": plugs report the mains voltage in volts, but battery powered sensors report the
+    # battery voltage in millivolts. It is mapped per model in the configuration instead.
+}
+
+# Adds the metrics of a message to the given metrics: message, sensor name, metrics.
+Extractor = Callable[[dict, str, prometheus.Metrics], None]
+
+
+def coerce(value: Any) -> float | None:
+    """Convert attribute value to number, or None if it has no numeric value."""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        return BOOLEANS.get(value.upper())
+    return None
+
+
+def compile_getter(path: str) -> Callable[[dict], Any]:
+    """Compile attribute path into function that returns the value, or None if the message does not have it."""
+    keys = extract.parse_path(path)
+    if len(keys) == 1 and isinstance(keys[0], str):
+        key = keys[0]
+        return lambda d: d.get(key)
+
+    get = extract.compile_selector(path)
+
+    def get_or_none(d):
+        try:
+            return get(d)
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    return get_or_none
+
+
+def compile_mapping(attributes: dict[str, Attribute]) -> Extractor:
+    """Compile attribute mapping into extractor.
+
+    :param attributes: Metric for each attribute, by attribute path such as "temperature" or "update.state".
+    """
+    fields = [(compile_getter(path), a.type, a.name, a.help, a.scale) for path, a in attributes.items()]
+
+    def extract_metrics(event: dict, sensor_name: str, metrics: prometheus.Metrics) -> None:
+        labels = {"sensor": sensor_name}
+        for get, kind, name, description, scale in fields:
+            value = coerce(get(event))
+            if value is None:
+                continue
+            if scale != 1.0:
+                value *= scale
+            metrics.family(kind, name, description, labels).add(value)
+
+    return extract_metrics
+
 
 class Zigbee(object):
-    def configure(self, instance_name, config):
+    # Each message is handled independently, so the messages can be split between worker processes.
+    shared_subscription = True
+
+    @dataclass(frozen=True, kw_only=True)
+    class Settings:
+        database_url: str = config.setting(key="database_url")
+        server: str
+        port: int = config.setting(1883, minimum=1)
+        topic: str
+        # Attributes added to the built-in mapping for all devices.
+        attributes: dict[str, Attribute] = config.setting({})
+        # Attributes for device models, as in the zigbee2mqtt device list. None removes the attribute.
+        models: dict[str, dict[str, Attribute | None]] = config.setting({})
+
+    def configure(self, instance_name, settings):
         self.instance_name = instance_name
-        self.server = config["server"]
-        self.port = config.get("port", 1883)
-        self.topic = config["topic"]
-        self.database_url = config["database_url"]
+        self.server = settings.server
+        self.port = settings.port
+        self.topic = settings.topic
+        self.sink = sink.get(settings.database_url)
+        self.breaker = circuitbreaker.get(f"mqtt://{self.server}:{self.port}")
+
+        # Base topic of zigbee2mqtt, without the shared subscription prefix ($share/<group>/).
+        topic = self.topic.split("/", 2)[2] if self.topic.startswith("$share/") else self.topic
+        self.base_topic = topic.split("/")[0]
+
+        # Compile the mapping for each configured model, other devices use the default mapping.
+        default = {**ATTRIBUTES, **settings.attributes}
+        self.default_extractor = compile_mapping(default)
+        self.extractors: dict[str, Extractor] = {}
+        for model, attributes in settings.models.items():
+            merged = {k: v for k, v in {**default, **attributes}.items() if v is not None}
+            self.extractors[model] = compile_mapping(merged)
+
+        # Device model by friendly name, from the device list published by zigbee2mqtt.
+        self.models: dict[str, str] = {}
+
+        self.stopping = asyncio.Event()
+
+    def stop(self):
+        """Handle the messages already received and return from start."""
+        self.stopping.set()
 
     async def start(self):
         logger.info(f"Starting Zigbee instance_name={self.instance_name} server={self.server} topic={self.topic}")
-        while True:
-            await self.loop_forever()
+        while not self.stopping.is_set():
+            self.breaker.check()
+            try:
+                await self.loop_forever()
+            except aiomqtt.MqttError as e:
+                raise self.breaker.failure(e) from e
 
     async def loop_forever(self):
         async with aiomqtt.Client(self.server, self.port) as client:
             await client.subscribe(self.topic)
-            async for message in client.messages:
+            if self.topic.startswith("$share/"):
+                # Retained messages are not sent to shared subscriptions, subscribe to the device list separately.
+                await client.subscribe(f"{self.base_topic}/bridge/devices")
+            self.breaker.record_success()
+            async for message in mqtt.receive(client, self.stopping):
                 # logger.debug(f"Received message: {message.topic} {message.payload}")
 
-                # Skip (informational) bridge messages.
-                if message.topic.matches("zigbee2mqtt/bridge/#"):
-                    continue
                 try:
                     # ensure that payload is string
                     payload = (
                         message.payload.decode("utf-8") if isinstance(message.payload, bytes) else str(message.payload)
                     )
+                    if message.topic.matches(f"{self.base_topic}/bridge/devices"):
+                        self.update_devices(json.loads(payload))
+                        continue
+
+                    # Skip (informational) bridge messages.
+                    if message.topic.matches(f"{self.base_topic}/bridge/#"):
+                        continue
+
                     event = json.loads(payload)
-                    topic = str(message.topic).split("/")
-                    await self.sensor_event(topic[1], event)
+                    if isinstance(event, dict):
+                        topic = str(message.topic).split("/", 1)[1]
+                        await self.sensor_event(topic.split("/")[0], event, topic)
                 except json.JSONDecodeError:
-                    logger.debug(f"Received non-JSON message: {message.payload}")
-
-    async def sensor_event(self, sensor_name, event):
-        logger.debug(f"{sensor_name} {event}")
-
-        # zigbee attribute name to prometheus metric name mapping
-        mapping = {
-            "temperature": "temperature_celsius",
-            "battery": "battery_percentage",
-            "humidity": "humidity_percentage",
-            "pressure": "pressure_hpa",
-            "occupancy": "occupancy_boolean",
-            "contact": "contact_boolean",
-            "illuminance_lux": "illuminance_lux",
-            "linkquality": "linkquality_dbm",
-            "consumption": "electric_consumption_kwh",
-            "power": "electric_power_w",
-            # "voltage": "electric_voltage_v",  # should be divided by 1000 to convert to volts
+                    logger.debug("Received non-JSON message: %s", message.payload)
+
+    def update_devices(self, devices: list) -> None:
+        """Update device models from the device list."""
+        self.models = {
+            d["friendly_name"]: d["definition"]["model"]
+            for d in devices
+            if isinstance(d, dict) and d.get("friendly_name") and d.get("definition")
         }
+        logger.debug("Received device list: devices=%d", len(self.models))
 
-        metrics = prometheus.Metrics()
-        for k, v in event.items():
-            if k in mapping:
-                samples = metrics.gauge(mapping[k], "")
-                samples.add(v, labels={"sensor": sensor_name})
+    async def sensor_event(self, sensor_name, event, friendly_name=None):
+        logger.debug("%s %s", sensor_name, event, extra={"sensor": sensor_name})
+
+        model = self.models.get(friendly_name or sensor_name)
+        extract_metrics = self.extractors.get(model, self.default_extractor)
 
-        client = httpx.AsyncClient()
-        await client.post(self.database_url, content=metrics.format())
+        metrics = prometheus.Metrics()
+        extract_metrics(event, sensor_name, metrics)
+        await self.sink.write(metrics)
 
 
 task.register(Zigbee, "zigbee")
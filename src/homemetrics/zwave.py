@@ -5,8 +5,11 @@ import logging
 import re
 
 import aiomqtt
-import httpx
+import circuitbreaker
+import config
+import mqtt
 import prometheus
+import sink
 import task
 
 from dataclasses import dataclass
@@ -20,22 +23,47 @@ class SensorData:
     property: str
     value: float
     time: int
+    counter: bool = False
 
 
 class Zwave(object):
-    def configure(self, instance_name, config):
+    # Each message is handled independently, so the messages can be split between worker processes.
+    shared_subscription = True
+
+    @dataclass(frozen=True, kw_only=True)
+    class Settings:
+        database_url: str = config.setting(key="database_url")
+        server: str
+        port: int = config.setting(1883, minimum=1)
+        topic: str
+
+    def configure(self, instance_name, settings):
         self.instance_name = instance_name
-        self.server = config["server"]
-        self.port = config.get("port", 1883)
-        self.topic = config["topic"]
-        self.database_url = config["database_url"]
+        self.server = settings.server
+        self.port = settings.port
+        self.topic = settings.topic
+        self.sink = sink.get(settings.database_url)
+        self.breaker = circuitbreaker.get(f"mqtt://{self.server}:{self.port}")
+        self.stopping = asyncio.Event()
+
+    def stop(self):
+        """Handle the messages already received and return from start."""
+        self.stopping.set()
 
     async def start(self):
         logger.info(f"Starting Z-Wave instance_name={self.instance_name} server={self.server} topic={self.topic}")
 
+        self.breaker.check()
+        try:
+            await self.loop_forever()
+        except aiomqtt.MqttError as e:
+            raise self.breaker.failure(e) from e
+
+    async def loop_forever(self):
         async with aiomqtt.Client(self.server, self.port) as client:
             await client.subscribe(self.topic)
-            async for message in client.messages:
+            self.breaker.record_success()
+            async for message in mqtt.receive(client, self.stopping):
                 # logger.debug(f"Received message: {message.topic} {message.payload}")
 
                 # Skip informational messages.
@@ -66,10 +94,12 @@ class Zwave(object):
                 if data:
                     # Store the data in the database.
                     metrics = prometheus.Metrics()
-                    metrics.gauge(data.property, labels={"sensor": data.sensor}).add(
-                        data.value, timestamp_msec=data.time
-                    )
-                    await httpx.AsyncClient().post(self.database_url, content=metrics.format())
+                    if data.counter:
+                        samples = metrics.counter(data.property, labels={"sensor": data.sensor})
+                    else:
+                        samples = metrics.gauge(data.property, labels={"sensor": data.sensor})
+                    samples.add(data.value, timestamp_msec=data.time)
+                    await self.sink.write(metrics)
 
                     # Publish the data to the MQTT broker.
                     await client.publish(f"home/{data.sensor}/{data.property}", data.value)
@@ -91,14 +121,21 @@ class Zwave(object):
         if command_class not in [48, 49, 50, 128]:
             return None
 
-        payload_dbg = {
-            "time": datetime.datetime.fromtimestamp(payload["time"] / 1000).isoformat(),
-            "value": payload["value"] if "value" in payload else None,
-        }
-
-        logger.debug(
-            f"node_id={node_id} command_class={command_class} endpoint={endpoint} property={property} property_key={property_key} payload={payload_dbg}"
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            payload_dbg = {
+                "time": datetime.datetime.fromtimestamp(payload["time"] / 1000).isoformat(),
+                "value": payload["value"] if "value" in payload else None,
+            }
+            logger.debug(
+                "node_id=%s command_class=%s endpoint=%s property=%s property_key=%s payload=%s",
+                node_id,
+                command_class,
+                endpoint,
+                property,
+                property_key,
+                payload_dbg,
+                extra={"sensor": node_id},
+            )
 
         metrics = prometheus.Metrics()
 
@@ -131,7 +168,11 @@ class Zwave(object):
             if property_key == "65537":
                 # Electric consumption kWh
                 return SensorData(
-                    sensor=node_id, property="electric_consumption_kwh", value=payload["value"], time=payload["time"]
+                    sensor=node_id,
+                    property="electric_consumption_kwh",
+                    value=payload["value"],
+                    time=payload["time"],
+                    counter=True,
                 )
             elif property_key == "66049":
                 # Electric power W
@@ -0,0 +1,25 @@
+import httpx
+
+# Shared HTTP client for all tasks.
+# Reusing the client keeps connections to devices and to the database alive between polls,
+# instead of opening a new connection pool for every request.
+_client: httpx.AsyncClient | None = None
+
+
+def get() -> httpx.AsyncClient:
+    """Get the shared HTTP client.
+
+    :return: The client, created on first use.
+    """
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+    return _client
+
+
+async def close() -> None:
+    """Close the connections of the shared HTTP client."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
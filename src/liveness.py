@@ -0,0 +1,163 @@
+# Liveness tracking of sensors.
+#
+# When a device goes silent, its last value stays in the database and looks current. Each sensor
+# is therefore tracked from the metrics written to the database, and following metrics are exported:
+#
+# - up: 1 when the sensor has written metrics within its timeout, otherwise 0.
+# - last_seen_seconds: Unix time when the sensor last wrote metrics.
+#
+# The change of up is written immediately when a sensor goes silent or comes back, and all sensors
+# are included in the self-metrics.
+#
+# Timeouts are tracked with a single hashed timer wheel instead of a timer per sensor. Receiving data
+# only updates the deadline of the sensor. When the slot of the old deadline comes up, the sensor is
+# either marked down or moved to the slot of its new deadline, so the cost does not grow with the rate
+# of the data.
+
+import asyncio
+import datetime
+import logging
+import time
+from dataclasses import dataclass
+
+import config
+import prometheus
+import sink
+import task
+
+logger = logging.getLogger("app.liveness")
+
+# Metrics written by this module, not counted as data from the sensor.
+OWN_METRICS = ("up", "last_seen_seconds")
+
+
+class TimerWheel(object):
+    def __init__(self, tick: float = 1.0, slots: int = 512):
+        """
+        :param tick: Resolution of the timers in seconds.
+        :param slots: Number of slots. Deadlines further than tick * slots wrap around and are checked again.
+        """
+        self.tick = tick
+        self.slots: list[list[str]] = [[] for _ in range(slots)]
+        self.current = int(time.monotonic() / tick)
+
+    def schedule(self, key: str, deadline: float) -> None:
+        # Deadline in the past is handled on the next advance.
+        index = max(int(deadline / self.tick), self.current + 1)
+        self.slots[index % len(self.slots)].append(key)
+
+    def advance(self, now: float) -> list[str]:
+        """Move the wheel to the current time.
+
+        :return: Keys scheduled in the passed slots. Their deadlines need to be checked by the caller.
+        """
+        due = []
+        target = int(now / self.tick)
+        # After a long pause, every slot needs to be visited only once.
+        start = max(self.current + 1, target - len(self.slots) + 1)
+        for i in range(start, target + 1):
+            slot = i % len(self.slots)
+            due.extend(self.slots[slot])
+            self.slots[slot] = []
+        self.current = max(self.current, target)
+        return due
+
+
+class Sensor(object):
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.up = True
+        self.last_seen = time.time()
+        self.deadline = time.monotonic() + timeout
+
+
+class LivenessTracker(object):
+    @dataclass(frozen=True, kw_only=True)
+    class Settings:
+        database_url: str = config.setting(key="database_url")
+        # Default timeout, and timeouts of individual sensors by name.
+        timeout: datetime.timedelta = datetime.timedelta(minutes=10)
+        timeouts: dict[str, datetime.timedelta] = config.setting({})
+        # Resolution of the timeouts in seconds.
+        tick: float = config.setting(1.0, greater_than=0)
+
+    def configure(self, instance_name, settings):
+        self.instance_name = instance_name
+        self.sink = sink.get(settings.database_url)
+        self.timeout = settings.timeout.total_seconds()
+        self.timeouts = {name: t.total_seconds() for name, t in settings.timeouts.items()}
+        self.wheel = TimerWheel(tick=settings.tick)
+        self.sensors: dict[str, Sensor] = {}
+
+        # Sensors that went down or came back since the last tick.
+        self.changed: set[str] = set()
+
+        sink.register(self.process)
+
+    async def start(self):
+        logger.info(f"Starting liveness tracking timeout_sec={self.timeout} sensors_with_timeout={len(self.timeouts)}")
+
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            self.expire(time.monotonic())
+            if self.changed:
+                metrics = prometheus.Metrics()
+                self.collect_sensors(metrics, self.changed)
+                self.changed = set()
+                await self.sink.write(metrics)
+
+    def process(self, metrics: prometheus.Metrics) -> None:
+        """Mark the sensors in the metrics as seen, called for all metrics written to the database."""
+        for family in metrics.families.values():
+            if family["name"] in OWN_METRICS:
+                continue
+            for samples in family["samples"]:
+                sensor = samples.common_labels_for_all_samples.get("sensor")
+                if sensor is not None:
+                    self.seen(sensor)
+                for sample in samples.samples:
+                    if "sensor" in sample["labels"]:
+                        self.seen(sample["labels"]["sensor"])
+
+    def seen(self, name: str) -> None:
+        s = self.sensors.get(name)
+        if s is None:
+            s = Sensor(self.timeouts.get(name, self.timeout))
+            self.sensors[name] = s
+            self.wheel.schedule(name, s.deadline)
+            return
+
+        s.last_seen = time.time()
+        s.deadline = time.monotonic() + s.timeout
+        if not s.up:
+            logger.info("Sensor is up again: sensor=%s", name, extra={"sensor": name})
+            s.up = True
+            self.changed.add(name)
+            self.wheel.schedule(name, s.deadline)
+
+    def expire(self, now: float) -> None:
+        for name in self.wheel.advance(now):
+            s = self.sensors[name]
+            if s.deadline > now:
+                # Seen after the timer was scheduled.
+                self.wheel.schedule(name, s.deadline)
+            elif s.up:
+                logger.warning(
+                    "Sensor is down, no data in %.0f seconds: sensor=%s", s.timeout, name, extra={"sensor": name}
+                )
+                s.up = False
+                self.changed.add(name)
+
+    def collect_sensors(self, metrics: prometheus.Metrics, names) -> None:
+        up = metrics.gauge("up", "Whether the sensor has sent data within its timeout")
+        last_seen = metrics.gauge("last_seen_seconds", "Unix time when the sensor last sent data")
+        for name in names:
+            s = self.sensors[name]
+            up.add(1 if s.up else 0, labels={"sensor": name})
+            last_seen.add(s.last_seen, labels={"sensor": name})
+
+    def collect(self, metrics: prometheus.Metrics) -> None:
+        self.collect_sensors(metrics, self.sensors)
+
+
+task.register(LivenessTracker, "liveness", internal=True)
@@ -0,0 +1,93 @@
+# Logging configuration.
+#
+# Logging is configured from logging.yaml with logging.config.dictConfig, with following additions:
+# - JsonFormatter writes each record as one JSON object per line, including the fields given
+#   with the extra parameter, for example logger.debug("...", extra={"sensor": name}).
+# - Non-standard top-level key "queue: true" moves the handlers to a background thread.
+#   Loggers then only put the records into a queue, so slow output never blocks the event loop.
+#
+# Log calls on hot paths use %-style arguments instead of f-strings, so that the message is not
+# formatted at all when the level is disabled.
+
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.config
+import logging.handlers
+import queue
+
+import yaml
+
+# Attributes that every log record has, anything else was given with the extra parameter.
+_STANDARD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime"}
+
+listeners: list[logging.handlers.QueueListener] = []
+
+_exception_formatter = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for k, v in record.__dict__.items():
+            if k not in _STANDARD_ATTRIBUTES:
+                entry[k] = v
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Unlike the base class, keep the exception separate from the message so that
+        # the formatters of the actual handlers can place it.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure(path: str) -> None:
+    """Configure logging from a file.
+
+    :param path: Path to the logging configuration file.
+    """
+    with open(path) as f:
+        config = yaml.safe_load(f)
+
+    use_queue = config.pop("queue", False)
+    logging.config.dictConfig(config)
+
+    if use_queue:
+        route_through_queue([logging.getLogger()] + [logging.getLogger(name) for name in config.get("loggers", {})])
+
+
+def route_through_queue(loggers: list[logging.Logger]) -> None:
+    """Replace the handlers of the loggers with a queue that is processed in a background thread."""
+    for logger in loggers:
+        if not logger.handlers:
+            continue
+        q = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(q, *logger.handlers, respect_handler_level=True)
+        logger.handlers = [QueueHandler(q)]
+        listener.start()
+        listeners.append(listener)
+
+
+@atexit.register
+def stop() -> None:
+    """Write out the queued records."""
+    while listeners:
+        listeners.pop().stop()
@@ -0,0 +1,90 @@
+# Event loop lag monitoring.
+#
+# The probe sleeps for a fixed interval and measures how late it wakes up. The delay is the time
+# callbacks spend waiting for the event loop, and it is exported as a histogram.
+#
+# A watchdog thread checks that the probe keeps waking up. If the event loop has been blocked
+# longer than the threshold, it logs the task and the stack of the code that is blocking it.
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+import config
+import prometheus
+import task
+
+logger = logging.getLogger("app.looplag")
+
+histogram = prometheus.Histogram([0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10])
+blocked_total = 0
+
+
+class LoopLagProbe(object):
+    # Configured from the runtime section.
+    Settings = config.Runtime
+
+    def configure(self, instance_name, settings):
+        self.instance_name = instance_name
+        self.interval = settings.loop_lag_interval
+        self.threshold = settings.slow_callback_threshold
+        self.last_wakeup = time.monotonic()
+
+    async def start(self):
+        logger.info(f"Starting event loop lag probe interval_sec={self.interval} threshold_sec={self.threshold}")
+
+        loop = asyncio.get_running_loop()
+        self.last_wakeup = time.monotonic()
+        stopped = threading.Event()
+        watchdog = threading.Thread(
+            target=self.watch, args=(loop, threading.get_ident(), stopped), name="loop-watchdog", daemon=True
+        )
+        watchdog.start()
+
+        try:
+            while True:
+                before = loop.time()
+                await asyncio.sleep(self.interval)
+                histogram.observe(max(0.0, loop.time() - before - self.interval))
+                self.last_wakeup = time.monotonic()
+        finally:
+            # The probe does not wake up anymore, stop the watchdog before it reports the loop as blocked.
+            stopped.set()
+            watchdog.join()
+
+    def watch(self, loop: asyncio.AbstractEventLoop, loop_thread_id: int, stopped: threading.Event):
+        global blocked_total
+        reported = 0.0
+        while not stopped.wait(self.threshold / 2):
+            last_wakeup = self.last_wakeup
+            blocked_for = time.monotonic() - last_wakeup - self.interval
+            if blocked_for < self.threshold or reported == last_wakeup:
+                continue
+
+            # Report each stall only once.
+            reported = last_wakeup
+            blocked_total += 1
+
+            current = asyncio.current_task(loop)
+            frame = sys._current_frames().get(loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            logger.warning(
+                "Event loop blocked for %.3f seconds by task %s:\n%s",
+                blocked_for,
+                current.get_name() if current else None,
+                stack,
+                extra={"task": current.get_name() if current else None},
+            )
+
+
+def collect(metrics: prometheus.Metrics) -> None:
+    metrics.histogram("event_loop_lag_seconds", "Delay in running callbacks on the event loop", histogram)
+    metrics.counter("event_loop_blocked_total", "Times the event loop was blocked longer than threshold").add(
+        blocked_total
+    )
+
+
+task.register(LoopLagProbe, "loop-lag", internal=True)
@@ -2,16 +2,32 @@
 
 import argparse
 import asyncio
-import logging.config
+import logging
+import signal
 import sys
 
+import circuitbreaker
+import config
+import counters
+import httpclient
+import liveness
+import logsetup
+import looplag
+import offload
+import selfmetrics
+import shard
+import sink
+import supervisor
 import task
-import yaml
+import tscache
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Configure logger.
-with open("logging.yaml") as f:
-    config = yaml.safe_load(f)
-    logging.config.dictConfig(config)
+logsetup.configure("logging.yaml")
 
 logger = logging.getLogger("app.main")
 
@@ -30,57 +46,128 @@ class Application(object):
             logger.error("No config file specified")
             exit(1)
 
-        # Load configuration file.
+        # Load and check the configuration file before starting anything.
         logger.info(f"Loading configuration file: {args.config}")
-        config = yaml.safe_load(open(args.config))
+        try:
+            conf = config.load(args.config)
+            self.configure(conf)
+        except config.ConfigException as e:
+            logger.error(f"Invalid configuration: {e}")
+            exit(1)
+
+    def configure(self, conf: config.Config):
+        # Settings for the application itself.
+        runtime = conf.runtime
+        self.runtime = runtime
 
         # Instantiate task classes that are requested in the configuration file.
-        self.tasks = []
-        for s in config["sensors"]:
-            # Combine global config with task-specific config.
-            task_config = s["config"]
-            if "global" in config:
-                task_config.update(config["global"])
+        self.supervisor = supervisor.Supervisor()
+        if runtime.workers > 0:
+            # Create the sensors here, so that errors are reported before the workers are started.
+            # The instances are discarded, the workers create their own. Keep the circuit breakers
+            # that they registered out of the metrics of this process.
+            breakers = dict(circuitbreaker.breakers)
+            for s in conf.sensors:
+                task.create(s, conf.global_config)
+            circuitbreaker.breakers.clear()
+            circuitbreaker.breakers.update(breakers)
+
+            # Run the sensors in worker processes, this process writes their metrics to the database.
+            for i, sensors in enumerate(shard.assign(conf.sensors, runtime.workers)):
+                instance = shard.Worker()
+                instance.configure(
+                    str(i), shard.Worker.Settings(sensors=sensors, global_config=conf.global_config, runtime=runtime)
+                )
+                self.supervisor.add(instance)
+            selfmetrics.register(shard.collect)
+        else:
+            for s in conf.sensors:
+                self.supervisor.add(task.create(s, conf.global_config))
+        offload.configure(runtime)
+        sink.configure(runtime)
+
+        # Detect resets of counters read from meters, before the metrics are cached or written.
+        counters.configure(runtime)
+        selfmetrics.register(counters.collect)
+
+        # Monitor the event loop for lag and for callbacks that block it.
+        if runtime.loop_lag_interval > 0:
+            instance = looplag.LoopLagProbe()
+            instance.configure("", runtime)
+            selfmetrics.register(looplag.collect)
+            self.supervisor.add(instance)
+
+        # Serve recent metrics from memory.
+        if runtime.cache_listen_port is not None:
+            instance = tscache.CacheServer()
+            instance.configure("", runtime)
+            self.supervisor.add(instance)
+
+        # Push metrics about the application itself to the same database as the sensor data.
+        if "database_url" in conf.global_config:
+            database_url = conf.global_config["database_url"]
+
+            # Track which sensors are still sending data.
+            instance = liveness.LivenessTracker()
+            instance.configure(
+                "",
+                liveness.LivenessTracker.Settings(
+                    database_url=database_url,
+                    timeout=runtime.liveness_timeout,
+                    timeouts=runtime.liveness_timeouts,
+                    tick=runtime.liveness_tick,
+                ),
+            )
+            selfmetrics.register(instance.collect)
+            self.supervisor.add(instance)
+
+            instance = selfmetrics.SelfMetrics()
+            instance.configure(
+                "", selfmetrics.SelfMetrics.Settings(database_url=database_url, poll_period=runtime.self_metrics_period)
+            )
+            selfmetrics.register(self.supervisor.collect)
+            self.supervisor.add(instance)
 
-            # Instantiate task class and configure it.
-            cls = task.get_task_class(s["type"])
-            instance = cls()
-            instance.configure(s.get("name", ""), task_config)
+    async def start(self):
+        # Run until SIGTERM (for example container stop) or SIGINT (Ctrl-C).
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stopping.set)
 
-            self.tasks.append(instance)
+        # Queue the metrics that were not written at previous shutdown.
+        if self.runtime.spool_file:
+            sink.restore(self.runtime.spool_file)
 
-    async def start(self):
         # Start all tasks.
-        for s in self.tasks:
-            # Closure to wrap task in try/except block and retry on failure.
-            async def task_wrapper(s):
-                logger.info(f"Starting task: {s}")
-                delay = 10
-                last_exception_time = asyncio.get_event_loop().time()
-                while True:
-                    try:
-                        await s.start()
-                    except Exception as e:
-                        # Reset retry delay to 10 seconds if no exceptions in the last 60 minutes.
-                        current_time = asyncio.get_event_loop().time()
-                        if current_time - last_exception_time > 60 * 60:
-                            delay = 10
-                        last_exception_time = current_time
-                        logger.exception(f"Error in task {s}, retry will be in {delay} seconds:", exc_info=e)
-                        await asyncio.sleep(delay)
-                        logger.info(f"Retrying task {s} after {delay} seconds")
-                        delay *= 2  # Exponential backoff.
-                        delay = min(delay, 60 * 60)  # Limit to 60 minutes.
-
-            asyncio.create_task(task_wrapper(s))
-
-        # Do not exit, keep running until killed.
-        await asyncio.Event().wait()
-
-
-async def main(args):
-    await Application(args).start()
+        self.supervisor.start()
+
+        await stopping.wait()
+        await self.stop()
+
+    async def stop(self):
+        timeout = self.runtime.shutdown_timeout.total_seconds()
+        logger.info(f"Shutting down, timeout_sec={timeout:.0f}")
+        deadline = asyncio.get_running_loop().time() + timeout
+
+        # Stop polling and handle the data already received, then write the queued metrics.
+        await self.supervisor.stop(timeout / 2)
+        remaining = max(0.0, deadline - asyncio.get_running_loop().time())
+        written, spooled, dropped = await sink.drain(remaining, self.runtime.spool_file)
+        await httpclient.close()
+
+        logger.info(f"Shutdown complete: drained_batches={written} spooled_batches={spooled} dropped_batches={dropped}")
+
+    def run(self):
+        if self.runtime.event_loop == "uvloop":
+            if uvloop is None:
+                logger.error("uvloop is not installed, using the default event loop")
+            else:
+                logger.info("Using uvloop event loop")
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+        asyncio.run(self.start())
 
 
 if __name__ == "__main__":
-    asyncio.run(main(sys.argv[1:]))
+    Application(sys.argv[1:]).run()
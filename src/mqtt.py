@@ -0,0 +1,38 @@
+# Helpers for MQTT tasks.
+
+import asyncio
+import contextlib
+from typing import AsyncIterator
+
+import aiomqtt
+
+
+async def receive(client: aiomqtt.Client, stopping: asyncio.Event) -> AsyncIterator[aiomqtt.Message]:
+    """Iterate the messages of the client until stopping is set.
+
+    Messages that were already received when stopping is set are still returned, so that they are
+    not lost at shutdown.
+
+    :param client: Connected client.
+    :param stopping: Event that is set when the task should stop.
+    """
+    messages = client.messages
+    stopped = asyncio.ensure_future(stopping.wait())
+    try:
+        while True:
+            if len(messages) > 0:
+                yield await anext(messages)
+                continue
+            if stopping.is_set():
+                return
+
+            received = asyncio.ensure_future(anext(messages))
+            await asyncio.wait((received, stopped), return_when=asyncio.FIRST_COMPLETED)
+            if received.done():
+                yield received.result()
+            else:
+                received.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await received
+    finally:
+        stopped.cancel()
@@ -0,0 +1,87 @@
+# Offloading of CPU heavy work from the event loop.
+#
+# Decoding large JSON responses, formatting large batches of metrics and compressing the
+# payloads can take long enough to delay other tasks, such as receiving MQTT messages.
+# Work on inputs larger than the threshold is run in a thread or process pool, while
+# small inputs are handled inline where the overhead of the pool would dominate.
+#
+# Thread pool keeps the event loop responsive since the interpreter switches between threads
+# periodically, and compression runs in parallel since zlib releases the GIL.
+# Process pool also runs the parsing in parallel, at the cost of copying the data between processes.
+
+import asyncio
+import concurrent.futures
+import gzip
+import json
+import logging
+import multiprocessing
+from typing import Any, Callable
+
+import config
+import prometheus
+
+logger = logging.getLogger("app.offload")
+
+# Inputs smaller than this (bytes) are processed inline.
+threshold = 64 * 1024
+
+# Estimated size of one formatted sample (bytes), used for deciding whether to offload formatting.
+BYTES_PER_SAMPLE = 64
+
+pool: concurrent.futures.Executor | None = None
+
+
+def configure(runtime: config.Runtime) -> None:
+    """Create the worker pool.
+
+    :param runtime: Runtime settings: offload_pool, offload_workers and offload_threshold.
+    """
+    global pool, threshold
+    threshold = runtime.offload_threshold
+    kind = runtime.offload_pool
+    workers = runtime.offload_workers
+
+    if kind == "thread":
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="offload")
+    elif kind == "process":
+        # Spawn instead of fork, since forking a process that runs threads is not safe.
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    else:
+        pool = None
+
+    logger.info(f"Offloading work pool={kind} workers={workers} threshold_bytes={threshold}")
+
+
+async def run(func: Callable, *args, size: int) -> Any:
+    """Run a function inline or in the worker pool, depending on the size of the input.
+
+    :param func: The function to run. Must be picklable when using process pool.
+    :param size: Size of the input in bytes.
+    :return: The return value of the function.
+    """
+    if pool is None or size < threshold:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+
+
+async def json_loads(data: bytes) -> Any:
+    return await run(json.loads, data, size=len(data))
+
+
+def _format(metrics: prometheus.Metrics) -> str:
+    return metrics.format()
+
+
+async def format_metrics(metrics: prometheus.Metrics) -> str:
+    return await run(_format, metrics, size=metrics.num_samples() * BYTES_PER_SAMPLE)
+
+
+def _gzip_compress(data: bytes) -> bytes:
+    # Default level 9 is several times slower than 6, for little gain with metrics text.
+    return gzip.compress(data, compresslevel=6)
+
+
+async def gzip_compress(data: bytes) -> bytes:
+    return await run(_gzip_compress, data, size=len(data))
@@ -0,0 +1,232 @@
+# Generic HTTP poller.
+#
+# The poller fetches a JSON document from a device periodically and turns it into metrics
+# according to a declarative spec (see extract.py). Device types are defined as subclasses
+# with a built-in spec, and new devices can be added in the configuration file by giving
+# the spec for the generic "http-poller" task type.
+#
+# One poller can also poll a fleet of devices of the same type, given as a list of devices
+# in the configuration. The devices are polled concurrently and the metrics of all devices
+# are written to the database in one batch per poll period.
+#
+# The poll interval can adapt to the data. The spec then has an "adaptive" section:
+#
+#   adaptive:
+#     signal: {sum: emeters[*].power}   # value watched for changes, sample spec without labels
+#     change: 500                       # change between polls that counts as volatile
+#     when: {path: car, equals: 2}      # poll fast while the condition holds, for example while charging
+#
+# While the signal is volatile or the condition holds, the device is polled every poll-min.
+# Otherwise the interval is doubled after each poll, up to poll-max (by default poll-period).
+# In a fleet, the interval follows the most active device.
+
+import asyncio
+import datetime
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import circuitbreaker
+import config
+import extract
+import httpclient
+import offload
+import prometheus
+import sink
+import task
+import utils
+
+logger = logging.getLogger("app.poller")
+
+
+@dataclass(frozen=True, kw_only=True)
+class DeviceSettings:
+    name: str = ""
+    url: str
+
+
+@dataclass
+class Device:
+    name: str
+    url: str
+    breaker: circuitbreaker.CircuitBreaker
+    extract: Callable[[Any, prometheus.Metrics], None]
+
+
+class Activity(object):
+    def __init__(self, spec: dict):
+        """
+        :param spec: The adaptive section of the spec.
+        """
+        if "signal" not in spec and "when" not in spec:
+            raise ValueError(f"Adaptive polling must have 'signal' or 'when': {spec!r}")
+        self.signal = extract.compile_value(spec["signal"]) if "signal" in spec else None
+        self.change = float(spec.get("change", 0))
+        self.condition = extract.compile_condition(spec["when"]) if "when" in spec else None
+
+        # Previous value of the signal per device.
+        self.previous: dict[str, float] = {}
+
+    def update(self, name: str, doc: Any) -> bool:
+        """Return True if the device is active and should be polled fast."""
+        active = False
+        if self.condition is not None:
+            active = self.condition(doc)
+        if self.signal is not None:
+            value = self.signal(doc)
+            previous = self.previous.get(name)
+            if previous is not None and abs(value - previous) > self.change:
+                active = True
+            self.previous[name] = value
+        return active
+
+
+class HttpPoller(object):
+    # Subclasses override these to describe a device type.
+    description = "HTTP poller"
+    default_poll_period = "1m"
+    # Shortest interval for adaptive polling, if the spec has adaptive section.
+    default_poll_min: str | None = None
+    # Name of the device when the task and the device do not have a name.
+    default_name = ""
+    spec: dict = {}
+
+    @dataclass(frozen=True, kw_only=True)
+    class Settings:
+        database_url: str = config.setting(key="database_url")
+        poll_period: datetime.timedelta | None = None
+        # Bounds of the interval for adaptive polling.
+        poll_min: datetime.timedelta | None = None
+        poll_max: datetime.timedelta | None = None
+        spec: dict | None = None
+        # Either a single device or a fleet of devices.
+        url: str | None = None
+        devices: list[DeviceSettings] | None = None
+        # Maximum number of devices polled at the same time.
+        concurrency: int = config.setting(10, minimum=1)
+
+    def configure(self, instance_name, settings):
+        self.instance_name = instance_name
+        if settings.poll_period is None:
+            self.poll_period = utils.parse_timedelta(self.default_poll_period)
+        else:
+            self.poll_period = settings.poll_period
+        self.sink = sink.get(settings.database_url)
+
+        spec = self.spec if settings.spec is None else settings.spec
+        self.activity = Activity(spec["adaptive"]) if "adaptive" in spec else None
+        self.poll_max = self.poll_period if settings.poll_max is None else settings.poll_max
+        if settings.poll_min is not None:
+            if settings.poll_min > self.poll_max:
+                raise task.TaskException(f"poll-min {settings.poll_min} is longer than poll-max {self.poll_max}")
+            self.poll_min = settings.poll_min
+        elif self.default_poll_min:
+            self.poll_min = min(utils.parse_timedelta(self.default_poll_min), self.poll_max)
+        else:
+            self.poll_min = self.poll_max
+        self.interval = self.poll_min if self.activity else self.poll_period
+
+        request = spec.get("request", {})
+        self.method = request.get("method", "GET")
+        self.request_body = request.get("json")
+
+        devices = settings.devices
+        if devices is None:
+            if not settings.url:
+                raise task.TaskException("missing url or devices")
+            devices = [DeviceSettings(name=instance_name, url=settings.url)]
+
+        self.devices = [
+            Device(
+                name=d.name,
+                url=d.url,
+                breaker=circuitbreaker.for_url(d.url),
+                extract=extract.compile_metrics(spec, {"instance_name": d.name or self.default_name}),
+            )
+            for d in devices
+        ]
+        self.concurrency = settings.concurrency
+
+    async def start(self):
+        urls = ",".join(d.url for d in self.devices)
+        if self.activity:
+            period = f"poll_min_sec={self.poll_min} poll_max_sec={self.poll_max}"
+        else:
+            period = f"poll_period_sec={self.poll_period}"
+        logger.info(f"Starting {self.description} instance_name={self.instance_name} url={urls} {period}")
+
+        while True:
+            await self.update_metrics()
+
+            logger.debug("Sleeping for %s", self.interval, extra={"task": self.instance_name})
+            await asyncio.sleep(self.interval.total_seconds())
+
+    async def update_metrics(self):
+        metrics = prometheus.Metrics()
+        active = False
+
+        if len(self.devices) == 1:
+            # Single device, let the supervisor handle failures of the endpoint.
+            d = self.devices[0]
+            active = self.process(d, await self.poll(d), metrics)
+        else:
+            # Fleet of devices, skip the ones that fail and store the rest.
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def poll_bounded(d):
+                async with semaphore:
+                    return await self.poll(d)
+
+            results = await asyncio.gather(*(poll_bounded(d) for d in self.devices), return_exceptions=True)
+
+            failures = []
+            for d, res in zip(self.devices, results):
+                if isinstance(res, circuitbreaker.EndpointException):
+                    logger.warning(f"Failed to poll device name={d.name} url={d.url}: {res}")
+                    failures.append(res)
+                elif isinstance(res, BaseException):
+                    raise res
+                else:
+                    active = self.process(d, res, metrics) or active
+
+            if len(failures) == len(self.devices):
+                raise failures[0]
+
+        if self.activity:
+            self.interval = self.poll_min if active else min(self.interval * 2, self.poll_max)
+
+        await self.sink.write(metrics)
+
+    def process(self, d: Device, doc: Any, metrics: prometheus.Metrics) -> bool:
+        """Add the metrics from the response of the device.
+
+        Response that does not match the spec is logged and skipped, it is not a failure of the endpoint
+        and restarting the task would not help.
+
+        :return: True if the device is active and should be polled fast.
+        """
+        try:
+            d.extract(doc, metrics)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            logger.warning(f"Unexpected response from device name={d.name} url={d.url}: {e!r}")
+            return False
+        return self.is_active(d, doc)
+
+    def is_active(self, d: Device, doc: Any) -> bool:
+        if self.activity is None:
+            return False
+        try:
+            return self.activity.update(d.name, doc)
+        except (KeyError, IndexError, TypeError):
+            # Signal missing from the response, treat the device as stable.
+            return False
+
+    async def poll(self, d: Device):
+        logger.debug("Fetching data: url=%s", d.url, extra={"sensor": d.name})
+        return await d.breaker.call(lambda: self.fetch(d.url))
+
+    async def fetch(self, url: str):
+        response = await httpclient.get().request(self.method, url, json=self.request_body)
+        if response.status_code != 200:
+            raise task.TaskException(f"failed to fetch data: {response.status_code}")
+        return await offload.json_loads(response.content)
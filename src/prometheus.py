@@ -6,8 +6,10 @@
 #   This is required for energy meter counters that are directly read from the meter.
 # - Allows setting the optional timestamp parameter for each metric, which is needed when polling
 #   the car data and electricity prices, which may contain data that was already scraped last time.
+# - Histogram keeps its state in a separate object that lives across pushes, since a new Metrics
+#   object is created for each push.
 
-
+import bisect
 from typing import Dict, List, Optional
 
 
@@ -42,43 +44,90 @@ class Samples(object):
             output.append(s)
         return output
 
+    def format_lines(self, name: str) -> List[str]:
+        return [f"{name} {s}" for s in self.format()]
+
+
+class Histogram(object):
+    def __init__(self, buckets: List[float]):
+        self.buckets = sorted(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            self.bucket_counts[i] += 1
+
+
+class HistogramSamples(Samples):
+    def __init__(self, labels, histogram: Histogram):
+        super().__init__(labels)
+        self.histogram = histogram
+
+    def format_lines(self, name: str) -> List[str]:
+        output = []
+        labels_str = ",".join([f'{k}="{v}"' for k, v in self.common_labels_for_all_samples.items()])
+        prefix = f"{labels_str}," if labels_str else ""
+
+        cumulative = 0
+        for bound, count in zip(self.histogram.buckets, self.histogram.bucket_counts):
+            cumulative += count
+            output.append(f'{name}_bucket {{{prefix}le="{bound}"}} {cumulative}')
+        output.append(f'{name}_bucket {{{prefix}le="+Inf"}} {self.histogram.count}')
+
+        labels_part = f"{{{labels_str}}} " if labels_str else ""
+        output.append(f"{name}_sum {labels_part}{self.histogram.sum}")
+        output.append(f"{name}_count {labels_part}{self.histogram.count}")
+        return output
+
 
 class Metrics(object):
     def __init__(self):
-        self.samples = []
+        # Metric families by name. Samples of the same metric are grouped under one family,
+        # so that metrics from several devices can be combined into one payload.
+        self.families: Dict[str, dict] = {}
 
     def num_samples(self) -> int:
-        return len(self.samples)
+        return sum(len(s.samples) for family in self.families.values() for s in family["samples"])
 
     def counter(self, name: str, description: str = "", labels: Optional[Dict[str, str]] = None) -> Samples:
-        s = Samples(labels)
-        self.samples.append(
-            {
-                "type": "counter",
-                "name": name,
-                "description": description,
-                "samples": s,
-            }
-        )
-        return s
+        return self.family("counter", name, description, labels)
 
     def gauge(self, name: str, description: str = "", labels: Optional[Dict[str, str]] = None) -> Samples:
-        s = Samples(labels)
-        self.samples.append(
-            {
-                "type": "gauge",
+        return self.family("gauge", name, description, labels)
+
+    def histogram(
+        self, name: str, description: str, histogram: Histogram, labels: Optional[Dict[str, str]] = None
+    ) -> Samples:
+        s = HistogramSamples(labels, histogram)
+        self.family("histogram", name, description, labels, s)
+        return s
+
+    def family(
+        self, type: str, name: str, description: str, labels: Optional[Dict[str, str]], s: Optional[Samples] = None
+    ) -> Samples:
+        if name not in self.families:
+            self.families[name] = {
+                "type": type,
                 "name": name,
                 "description": description,
-                "samples": s,
+                "samples": [],
             }
-        )
+        if s is None:
+            s = Samples(labels)
+        self.families[name]["samples"].append(s)
         return s
 
     def format(self) -> str:
         output = ""
-        for sample in self.samples:
-            output += f"# HELP {sample['name']} {sample['description']}\n"
-            output += f"# TYPE {sample['name']} {sample['type']}\n"
-            for s in sample["samples"].format():
-                output += f"{sample['name']} {s}\n"
+        for family in self.families.values():
+            output += f"# HELP {family['name']} {family['description']}\n"
+            output += f"# TYPE {family['name']} {family['type']}\n"
+            for samples in family["samples"]:
+                for line in samples.format_lines(family["name"]):
+                    output += f"{line}\n"
         return output
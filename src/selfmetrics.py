@@ -0,0 +1,62 @@
+# Metrics about the application itself, such as circuit breaker states and sink queue lengths.
+# They are pushed periodically to the same database as the sensor data.
+
+import asyncio
+import datetime
+import logging
+from dataclasses import dataclass
+from typing import Callable
+
+import circuitbreaker
+import config
+import prometheus
+import sink
+import task
+
+logger = logging.getLogger("app.selfmetrics")
+
+# Functions that add their metrics to the given Metrics object.
+collectors: list[Callable[[prometheus.Metrics], None]] = [
+    circuitbreaker.collect,
+    sink.collect,
+]
+
+
+# Labels added to all self-metrics, for example to tell worker processes apart.
+common_labels: dict[str, str] = {}
+
+
+def register(collector: Callable[[prometheus.Metrics], None]) -> None:
+    collectors.append(collector)
+
+
+def collect() -> prometheus.Metrics:
+    metrics = prometheus.Metrics()
+    for c in collectors:
+        c(metrics)
+    for family in metrics.families.values():
+        for samples in family["samples"]:
+            samples.common_labels_for_all_samples.update(common_labels)
+    return metrics
+
+
+class SelfMetrics(object):
+    @dataclass(frozen=True, kw_only=True)
+    class Settings:
+        database_url: str = config.setting(key="database_url")
+        poll_period: datetime.timedelta = datetime.timedelta(minutes=1)
+
+    def configure(self, instance_name, settings):
+        self.instance_name = instance_name
+        self.poll_period = settings.poll_period
+        self.sink = sink.get(settings.database_url)
+
+    async def start(self):
+        logger.info(f"Starting self-metrics instance_name={self.instance_name} poll_period_sec={self.poll_period}")
+
+        while True:
+            await asyncio.sleep(self.poll_period.total_seconds())
+            await self.sink.write(collect())
+
+
+task.register(SelfMetrics, "self-metrics", internal=True)
@@ -0,0 +1,255 @@
+# Sharding of sensors across worker processes.
+#
+# One process runs on one core. With runtime setting "workers: N", the sensors are run in N worker
+# processes instead, and the main process only writes their metrics to the database:
+#
+# - Each sensor is assigned to a worker by a stable hash of its type and name, so that the sensor
+#   stays in the same worker when the configuration changes.
+# - MQTT tasks that handle each message independently (zigbee, zwave) run in every worker with
+#   a shared subscription ($share/<group>/<topic>), so that the broker splits the messages between
+#   the workers. Note that the broker does not send retained messages to shared subscriptions.
+# - Workers send the metrics over a pipe to the main process, where they go through the sink as usual.
+#   Counter reset detection, liveness tracking and the cache therefore see the metrics of all workers.
+#
+# Workers are supervised as tasks of the main process and restarted after a short delay if they exit.
+# The load of the workers is exported in the self-metrics with label "worker". At shutdown, the workers
+# are sent SIGTERM and they stop their tasks and send the remaining metrics before exiting.
+
+import asyncio
+import contextlib
+import dataclasses
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from multiprocessing.connection import Connection
+
+import config
+import looplag
+import offload
+import prometheus
+import selfmetrics
+import sink
+import supervisor
+import task
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+logger = logging.getLogger("app.shard")
+
+# Group name for MQTT shared subscriptions.
+SHARE_GROUP = "homemetrics"
+
+# Seconds to wait before starting a worker process that exited.
+RESTART_DELAY = 5
+
+# Exit code of a worker process whose sensors cannot be configured, it is not restarted (EX_CONFIG).
+CONFIG_ERROR_EXIT = 78
+
+# Batches received from each worker, and times each worker has been restarted.
+received: dict[str, int] = {}
+restarts: dict[str, int] = {}
+
+
+def assign(sensors: list[config.Sensor], workers: int) -> list[list[config.Sensor]]:
+    """Assign sensors to workers.
+
+    :param sensors: The sensors section of the configuration file.
+    :param workers: Number of workers.
+    :return: Sensors for each worker.
+    """
+    assigned: list[list[config.Sensor]] = [[] for _ in range(workers)]
+    seen: dict[str, int] = {}
+    for s in sensors:
+        cls = task.get_task_class(s.type)
+        if getattr(cls, "shared_subscription", False) and "topic" in s.config:
+            shared = dataclasses.replace(s, config={**s.config, "topic": f"$share/{SHARE_GROUP}/{s.config['topic']}"})
+            for w in assigned:
+                w.append(shared)
+            continue
+
+        # Sensors of the same type without name are told apart by their order.
+        key = f"{s.type}:{s.name}"
+        seen[key] = seen.get(key, 0) + 1
+        if seen[key] > 1:
+            key = f"{key}:{seen[key]}"
+        assigned[zlib.crc32(key.encode()) % workers].append(s)
+    return assigned
+
+
+class Worker(object):
+    @dataclass(frozen=True, kw_only=True)
+    class Settings:
+        sensors: list[config.Sensor]
+        global_config: dict = config.setting({}, key="global")
+        runtime: config.Runtime = dataclasses.field(default_factory=config.Runtime)
+
+    def configure(self, instance_name, settings):
+        self.instance_name = instance_name
+        self.sensors = settings.sensors
+        self.global_config = settings.global_config
+        self.runtime = settings.runtime
+        self.process: multiprocessing.Process | None = None
+        self.stopping = asyncio.Event()
+        received[instance_name] = 0
+        restarts[instance_name] = 0
+
+    def stop(self):
+        """Ask the worker process to stop, start returns when it has sent its remaining metrics."""
+        self.stopping.set()
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+
+    async def start(self):
+        logger.info(f"Starting worker {self.instance_name} sensors={len(self.sensors)}")
+
+        # The worker is restarted here instead of by the supervisor, since a crashed process is not
+        # a failing endpoint that needs increasing backoff.
+        while True:
+            exitcode = await self.run()
+            if self.stopping.is_set():
+                break
+            if exitcode == CONFIG_ERROR_EXIT:
+                # Restarting would fail the same way, wait for shutdown instead.
+                logger.error(f"Worker {self.instance_name} exited: invalid configuration, not restarting")
+                await self.stopping.wait()
+                break
+            restarts[self.instance_name] += 1
+            logger.warning(
+                f"Worker {self.instance_name} exited: code={exitcode}, restarting in {RESTART_DELAY} seconds"
+            )
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.stopping.wait(), RESTART_DELAY)
+            if self.stopping.is_set():
+                break
+        logger.info(f"Worker {self.instance_name} stopped: batches={received[self.instance_name]}")
+
+    async def run(self) -> int | None:
+        """Run the worker process and write its metrics until it exits.
+
+        :return: Exit code of the process.
+        """
+        # Spawn instead of fork, since forking a process that runs threads is not safe.
+        ctx = multiprocessing.get_context("spawn")
+        conn, child_conn = ctx.Pipe(duplex=False)
+        self.process = process = ctx.Process(
+            target=run_worker,
+            args=(self.instance_name, self.sensors, self.global_config, self.runtime, child_conn),
+            name=f"worker-{self.instance_name}",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+
+        try:
+            while True:
+                try:
+                    url, metrics = await asyncio.to_thread(conn.recv)
+                except EOFError:
+                    await asyncio.to_thread(process.join)
+                    return process.exitcode
+                received[self.instance_name] += 1
+                await sink.get(url).write(metrics)
+        finally:
+            if process.is_alive():
+                process.kill()
+            conn.close()
+
+
+def collect(metrics: prometheus.Metrics) -> None:
+    batches = metrics.counter("worker_received_batches_total", "Batches of metrics received from the worker")
+    for name, count in received.items():
+        batches.add(count, labels={"worker": name})
+    restarted = metrics.counter("worker_restarts_total", "Times the worker process has been restarted")
+    for name, count in restarts.items():
+        restarted.add(count, labels={"worker": name})
+
+
+def collect_worker(metrics: prometheus.Metrics) -> None:
+    metrics.counter("worker_cpu_seconds_total", "CPU time used by the worker process").add(time.process_time())
+
+
+def run_worker(
+    name: str, sensors: list[config.Sensor], global_config: dict, runtime: config.Runtime, conn: Connection
+) -> None:
+    """Entry point of a worker process."""
+    # Logging is configured and task classes registered when the main module is imported in the new process.
+    logger.info(f"Worker {name} started: pid={os.getpid()}")
+
+    # Hand the metrics to a thread that sends them, so that the event loop does not block on a full pipe.
+    outgoing = queue.SimpleQueue()
+
+    def send_forever():
+        try:
+            while (item := outgoing.get()) is not None:
+                conn.send(item)
+        except OSError:
+            # Main process is gone.
+            os._exit(1)
+
+    sender = threading.Thread(target=send_forever, name="forward", daemon=True)
+    sender.start()
+    sink.forward = lambda url, metrics: outgoing.put((url, metrics))
+
+    offload.configure(runtime)
+
+    workers = supervisor.Supervisor()
+    try:
+        for s in sensors:
+            workers.add(task.create(s, global_config))
+    except config.ConfigException as e:
+        # Normally reported already by the main process before the workers are started.
+        logger.error(f"Worker {name}: invalid configuration: {e}")
+        sys.exit(CONFIG_ERROR_EXIT)
+
+    if runtime.loop_lag_interval > 0:
+        instance = looplag.LoopLagProbe()
+        instance.configure("", runtime)
+        selfmetrics.register(looplag.collect)
+        workers.add(instance)
+
+    # Metrics of the worker itself are sent to the main process like other metrics.
+    if "database_url" in global_config:
+        selfmetrics.common_labels["worker"] = name
+        selfmetrics.register(collect_worker)
+        selfmetrics.register(workers.collect)
+        instance = selfmetrics.SelfMetrics()
+        instance.configure(
+            "",
+            selfmetrics.SelfMetrics.Settings(
+                database_url=global_config["database_url"], poll_period=runtime.self_metrics_period
+            ),
+        )
+        workers.add(instance)
+
+    async def main():
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stopping.set)
+
+        workers.start()
+        await stopping.wait()
+        # The main process waits for the workers half of the timeout, leave time for sending the metrics.
+        await workers.stop(runtime.shutdown_timeout.total_seconds() / 4)
+
+    if runtime.event_loop == "uvloop" and uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(main())
+
+    # Send the remaining metrics, the main process gets end of file when the pipe is closed at exit.
+    outgoing.put(None)
+    sender.join()
+    logger.info(f"Worker {name} exiting")
+
+
+task.register(Worker, "worker", internal=True)
@@ -0,0 +1,251 @@
+# Shared writer for pushing metrics to the time series database.
+#
+# Tasks hand their metrics to the sink and return immediately. The sink queues the batches and
+# a background flusher posts them to the database, coalescing queued batches into one request.
+# A failing database therefore never stalls device polling or tears down MQTT subscriptions:
+# batches stay queued while the circuit breaker of the database endpoint is open, and the
+# oldest batches are dropped if the queue grows beyond its limit. Batches that the database rejects
+# as invalid (4xx) are logged and dropped, since retrying them would block the batches behind them.
+#
+# At shutdown, the queued batches are written within a deadline. Batches that could not be written
+# are saved to a spool file if one is configured, and queued again at the next startup. Note that
+# samples without timestamp get the time when they are finally written to the database.
+
+import asyncio
+import collections
+import json
+import logging
+import os
+from typing import Callable
+
+import circuitbreaker
+import config
+import httpclient
+import httpx
+import offload
+import prometheus
+
+logger = logging.getLogger("app.sink")
+
+# Compress request bodies with gzip.
+compression = False
+
+# Functions that are given all metrics before they are queued, for example to keep a local copy.
+processors: list[Callable[[prometheus.Metrics], None]] = []
+
+# In worker processes, hands the metrics over to the main process instead of writing them.
+forward: Callable[[str, prometheus.Metrics], None] | None = None
+
+
+def configure(runtime: config.Runtime) -> None:
+    """Configure all sinks.
+
+    :param runtime: Runtime settings: sink_compression.
+    """
+    global compression
+    compression = runtime.sink_compression == "gzip"
+
+
+def register(processor: Callable[[prometheus.Metrics], None]) -> None:
+    processors.append(processor)
+
+
+class Sink(object):
+    def __init__(self, url: str, max_pending: int = 1000, max_batches_per_request: int = 100):
+        self.url = url
+        self.max_pending = max_pending
+        self.max_batches_per_request = max_batches_per_request
+        self.breaker = circuitbreaker.for_url(url)
+        self.pending: collections.deque[str] = collections.deque()
+        self.has_pending = asyncio.Event()
+        # Set when all queued batches have been written.
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.flusher: asyncio.Task | None = None
+
+        # Number of batches to write one by one, to find the rejected batch in a coalesced request.
+        self.write_singly = 0
+
+        # Statistics exported as metrics.
+        self.written_total = 0
+        self.dropped_total = 0
+        self.rejected_total = 0
+
+    async def write(self, metrics: prometheus.Metrics) -> None:
+        """Queue metrics to be written to the database.
+
+        :param metrics: The metrics to write.
+        """
+        if metrics.num_samples() == 0:
+            return
+
+        if forward is not None:
+            forward(self.url, metrics)
+            return
+
+        for p in processors:
+            try:
+                p(metrics)
+            except Exception as e:
+                # Failing processor must not fail the task that writes the metrics.
+                logger.exception(f"Metrics processor {getattr(p, '__qualname__', p)} failed:", exc_info=e)
+
+        self.enqueue(await offload.format_metrics(metrics))
+
+    def enqueue(self, body: str) -> None:
+        self.pending.append(body)
+        self.drop_overflow()
+        self.idle.clear()
+        self.has_pending.set()
+
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self.flush_forever())
+
+    def drop_overflow(self) -> None:
+        while len(self.pending) > self.max_pending:
+            self.pending.popleft()
+            self.dropped_total += 1
+            logger.warning(f"Dropped oldest batch, queue full url={self.url} max_pending={self.max_pending}")
+
+    async def flush_forever(self) -> None:
+        while True:
+            if not self.pending:
+                self.has_pending.clear()
+                self.idle.set()
+                await self.has_pending.wait()
+
+            # Coalesce queued batches into one request.
+            batches = []
+            limit = 1 if self.write_singly else self.max_batches_per_request
+            while self.pending and len(batches) < limit:
+                batches.append(self.pending.popleft())
+            self.write_singly = max(0, self.write_singly - 1)
+
+            try:
+                response = await self.breaker.call(lambda: self.post("".join(batches)))
+            except asyncio.CancelledError:
+                # Stopped during shutdown, keep the batches for spooling.
+                self.pending.extendleft(reversed(batches))
+                raise
+            except circuitbreaker.EndpointException as e:
+                logger.warning(f"Failed to store metrics, will retry: {e}")
+
+                # Put the batches back in the front of the queue and wait until the endpoint may have recovered.
+                self.pending.extendleft(reversed(batches))
+                self.drop_overflow()
+                await asyncio.sleep(max(e.retry_in, 1))
+                continue
+
+            if response.is_client_error:
+                if len(batches) > 1:
+                    # Write the batches one by one, to drop only the rejected ones.
+                    self.pending.extendleft(reversed(batches))
+                    self.write_singly = len(batches)
+                    continue
+                self.rejected_total += 1
+                logger.error(
+                    f"Database rejected batch, dropping it: url={self.url} status={response.status_code} "
+                    f"response={response.text[:200]!r} batch={batches[0][:500]!r}"
+                )
+                continue
+
+            self.written_total += len(batches)
+
+    async def close(self) -> None:
+        """Stop writing, the batches that were not written are left in the queue."""
+        if self.flusher is not None:
+            self.flusher.cancel()
+            await asyncio.gather(self.flusher, return_exceptions=True)
+            self.flusher = None
+
+    async def post(self, body: str) -> httpx.Response:
+        """Post the metrics.
+
+        :return: Response, successful or rejected by the database (4xx).
+        :raises httpx.HTTPError: If the request failed or the database failed to handle it.
+        """
+        logger.debug("Storing metrics: url=%s bytes=%d", self.url, len(body))
+        content = body.encode()
+        headers = {}
+        if compression:
+            content = await offload.gzip_compress(content)
+            headers["Content-Encoding"] = "gzip"
+        response = await httpclient.get().post(self.url, content=content, headers=headers)
+        if not response.is_client_error:
+            response.raise_for_status()
+        return response
+
+
+# Global registry of sinks, one per database URL.
+sinks: dict[str, Sink] = {}
+
+
+def get(url: str) -> Sink:
+    if url not in sinks:
+        sinks[url] = Sink(url)
+    return sinks[url]
+
+
+async def drain(timeout: float, spool: str | None = None) -> tuple[int, int, int]:
+    """Write the queued batches of all sinks before exit.
+
+    :param timeout: Seconds to wait for the batches to be written.
+    :param spool: File to save the batches that could not be written to.
+    :return: Number of batches written, spooled and dropped.
+    """
+    written_before = sum(s.written_total for s in sinks.values())
+    waiting = [asyncio.create_task(s.idle.wait()) for s in sinks.values() if not s.idle.is_set()]
+    if waiting:
+        _, not_idle = await asyncio.wait(waiting, timeout=timeout)
+        for w in not_idle:
+            w.cancel()
+    for s in sinks.values():
+        await s.close()
+
+    written = sum(s.written_total for s in sinks.values()) - written_before
+    remaining = [(s.url, body) for s in sinks.values() for body in s.pending]
+    if not remaining:
+        return written, 0, 0
+    if spool:
+        try:
+            with open(spool, "a") as f:
+                for url, body in remaining:
+                    f.write(json.dumps({"url": url, "body": body}) + "\n")
+            return written, len(remaining), 0
+        except OSError as e:
+            logger.error(f"Failed to write spool file: path={spool} error={e}")
+    return written, 0, len(remaining)
+
+
+def restore(spool: str) -> int:
+    """Queue the batches saved to the spool file at previous shutdown, and remove the file.
+
+    :return: Number of batches restored.
+    """
+    try:
+        with open(spool) as f:
+            batches = [json.loads(line) for line in f if line.strip()]
+        os.remove(spool)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to read spool file: path={spool} error={e}")
+        return 0
+
+    for b in batches:
+        get(b["url"]).enqueue(b["body"])
+    logger.info(f"Restored batches from spool file: path={spool} batches={len(batches)}")
+    return len(batches)
+
+
+def collect(metrics: prometheus.Metrics) -> None:
+    pending = metrics.gauge("sink_pending_batches", "Batches waiting to be written to the database")
+    written = metrics.counter("sink_written_batches_total", "Batches written to the database")
+    dropped = metrics.counter("sink_dropped_batches_total", "Batches dropped because the queue was full")
+    rejected = metrics.counter("sink_rejected_batches_total", "Batches dropped because the database rejected them")
+    for s in sinks.values():
+        labels = {"endpoint": s.breaker.endpoint}
+        pending.add(len(s.pending), labels=labels)
+        written.add(s.written_total, labels=labels)
+        dropped.add(s.dropped_total, labels=labels)
+        rejected.add(s.rejected_total, labels=labels)
@@ -0,0 +1,130 @@
+# Supervisor that keeps tasks running.
+#
+# Failures of remote endpoints (devices, cloud APIs, MQTT brokers) are tracked by per-endpoint
+# circuit breakers, and the task is restarted as soon as the breaker lets the next probe through.
+# Writing to the database never fails a task since the sink queues the metrics and retries by itself.
+# Rejected credentials are retried only after a long delay, so that the account does not get locked.
+# Any other failure is treated as a bug or misconfiguration and retried with exponential backoff.
+#
+# At shutdown, tasks that have stop() method are asked to finish and the rest are cancelled.
+
+import asyncio
+import logging
+
+import circuitbreaker
+import prometheus
+import task
+
+logger = logging.getLogger("app.supervisor")
+
+# Minimum delay before restarting a task.
+MIN_RESTART_DELAY = 5
+
+# Restart delay for unexpected failures, doubled after every failure.
+INITIAL_BACKOFF = 10
+MAX_BACKOFF = 60 * 60
+
+# Restart delay after the credentials of the task were rejected.
+AUTH_RETRY_DELAY = 6 * 60 * 60
+
+
+class Supervisor(object):
+    def __init__(self):
+        self.tasks: list[task.Task] = []
+        self.running: list[asyncio.Task] = []
+        self.stopping = False
+        # Tasks that are running start(), instead of waiting to be restarted.
+        self.started: set[asyncio.Task] = set()
+
+        # Statistics exported as metrics.
+        self.restarts: dict[str, int] = {}
+
+    def add(self, t: task.Task) -> None:
+        self.tasks.append(t)
+
+    def start(self) -> None:
+        for t in self.tasks:
+            # Name the asyncio task after the task, to identify it in diagnostics.
+            self.running.append(asyncio.create_task(self.supervise(t), name=task.name(t)))
+
+    async def stop(self, timeout: float) -> None:
+        """Stop all tasks.
+
+        :param timeout: Seconds to wait for the tasks that have stop() method to finish, before cancelling them.
+        """
+        self.stopping = True
+        finishing = []
+        for t, running in zip(self.tasks, self.running):
+            if hasattr(t, "stop") and running in self.started:
+                t.stop()
+                finishing.append(running)
+            else:
+                running.cancel()
+
+        if finishing:
+            _, not_finished = await asyncio.wait(finishing, timeout=timeout)
+            for running in not_finished:
+                logger.warning(f"Task {running.get_name()} did not stop in {timeout:.0f} seconds, cancelling")
+
+        for running in self.running:
+            running.cancel()
+        await asyncio.gather(*self.running, return_exceptions=True)
+
+    async def supervise(self, t: task.Task) -> None:
+        name = task.name(t)
+        self.restarts[name] = 0
+        logger.info(f"Starting task: {name}", extra={"task": name})
+
+        delay = INITIAL_BACKOFF
+        last_exception_time = asyncio.get_event_loop().time()
+        while True:
+            try:
+                self.started.add(asyncio.current_task())
+                try:
+                    await t.start()
+                finally:
+                    self.started.discard(asyncio.current_task())
+                if self.stopping:
+                    logger.info(f"Stopped task: {name}", extra={"task": name})
+                    return
+            except circuitbreaker.EndpointException as e:
+                if self.stopping:
+                    return
+                # Remote endpoint failed, let the circuit breaker decide when to try again.
+                retry_in = max(e.retry_in, MIN_RESTART_DELAY)
+                logger.warning(
+                    f"Endpoint failure in task {name}, retry will be in {retry_in:.0f} seconds: {e}",
+                    extra={"task": name},
+                )
+                await asyncio.sleep(retry_in)
+            except task.AuthenticationException as e:
+                if self.stopping:
+                    return
+                logger.error(
+                    f"Authentication failed in task {name}, retry will be in {AUTH_RETRY_DELAY} seconds: {e}",
+                    extra={"task": name},
+                )
+                await asyncio.sleep(AUTH_RETRY_DELAY)
+            except Exception as e:
+                if self.stopping:
+                    logger.exception(f"Error in task {name} while stopping:", exc_info=e, extra={"task": name})
+                    return
+                # Reset retry delay if no exceptions in the last 60 minutes.
+                current_time = asyncio.get_event_loop().time()
+                if current_time - last_exception_time > 60 * 60:
+                    delay = INITIAL_BACKOFF
+                last_exception_time = current_time
+                logger.exception(
+                    f"Error in task {name}, retry will be in {delay} seconds:", exc_info=e, extra={"task": name}
+                )
+                await asyncio.sleep(delay)
+                delay *= 2  # Exponential backoff.
+                delay = min(delay, MAX_BACKOFF)
+
+            self.restarts[name] += 1
+            logger.info(f"Restarting task {name}", extra={"task": name})
+
+    def collect(self, metrics: prometheus.Metrics) -> None:
+        restarts = metrics.counter("task_restarts_total", "Number of times the task was restarted after failure")
+        for name, count in self.restarts.items():
+            restarts.add(count, labels={"task": name})
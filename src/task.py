@@ -1,12 +1,19 @@
 import logging
-from typing import Protocol, Type
+from typing import Any, Protocol, Type
+
+import config
 
 logger = logging.getLogger("task")
 
 
 # Interface for task classes.
+# Settings is a frozen dataclass describing the configuration of the task, see config.py.
+# At shutdown, tasks are cancelled. Tasks that have data in flight can also define stop(), which
+# asks start() to finish the data already received and return, see Supervisor.stop().
 class Task(Protocol):
-    def configure(self, instance_name: str, config: dict) -> None:
+    Settings: Type
+
+    def configure(self, instance_name: str, settings: Any) -> None:
         ...
 
     async def start(self) -> None:
@@ -17,14 +24,68 @@ class TaskException(Exception):
     pass
 
 
+class AuthenticationException(TaskException):
+    """Credentials were rejected, retrying soon would not help and could get the account locked."""
+
+
 # Global registry of task classes.
 task_classes: dict[str, Type[Task]] = {}
 
+# Task types that the application runs itself, and that cannot be configured as sensors.
+internal_types: set[str] = set()
 
-def register(cls: Type[Task], task_type: str):
+
+def register(cls: Type[Task], task_type: str, internal: bool = False):
     logger.debug(f"Registering task class: {task_type}")
     task_classes[task_type] = cls
+    if internal:
+        internal_types.add(task_type)
 
 
 def get_task_class(task_type: str) -> Type[Task]:
     return task_classes[task_type]
+
+
+def check(sensor: config.Sensor, global_config: dict) -> Any:
+    """Convert the configuration of a sensor to the settings of its task class.
+
+    :param sensor: Entry in the sensors section of the configuration file.
+    :param global_config: The global section of the configuration file.
+    :raises config.ConfigException: If the sensor is not configured correctly.
+    """
+    if sensor.type not in task_classes or sensor.type in internal_types:
+        expected = sorted(t for t in task_classes if t not in internal_types)
+        raise config.ConfigException(f"{context(sensor)}: unknown type, expected one of {', '.join(expected)}")
+    cls = get_task_class(sensor.type)
+
+    # Global settings apply to the tasks that have them, and settings of the sensor take precedence.
+    known = config.keys(cls.Settings)
+    data = {**{k: v for k, v in global_config.items() if k in known}, **sensor.config}
+    return config.parse(cls.Settings, data, context(sensor))
+
+
+def create(sensor: config.Sensor, global_config: dict) -> Task:
+    """Instantiate and configure a task.
+
+    :param sensor: Entry in the sensors section of the configuration file.
+    :param global_config: The global section of the configuration file.
+    :raises config.ConfigException: If the sensor is not configured correctly.
+    """
+    settings = check(sensor, global_config)
+    instance = get_task_class(sensor.type)()
+    try:
+        instance.configure(sensor.name, settings)
+    except (TaskException, ValueError) as e:
+        raise config.ConfigException(f"{context(sensor)}: {e}") from e
+    return instance
+
+
+def context(sensor: config.Sensor) -> str:
+    return f"sensor {sensor.type}:{sensor.name}" if sensor.name else f"sensor {sensor.type}"
+
+
+def name(t: Task) -> str:
+    """Name of a task instance for logs and metrics, for example "shelly2:heater"."""
+    task_type = next((k for k, v in task_classes.items() if type(t) is v), type(t).__name__)
+    instance_name = getattr(t, "instance_name", "")
+    return f"{task_type}:{instance_name}" if instance_name else task_type
@@ -0,0 +1,211 @@
+# In-memory cache of recent metrics.
+#
+# Keeps the samples of the last minutes of each series that is written to the database, so that current
+# values and short ranges can be read locally without querying the database. Each series is a ring buffer
+# of fixed capacity, stored in compact arrays of int64 timestamps and float64 values.
+#
+# The cache is served over HTTP:
+# - GET /api/v1/latest?name=<metric>&<label>=<value>: latest value of the matching series.
+# - GET /api/v1/range?name=<metric>&<label>=<value>&since=5m: samples of the matching series.
+# - GET /metrics: latest values in Prometheus exposition format, for scraping (optional).
+
+import array
+import asyncio
+import logging
+import time
+
+import config
+import prometheus
+import sink
+import task
+import utils
+from aiohttp import web
+
+logger = logging.getLogger("app.tscache")
+
+
+class Series(object):
+    def __init__(self, name: str, type: str, description: str, labels: dict[str, str], capacity: int, window_msec: int):
+        self.name = name
+        self.type = type
+        self.description = description
+        self.labels = labels
+        self.capacity = capacity
+        self.window_msec = window_msec
+        self.timestamps = array.array("q", bytes(8 * capacity))
+        self.values = array.array("d", bytes(8 * capacity))
+        self.next = 0
+        self.size = 0
+        self.updated = time.monotonic()
+
+    def index(self, i: int) -> int:
+        """Return position of i:th sample in the arrays, counting from the oldest."""
+        return (self.next - self.size + i) % self.capacity
+
+    def append(self, timestamp_msec: int, value: float) -> None:
+        self.updated = time.monotonic()
+
+        # Same samples are written again when polled data has not changed (timestamp comes from the device)
+        # or when the data includes forecasts, such as electricity prices, so look for the timestamp.
+        i = self.size
+        while i > 0 and self.timestamps[self.index(i - 1)] > timestamp_msec:
+            i -= 1
+        if i > 0 and self.timestamps[self.index(i - 1)] == timestamp_msec:
+            self.values[self.index(i - 1)] = value
+            return
+
+        if self.size == self.capacity:
+            if i == 0:
+                return  # Older than any sample that is kept.
+            self.size -= 1
+            i -= 1
+
+        # Move newer samples to make room, normally none.
+        for j in range(self.size, i, -1):
+            self.timestamps[self.index(j)] = self.timestamps[self.index(j - 1)]
+            self.values[self.index(j)] = self.values[self.index(j - 1)]
+        self.timestamps[self.index(i)] = timestamp_msec
+        self.values[self.index(i)] = value
+        self.next = (self.next + 1) % self.capacity
+        self.size += 1
+        self.trim()
+
+    def trim(self) -> None:
+        """Drop samples that are older than the window."""
+        oldest = int(time.time() * 1000) - self.window_msec
+        while self.size > 0 and self.timestamps[self.index(0)] < oldest:
+            self.size -= 1
+
+    def latest(self) -> tuple[int, float]:
+        i = self.index(self.size - 1)
+        return self.timestamps[i], self.values[i]
+
+    def points(self, since_msec: int) -> list[tuple[int, float]]:
+        """Return the samples from oldest to newest, starting from the given time."""
+        self.trim()
+        points = []
+        for i in range(self.size):
+            j = self.index(i)
+            if self.timestamps[j] >= since_msec:
+                points.append((self.timestamps[j], self.values[j]))
+        return points
+
+    def matches(self, name: str | None, labels: dict[str, str]) -> bool:
+        if name is not None and name != self.name:
+            return False
+        return all(self.labels.get(k) == v for k, v in labels.items())
+
+
+class Cache(object):
+    def __init__(self, capacity: int = 256, window: float = 15 * 60, retention: float = 15 * 60):
+        """
+        :param capacity: Maximum number of samples kept per series.
+        :param window: Seconds of samples kept per series.
+        :param retention: Seconds to keep series that are not updated.
+        """
+        self.capacity = capacity
+        self.window = window
+        self.retention = retention
+        self.series: dict[tuple, Series] = {}
+
+    def record(self, metrics: prometheus.Metrics) -> None:
+        """Store the samples, called for all metrics written to the database."""
+        now = int(time.time() * 1000)
+        for family in metrics.families.values():
+            for samples in family["samples"]:
+                for sample in samples.samples:
+                    labels = {**samples.common_labels_for_all_samples, **sample["labels"]}
+                    key = (family["name"], tuple(sorted(labels.items())))
+                    series = self.series.get(key)
+                    if series is None:
+                        series = Series(
+                            family["name"],
+                            family["type"],
+                            family["description"],
+                            labels,
+                            self.capacity,
+                            int(self.window * 1000),
+                        )
+                        self.series[key] = series
+                    series.append(int(sample["timestamp"] or now), sample["value"])
+
+    def expire(self) -> None:
+        """Remove series that have not been updated within retention, and samples older than the window."""
+        deadline = time.monotonic() - self.retention
+        for key in [k for k, s in self.series.items() if s.updated < deadline]:
+            del self.series[key]
+        for s in self.series.values():
+            s.trim()
+
+    def select(self, name: str | None, labels: dict[str, str]) -> list[Series]:
+        return [s for s in self.series.values() if s.size > 0 and s.matches(name, labels)]
+
+
+class CacheServer(object):
+    # Configured from the runtime section.
+    Settings = config.Runtime
+
+    def configure(self, instance_name, settings):
+        self.instance_name = instance_name
+        self.listen_address = settings.cache_listen_address
+        self.listen_port = settings.cache_listen_port
+        self.scrape_endpoint = settings.cache_metrics_endpoint
+        self.cache = Cache(
+            capacity=settings.cache_capacity,
+            window=settings.cache_window.total_seconds(),
+            retention=settings.cache_retention.total_seconds(),
+        )
+        sink.register(self.cache.record)
+
+    async def start(self):
+        logger.info(
+            f"Starting metrics cache address={self.listen_address}:{self.listen_port} "
+            f"capacity={self.cache.capacity} window_sec={self.cache.window} retention_sec={self.cache.retention}"
+        )
+
+        app = web.Application()
+        app.router.add_get("/api/v1/latest", self.handle_latest)
+        app.router.add_get("/api/v1/range", self.handle_range)
+        if self.scrape_endpoint:
+            app.router.add_get("/metrics", self.handle_metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.listen_address, self.listen_port).start()
+            while True:
+                await asyncio.sleep(60)
+                self.cache.expire()
+        finally:
+            await runner.cleanup()
+
+    def query(self, request) -> tuple[str | None, dict[str, str]]:
+        labels = {k: v for k, v in request.query.items() if k not in ("name", "since")}
+        return request.query.get("name"), labels
+
+    async def handle_latest(self, request):
+        result = []
+        for s in self.cache.select(*self.query(request)):
+            timestamp, value = s.latest()
+            result.append({"name": s.name, "labels": s.labels, "timestamp": timestamp, "value": value})
+        return web.json_response(result)
+
+    async def handle_range(self, request):
+        try:
+            since = utils.parse_timedelta(request.query.get("since", "5m")).total_seconds()
+        except (IndexError, ValueError):
+            raise web.HTTPBadRequest(text=f"Invalid since: {request.query['since']!r}")
+        since_msec = int((time.time() - since) * 1000)
+        result = []
+        for s in self.cache.select(*self.query(request)):
+            result.append({"name": s.name, "labels": s.labels, "samples": s.points(since_msec)})
+        return web.json_response(result)
+
+    async def handle_metrics(self, request):
+        metrics = prometheus.Metrics()
+        for s in self.cache.select(None, {}):
+            # Without timestamps, since the scraper assigns its own.
+            metrics.family(s.type, s.name, s.description, None).add(s.latest()[1], labels=s.labels)
+        return web.Response(text=metrics.format(), content_type="text/plain")
+
+
+task.register(CacheServer, "metrics-cache", internal=True)
@@ -0,0 +1,24 @@
+# Unit tests of the application modules, run with "python -m pytest -q" from the repository root.
+#
+# The application modules are imported from src the same way as main.py imports them.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import circuitbreaker  # noqa: E402
+import httpclient  # noqa: E402
+import sink  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def breakers(monkeypatch):
+    """Keep the circuit breakers, sinks and HTTP client created by a test out of the other tests."""
+    monkeypatch.setattr(circuitbreaker, "breakers", {})
+    monkeypatch.setattr(sink, "sinks", {})
+    monkeypatch.setattr(sink, "processors", [])
+    monkeypatch.setattr(httpclient, "_client", None)
+    return circuitbreaker.breakers
@@ -0,0 +1,151 @@
+# Fake Shelly devices for testing the Shelly tasks without real devices.
+#
+# Simulates a Shelly Plus 1PM (2nd gen) and a Shelly 3EM (1st gen) with slowly changing power readings.
+#
+# - Serves the polling APIs: POST /rpc with Shelly.GetStatus (2nd gen) and GET /status (1st gen).
+# - With --websocket, connects to the shelly2-push task like a 2nd gen device with outbound websocket enabled,
+#   sends NotifyFullStatus and then NotifyStatus with the changed fields.
+# - With --mqtt, publishes 2nd gen notifications and 1st gen emeter values to MQTT broker.
+#
+# Example:
+#
+#   python3 tests/fakeshelly.py --websocket ws://localhost:8765/shelly --mqtt localhost
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+
+import aiohttp
+import aiomqtt
+from aiohttp import web
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("fakeshelly")
+
+
+class FakeDevices(object):
+    def __init__(self, device_id: str):
+        self.device_id = device_id
+        self.switch = {
+            "id": 0,
+            "source": "init",
+            "output": True,
+            "apower": 0.0,
+            "voltage": 230.0,
+            "current": 0.0,
+            "aenergy": {"total": 0.0},
+        }
+        self.emeters = [{"power": 0.0, "current": 0.0, "voltage": 230.0, "total": 0.0} for _ in range(3)]
+
+    def step(self, period: float) -> dict:
+        """Advance the simulated readings.
+
+        :return: Changed fields of the 2nd gen switch.
+        """
+        power = max(0.0, self.switch["apower"] + random.uniform(-50, 50))
+        self.switch["apower"] = round(power, 1)
+        self.switch["current"] = round(power / self.switch["voltage"], 3)
+        self.switch["aenergy"]["total"] = round(self.switch["aenergy"]["total"] + power * period / 3600, 3)
+
+        for e in self.emeters:
+            e["power"] = round(max(0.0, e["power"] + random.uniform(-100, 100)), 2)
+            e["current"] = round(e["power"] / e["voltage"], 2)
+            e["total"] = round(e["total"] + e["power"] * period / 3600, 1)
+
+        return {
+            "switch:0": {
+                "id": 0,
+                "apower": self.switch["apower"],
+                "current": self.switch["current"],
+                "aenergy": {"total": self.switch["aenergy"]["total"]},
+            }
+        }
+
+    def full_status(self) -> dict:
+        return {"switch:0": self.switch, "sys": {"mac": "AABBCCDDEEFF"}}
+
+    def notification(self, method: str, params: dict) -> dict:
+        return {"src": self.device_id, "dst": "homemetrics", "method": method, "params": {"ts": time.time(), **params}}
+
+    async def handle_rpc(self, request):
+        body = await request.json()
+        return web.json_response({"id": body.get("id", 1), "src": self.device_id, "result": self.full_status()})
+
+    async def handle_status(self, request):
+        return web.json_response({"emeters": self.emeters, "total_power": sum(e["power"] for e in self.emeters)})
+
+
+async def serve_http(devices: FakeDevices, port: int):
+    app = web.Application()
+    app.router.add_post("/rpc", devices.handle_rpc)
+    app.router.add_get("/status", devices.handle_status)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    logger.info(f"Serving /rpc and /status on 127.0.0.1:{port}")
+
+
+async def push_websocket(devices: FakeDevices, url: str, period: float):
+    while True:
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.ws_connect(url) as ws:
+                    logger.info(f"Connected to {url}")
+                    await ws.send_json(devices.notification("NotifyFullStatus", devices.full_status()))
+                    while True:
+                        await asyncio.sleep(period)
+                        await ws.send_json(devices.notification("NotifyStatus", devices.step(period)))
+        except aiohttp.ClientError as e:
+            logger.warning(f"Websocket connection failed, reconnecting: {e}")
+            await asyncio.sleep(5)
+
+
+async def push_mqtt(devices: FakeDevices, server: str, period: float):
+    async with aiomqtt.Client(server) as client:
+        logger.info(f"Connected to MQTT broker {server}")
+        await client.publish(f"{devices.device_id}/status/switch:0", json.dumps(devices.switch))
+        while True:
+            await asyncio.sleep(period)
+            changes = devices.step(period)
+            await client.publish(
+                f"{devices.device_id}/events/rpc", json.dumps(devices.notification("NotifyStatus", changes))
+            )
+            for i, e in enumerate(devices.emeters):
+                for k, v in e.items():
+                    await client.publish(f"shellies/shellyem3-{devices.device_id}/emeter/{i}/{k}", str(v))
+
+
+async def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--device-id", default="shellyplus1pm-fake", help="Device id")
+    ap.add_argument("--port", type=int, default=9001, help="Port for the polling APIs")
+    ap.add_argument("--websocket", help="URL of the shelly2-push task, for example ws://localhost:8765/shelly")
+    ap.add_argument("--mqtt", help="MQTT broker to publish to")
+    ap.add_argument("--period", type=float, default=2.0, help="Seconds between status changes")
+    args = ap.parse_args()
+
+    devices = FakeDevices(args.device_id)
+    await serve_http(devices, args.port)
+
+    pushers = []
+    if args.websocket:
+        pushers.append(push_websocket(devices, args.websocket, args.period))
+    if args.mqtt:
+        pushers.append(push_mqtt(devices, args.mqtt, args.period))
+    if not pushers:
+        # Only serving polling APIs, advance the readings here.
+        async def step_forever():
+            while True:
+                await asyncio.sleep(args.period)
+                devices.step(args.period)
+
+        pushers.append(step_forever())
+
+    await asyncio.gather(*pushers)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,38 +1,312 @@
-# HTTP test server that will accept POST requests and print the body.
+# HTTP test server that stands in for the database the metrics are pushed to.
+#
+# Accepts the same write requests as VictoriaMetrics and Prometheus:
+# - Prometheus exposition format text, for example POST /api/v1/import/prometheus, optionally gzip compressed.
+# - Prometheus remote write (snappy compressed protobuf) at POST /api/v1/write.
+#
+# The samples are parsed into an in-memory series store, and statistics are served for assertions
+# in integration and performance tests:
+# - GET /stats: counts of requests, samples, series and duplicate samples, and latency percentiles.
+#   Latency is the time from the sample timestamp to receiving it, for samples that have timestamp.
+# - GET /series?name=<metric>: stored samples of the series.
+# - POST /reset: clears the store.
+#
+# The server is asynchronous and does not print the bodies unless --verbose is given, so that it does not
+# become the bottleneck under load. SeriesStore and Server can also be used from other test tools.
 
-import http.server
+import argparse
 import logging
+import re
+import struct
+import time
+from typing import Callable, NamedTuple
 
-import yaml
+from aiohttp import web
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("httpserver")
 
+LINE_RE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)\s*(?:\{(.*)\})?\s+(\S+)(?:\s+(\S+))?\s*$")
+LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
 
-class LoggingHandler(http.server.BaseHTTPRequestHandler):
-    def do_POST(self):
-        content_length = int(self.headers["Content-Length"])
-        body = self.rfile.read(content_length)
-        self.send_response(200)
-        self.end_headers()
-        logger.info(f"body:\n{body.decode('utf-8')}")
 
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
+class Sample(NamedTuple):
+    name: str
+    labels: tuple[tuple[str, str], ...]
+    value: float
+    timestamp_msec: int | None
 
-    def log_message(self, format, *args):
-        logger.info(
-            f"address: {self.client_address[0]}:{self.client_address[1]} method: {self.command} path: {self.path}"
+
+def parse_text(body: str) -> list[Sample]:
+    """Parse Prometheus exposition format.
+
+    :raises ValueError: If a line cannot be parsed.
+    """
+    samples = []
+    for line in body.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        m = LINE_RE.match(line)
+        if not m:
+            raise ValueError(f"invalid line: {line}")
+        name, labels, value, timestamp = m.groups()
+        samples.append(
+            Sample(
+                name=name,
+                labels=tuple(sorted(LABEL_RE.findall(labels or ""))),
+                value=float(value),
+                # Timestamps computed from device time can have a fraction of millisecond.
+                timestamp_msec=int(float(timestamp)) if timestamp else None,
+            )
         )
+    return samples
+
+
+def read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    """Read variable length integer.
+
+    :return: The value and the position after it.
+    """
+    result = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def snappy_decompress(data: bytes) -> bytes:
+    """Decompress snappy block format, as used by Prometheus remote write."""
+    length, pos = read_varint(data, 0)
+    out = bytearray()
+    while pos < len(data):
+        tag = data[pos]
+        pos += 1
+        kind = tag & 3
+        if kind == 0:
+            # Literal, length is in the tag or in the following 1-4 bytes.
+            n = tag >> 2
+            if n >= 60:
+                extra = n - 59
+                n = int.from_bytes(data[pos : pos + extra], "little")
+                pos += extra
+            n += 1
+            out += data[pos : pos + n]
+            pos += n
+            continue
+        if kind == 1:
+            n = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | data[pos]
+            pos += 1
+        elif kind == 2:
+            n = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos : pos + 2], "little")
+            pos += 2
+        else:
+            n = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos : pos + 4], "little")
+            pos += 4
+        # Copy byte by byte, since the source may overlap with the bytes being written.
+        start = len(out) - offset
+        for i in range(n):
+            out.append(out[start + i])
+
+    if len(out) != length:
+        raise ValueError("invalid snappy data")
+    return bytes(out)
+
+
+def protobuf_fields(data: bytes):
+    """Iterate over (field number, value) of a protobuf message.
+
+    Length delimited values are returned as bytes, fixed64 as raw 8 bytes and varints as int.
+    """
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+            yield field, value
+        elif wire_type == 1:
+            yield field, data[pos : pos + 8]
+            pos += 8
+        elif wire_type == 2:
+            n, pos = read_varint(data, pos)
+            yield field, data[pos : pos + n]
+            pos += n
+        elif wire_type == 5:
+            yield field, data[pos : pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f"unsupported wire type: {wire_type}")
+
+
+def parse_remote_write(body: bytes) -> list[Sample]:
+    """Parse Prometheus remote write request.
+
+    https://prometheus.io/docs/concepts/remote_write_spec/
+    """
+    samples = []
+    for field, timeseries in protobuf_fields(snappy_decompress(body)):
+        if field != 1:
+            continue
+        name = ""
+        labels = []
+        values = []
+        for f, v in protobuf_fields(timeseries):
+            if f == 1:
+                label = dict(protobuf_fields(v))
+                k, val = label.get(1, b"").decode(), label.get(2, b"").decode()
+                if k == "__name__":
+                    name = val
+                else:
+                    labels.append((k, val))
+            elif f == 2:
+                sample = dict(protobuf_fields(v))
+                timestamp = sample.get(2, 0)
+                if timestamp >= 1 << 63:
+                    timestamp -= 1 << 64
+                values.append((struct.unpack("<d", sample.get(1, bytes(8)))[0], timestamp))
+        for value, timestamp in values:
+            samples.append(Sample(name=name, labels=tuple(sorted(labels)), value=value, timestamp_msec=timestamp))
+    return samples
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Return the p'th percentile of sorted values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class SeriesStore(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        # Samples by series, as (timestamp, value). Samples without timestamp get the time they were received.
+        self.series: dict[tuple[str, tuple], dict[int, float]] = {}
+        self.latencies: list[float] = []
+        self.requests = 0
+        self.bytes = 0
+        self.samples = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.encodings: dict[str, int] = {}
+        self.started = time.time()
+
+    def add(self, samples: list[Sample], received: float) -> None:
+        received_msec = int(received * 1000)
+        for s in samples:
+            points = self.series.setdefault((s.name, s.labels), {})
+            if s.timestamp_msec is None:
+                timestamp = received_msec
+            else:
+                timestamp = s.timestamp_msec
+                self.latencies.append(received - timestamp / 1000)
+                if timestamp in points:
+                    self.duplicates += 1
+            points[timestamp] = s.value
+        self.samples += len(samples)
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        elapsed = max(time.time() - self.started, 0.001)
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "encodings": self.encodings,
+            "samples": self.samples,
+            "samples_per_second": round(self.samples / elapsed, 1),
+            "series": len(self.series),
+            "duplicates": self.duplicates,
+            "latency_seconds": {
+                "count": len(latencies),
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1] if latencies else 0.0,
+            },
+        }
+
+
+class Server(object):
+    def __init__(self, store: SeriesStore, verbose: bool = False):
+        self.store = store
+        self.verbose = verbose
+
+        # Called with the samples of each write request, for tools that track the written data.
+        self.listeners: list[Callable[[list[Sample]], None]] = []
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/stats", self.handle_stats)
+        app.router.add_get("/series", self.handle_series)
+        app.router.add_post("/reset", self.handle_reset)
+        app.router.add_post("/api/v1/write", self.handle_remote_write)
+        app.router.add_post("/{path:.*}", self.handle_text)
+        return app
+
+    async def handle_text(self, request):
+        # aiohttp decompresses the body according to Content-Encoding.
+        text = (await request.read()).decode("utf-8")
+        encoding = request.headers.get("Content-Encoding", "text")
+        if self.verbose:
+            logger.info(f"body:\n{text}")
+        return self.write(request, encoding, parse_text, text)
+
+    async def handle_remote_write(self, request):
+        return self.write(request, "remote-write", parse_remote_write, await request.read())
+
+    def write(self, request, encoding: str, parse: Callable, body) -> web.Response:
+        received = time.time()
+        self.store.requests += 1
+        self.store.bytes += request.content_length or 0
+        self.store.encodings[encoding] = self.store.encodings.get(encoding, 0) + 1
+        try:
+            samples = parse(body)
+        except (ValueError, IndexError) as e:
+            self.store.errors += 1
+            logger.warning(f"Invalid {encoding} request: {e}")
+            return web.Response(status=400, text=str(e))
+
+        self.store.add(samples, received)
+        for listener in self.listeners:
+            listener(samples)
+        return web.Response(status=204)
+
+    async def handle_stats(self, request):
+        return web.json_response(self.store.stats())
+
+    async def handle_series(self, request):
+        name = request.query.get("name")
+        result = [
+            {"name": n, "labels": dict(labels), "samples": sorted(points.items())}
+            for (n, labels), points in self.store.series.items()
+            if name is None or n == name
+        ]
+        return web.json_response(result)
+
+    async def handle_reset(self, request):
+        self.store.reset()
+        return web.Response(status=204)
 
 
 def main():
-    server_address = ("127.0.0.1", 8000)
-    logger.info(f"Starting server on {server_address[0]}:{server_address[1]}")
-    httpd = http.server.HTTPServer(server_address, LoggingHandler)
-    httpd.request_queue_size = 10
-    httpd.serve_forever()
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    ap.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    ap.add_argument("--verbose", action="store_true", help="Print the body of each text request")
+    args = ap.parse_args()
+
+    logger.info(f"Starting server on {args.host}:{args.port}")
+    server = Server(SeriesStore(), verbose=args.verbose)
+    web.run_app(server.app(), host=args.host, port=args.port, access_log=None, print=None)
 
 
 if __name__ == "__main__":
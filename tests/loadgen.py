@@ -0,0 +1,389 @@
+# Load generator for stress testing the application.
+#
+# Generates device traffic towards the application and receives the metrics it writes, to measure
+# ingestion rate, end-to-end latency and loss. Use it to size the deployment and to catch throughput
+# regressions.
+#
+# - record: Captures MQTT traffic, for example from zigbee2mqtt and zwave-js-ui, to a file (one JSON object per line).
+# - run: Replays captures to MQTT broker at N times the recorded speed, optionally multiplying the sensors.
+#   Simulates fleets of Shelly and go-e devices polled over HTTP, and acts as the database the application writes to
+#   (see httpserver.py).
+# - config: Prints application configuration that matches the simulated devices.
+#
+# Latency and loss are tracked per sensor label. Each published message and each served HTTP response
+# is an event for the sensor, and the first write received for the sensor after the event delivers it.
+# Events that are not delivered within the loss timeout are counted as lost. Note that messages that the
+# application ignores, such as unhandled Z-Wave command classes, are delivered by the next handled message
+# of the same sensor.
+#
+# Example:
+#
+#   python3 tests/loadgen.py record --mqtt mosquitto --topic "zigbee2mqtt/#" --topic "zwave/#" --output capture.jsonl
+#   python3 tests/loadgen.py config --shelly2 200 --goe 10 --mqtt localhost > loadtest.yaml
+#   python3 tests/loadgen.py run --replay capture.jsonl --mqtt localhost --speed 10 --copies 5 --shelly2 200 --goe 10
+#   python3 src/main.py --config loadtest.yaml
+
+import argparse
+import asyncio
+import base64
+import collections
+import json
+import logging
+import random
+import sys
+import time
+
+import aiomqtt
+import httpserver
+import yaml
+from aiohttp import web
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("loadgen")
+
+
+class Tracker(object):
+    """Matches the events sent to the application with the metrics written by it."""
+
+    def __init__(self, loss_timeout: float):
+        self.loss_timeout = loss_timeout
+        self.pending: dict[str, collections.deque[float]] = collections.defaultdict(collections.deque)
+        self.latencies: list[float] = []
+
+        self.events_total = 0
+        self.delivered_total = 0
+        self.lost_total = 0
+        self.samples_total = 0
+        self.requests_total = 0
+
+        # Batches dropped by the application, as reported in its own metrics.
+        self.dropped_batches = 0
+
+    def event(self, sensor: str) -> None:
+        self.pending[sensor].append(time.monotonic())
+        self.events_total += 1
+
+    def received(self, samples: list[httpserver.Sample]) -> None:
+        now = time.monotonic()
+        self.requests_total += 1
+        self.samples_total += len(samples)
+        sensors = set()
+        dropped = None
+        for s in samples:
+            labels = dict(s.labels)
+            if "sensor" in labels:
+                sensors.add(labels["sensor"])
+            elif s.name == "sink_dropped_batches_total":
+                dropped = (dropped or 0) + int(s.value)
+        if dropped is not None:
+            self.dropped_batches = dropped
+
+        for sensor in sensors:
+            events = self.pending.get(sensor)
+            while events:
+                self.latencies.append(now - events.popleft())
+                self.delivered_total += 1
+
+    def expire(self) -> None:
+        deadline = time.monotonic() - self.loss_timeout
+        for events in self.pending.values():
+            while events and events[0] < deadline:
+                events.popleft()
+                self.lost_total += 1
+
+    def report(self, elapsed: float, previous: tuple[int, int]) -> tuple[int, int]:
+        """Log the statistics since previous report.
+
+        :return: Counters to pass to the next report.
+        """
+        self.expire()
+        latencies = sorted(self.latencies)
+        self.latencies = []
+        pending = sum(len(e) for e in self.pending.values())
+        logger.info(
+            "events/s=%.1f samples/s=%.1f latency_ms p50=%.1f p95=%.1f p99=%.1f max=%.1f "
+            "delivered=%d lost=%d pending=%d requests=%d app_dropped_batches=%d",
+            (self.events_total - previous[0]) / elapsed,
+            (self.samples_total - previous[1]) / elapsed,
+            httpserver.percentile(latencies, 50) * 1000,
+            httpserver.percentile(latencies, 95) * 1000,
+            httpserver.percentile(latencies, 99) * 1000,
+            (latencies[-1] if latencies else 0) * 1000,
+            self.delivered_total,
+            self.lost_total,
+            pending,
+            self.requests_total,
+            self.dropped_batches,
+        )
+        return self.events_total, self.samples_total
+
+
+class SimulatedDevices(object):
+    """Fleets of Shelly and go-e devices that are polled over HTTP."""
+
+    def __init__(self, tracker: Tracker):
+        self.tracker = tracker
+        self.energy = collections.defaultdict(float)
+
+    def routes(self, app: web.Application) -> None:
+        app.router.add_post("/shelly2/{i}/rpc", self.handle_shelly2)
+        app.router.add_get("/shelly1/{i}/status", self.handle_shelly1)
+        app.router.add_get("/goe/{i}/api/status", self.handle_goe)
+
+    def increment(self, key: str, power: float) -> float:
+        self.energy[key] += power / 60
+        return round(self.energy[key], 3)
+
+    async def handle_shelly2(self, request):
+        name = f"shelly2-{request.match_info['i']}"
+        power = round(random.uniform(0, 2000), 1)
+        switch = {
+            "id": 0,
+            "output": True,
+            "apower": power,
+            "voltage": 230.0,
+            "current": round(power / 230, 3),
+            "aenergy": {"total": self.increment(name, power)},
+        }
+        self.tracker.event(name)
+        return web.json_response({"id": 1, "src": name, "result": {"switch:0": switch}})
+
+    async def handle_shelly1(self, request):
+        name = f"shelly1-{request.match_info['i']}"
+        emeters = []
+        for phase in range(3):
+            power = round(random.uniform(0, 3000), 2)
+            emeters.append(
+                {
+                    "power": power,
+                    "current": round(power / 230, 2),
+                    "voltage": 230.0,
+                    "total": self.increment(f"{name}-{phase}", power),
+                }
+            )
+        self.tracker.event(name)
+        return web.json_response({"emeters": emeters, "total_power": sum(e["power"] for e in emeters)})
+
+    async def handle_goe(self, request):
+        name = f"goe-{request.match_info['i']}"
+        power = round(random.uniform(0, 11000), 1)
+        current = round(power / 3 / 230, 1)
+        nrg = [230, 230, 230, 0, current, current, current, power / 3, power / 3, power / 3, 0, power]
+        self.tracker.event(name)
+        return web.json_response(
+            {
+                "car": 2 if power > 0 else 1,
+                "eto": self.increment(name, power),
+                "nrg": nrg,
+                "cdi": {"type": 1, "value": 600000},
+                "wh": self.increment(f"{name}-session", power),
+            }
+        )
+
+
+def read_capture(path: str) -> list[dict]:
+    with open(path) as f:
+        messages = [json.loads(line) for line in f if line.strip()]
+    for m in messages:
+        if m.get("encoding") == "base64":
+            m["payload"] = base64.b64decode(m["payload"])
+        else:
+            m["payload"] = m["payload"].encode("utf-8")
+    return messages
+
+
+def informational(topic: str) -> bool:
+    """Bridge and informational messages are not written as metrics and are not multiplied."""
+    return topic.startswith("zigbee2mqtt/bridge/") or topic.startswith("zwave/_")
+
+
+def rename(topic: str, payload: bytes, copy: int) -> tuple[str, str, bytes]:
+    """Make the message look like it came from a different sensor, and from this moment.
+
+    :return: Topic, sensor name and payload.
+    """
+    parts = topic.split("/")
+    if len(parts) < 2 or informational(topic):
+        return topic, "", payload
+    if copy > 0:
+        parts[1] = f"{parts[1]}-{copy}"
+
+    # Z-Wave JS UI includes the time of the event, which the application uses as sample timestamp.
+    if parts[0] == "zwave":
+        try:
+            event = json.loads(payload)
+            if isinstance(event, dict) and "time" in event:
+                event["time"] = int(time.time() * 1000)
+                payload = json.dumps(event).encode("utf-8")
+        except json.JSONDecodeError:
+            pass
+
+    return "/".join(parts), parts[1], payload
+
+
+async def replay(tracker: Tracker, path: str, server: str, port: int, speed: float, copies: int, loop: bool):
+    messages = read_capture(path)
+    logger.info(f"Replaying {len(messages)} messages from {path} speed={speed} copies={copies}")
+    async with aiomqtt.Client(server, port) as client:
+        while True:
+            start = time.monotonic()
+            for m in messages:
+                delay = start + m["time"] / speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                for copy in range(1 if informational(m["topic"]) else copies):
+                    topic, sensor, payload = rename(m["topic"], m["payload"], copy)
+                    # Copies are not retained, so that they do not pile up in the broker.
+                    await client.publish(topic, payload, retain=copy == 0 and m.get("retain", False))
+                    if sensor:
+                        tracker.event(sensor)
+            if not loop:
+                break
+    logger.info("Replay finished")
+
+
+async def record(args):
+    start = time.monotonic()
+    count = 0
+    with open(args.output, "w") as f:
+        async with aiomqtt.Client(args.mqtt, args.port) as client:
+            for topic in args.topic:
+                await client.subscribe(topic)
+            logger.info(f"Recording {args.topic} to {args.output}")
+            async with asyncio.timeout(args.duration):
+                async for message in client.messages:
+                    entry = {"time": round(time.monotonic() - start, 3), "topic": str(message.topic)}
+                    try:
+                        entry["payload"] = message.payload.decode("utf-8")
+                    except UnicodeDecodeError:
+                        entry["payload"] = base64.b64encode(message.payload).decode("ascii")
+                        entry["encoding"] = "base64"
+                    if message.retain:
+                        entry["retain"] = True
+                    f.write(json.dumps(entry) + "\n")
+                    count += 1
+    logger.info(f"Recorded {count} messages")
+
+
+async def run(args):
+    tracker = Tracker(args.loss_timeout)
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    SimulatedDevices(tracker).routes(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    # Each device listens on its own port, so that the application sees them as separate endpoints.
+    for port in range(args.http_port, args.http_port + args.shelly2 + args.shelly1 + args.goe):
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    # Database stand-in, statistics of the stored series are available at /stats.
+    server = httpserver.Server(httpserver.SeriesStore())
+    server.listeners.append(tracker.received)
+    sink_runner = web.AppRunner(server.app(), access_log=None)
+    await sink_runner.setup()
+    await web.TCPSite(sink_runner, "127.0.0.1", args.sink_port).start()
+    logger.info(f"Serving simulated devices from port {args.http_port} and sink on port {args.sink_port}")
+
+    generators = []
+    if args.replay:
+        if not args.mqtt:
+            sys.exit("--replay requires --mqtt")
+        generators.append(
+            asyncio.create_task(replay(tracker, args.replay, args.mqtt, args.port, args.speed, args.copies, args.loop))
+        )
+
+    start = time.monotonic()
+    last = start
+    previous = (0, 0)
+    try:
+        while args.duration is None or time.monotonic() - start < args.duration:
+            await asyncio.sleep(args.report_interval)
+            now = time.monotonic()
+            previous = tracker.report(now - last, previous)
+            last = now
+            for g in generators:
+                if g.done() and g.exception():
+                    raise g.exception()
+    finally:
+        for g in generators:
+            g.cancel()
+        await runner.cleanup()
+        await sink_runner.cleanup()
+
+
+def config(args):
+    database_url = f"http://127.0.0.1:{args.sink_port}/api/v1/import/prometheus"
+    ports = iter(range(args.http_port, args.http_port + args.shelly2 + args.shelly1 + args.goe))
+    sensors = []
+    if args.shelly2:
+        devices = [
+            {"name": f"shelly2-{i}", "url": f"http://127.0.0.1:{next(ports)}/shelly2/{i}/rpc"}
+            for i in range(args.shelly2)
+        ]
+        sensors.append({"type": "shelly2", "name": "loadgen", "config": {"devices": devices, "poll-period": "5s"}})
+    if args.shelly1:
+        devices = [
+            {"name": f"shelly1-{i}", "url": f"http://127.0.0.1:{next(ports)}/shelly1/{i}/status"}
+            for i in range(args.shelly1)
+        ]
+        sensors.append({"type": "shelly1", "name": "loadgen", "config": {"devices": devices, "poll-period": "5s"}})
+    if args.goe:
+        devices = [
+            {"name": f"goe-{i}", "url": f"http://127.0.0.1:{next(ports)}/goe/{i}/api/status"} for i in range(args.goe)
+        ]
+        sensors.append({"type": "goe-charger", "name": "loadgen", "config": {"devices": devices, "poll-period": "5s"}})
+    if args.mqtt:
+        sensors.append({"type": "zigbee", "config": {"server": args.mqtt, "topic": "zigbee2mqtt/#"}})
+        sensors.append({"type": "zwave", "config": {"server": args.mqtt, "topic": "zwave/#"}})
+
+    yaml.safe_dump(
+        {"global": {"database_url": database_url}, "runtime": {"self-metrics-period": "10s"}, "sensors": sensors},
+        sys.stdout,
+        sort_keys=False,
+    )
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    commands = ap.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("record", help="Record MQTT traffic to a file")
+    p.add_argument("--mqtt", required=True, help="MQTT broker to record from")
+    p.add_argument("--port", type=int, default=1883, help="MQTT broker port")
+    p.add_argument("--topic", action="append", required=True, help="Topic to subscribe, can be repeated")
+    p.add_argument("--output", required=True, help="File to write the capture to")
+    p.add_argument("--duration", type=float, help="Seconds to record, default until interrupted")
+
+    run_parser = commands.add_parser("run", help="Generate traffic and measure the application")
+    config_parser = commands.add_parser("config", help="Print application configuration for the simulated devices")
+    for p in (run_parser, config_parser):
+        p.add_argument("--mqtt", help="MQTT broker to replay to")
+        p.add_argument("--shelly2", type=int, default=0, help="Number of simulated Shelly 2nd gen devices")
+        p.add_argument("--shelly1", type=int, default=0, help="Number of simulated Shelly 1st gen devices")
+        p.add_argument("--goe", type=int, default=0, help="Number of simulated go-e chargers")
+        p.add_argument(
+            "--http-port", type=int, default=9100, help="First port of the simulated devices, one per device"
+        )
+        p.add_argument("--sink-port", type=int, default=8000, help="Port for receiving the metrics")
+
+    p = run_parser
+    p.add_argument("--port", type=int, default=1883, help="MQTT broker port")
+    p.add_argument("--replay", help="Capture file to replay")
+    p.add_argument("--speed", type=float, default=1.0, help="Replay speed multiplier")
+    p.add_argument("--copies", type=int, default=1, help="Replay each message as this many different sensors")
+    p.add_argument("--loop", action="store_true", help="Replay the capture repeatedly")
+    p.add_argument("--duration", type=float, help="Seconds to run, default until interrupted")
+    p.add_argument("--report-interval", type=float, default=10, help="Seconds between statistics reports")
+    p.add_argument("--loss-timeout", type=float, default=30, help="Seconds after which undelivered event is lost")
+    args = ap.parse_args()
+
+    if args.command == "record":
+        asyncio.run(record(args))
+    elif args.command == "run":
+        asyncio.run(run(args))
+    else:
+        config(args)
+
+
+if __name__ == "__main__":
+    main()
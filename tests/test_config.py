@@ -0,0 +1,84 @@
+import datetime
+from dataclasses import dataclass
+
+import config
+import pytest
+
+
+@dataclass(frozen=True, kw_only=True)
+class Settings:
+    database_url: str = config.setting(key="database_url")
+    url: str
+    poll_period: datetime.timedelta = datetime.timedelta(minutes=1)
+    concurrency: int = config.setting(16, minimum=1)
+    threshold: float = config.setting(0.5, greater_than=0)
+    mode: str = config.setting("thread", choices=("thread", "process"))
+    schedule: list[datetime.time] = config.setting([])
+    timeouts: dict[str, datetime.timedelta] = config.setting({})
+    port: int | None = None
+
+
+def parse(data):
+    return config.parse(Settings, {"database_url": "http://db", **data}, "sensor test")
+
+
+def test_conversion():
+    s = parse(
+        {
+            "url": 12345,
+            "poll-period": "5m",
+            "threshold": 1,
+            "schedule": ["00:00", "12:30"],
+            "timeouts": {"sauna": "1h"},
+            "port": 8080,
+        }
+    )
+    assert s.database_url == "http://db"
+    assert s.url == "12345"
+    assert s.poll_period == datetime.timedelta(minutes=5)
+    assert s.threshold == 1.0 and isinstance(s.threshold, float)
+    assert s.schedule == [datetime.time(0, 0), datetime.time(12, 30)]
+    assert s.timeouts == {"sauna": datetime.timedelta(hours=1)}
+    assert s.port == 8080
+
+
+def test_defaults_are_not_shared():
+    assert parse({"url": "x"}).timeouts is not parse({"url": "x"}).timeouts
+
+
+def test_zero_is_not_replaced_by_default():
+    assert config.parse(config.Runtime, {"loop-lag-interval": 0}, "runtime").loop_lag_interval == 0
+
+
+@pytest.mark.parametrize(
+    "data, message",
+    [
+        ({}, "missing required setting: url"),
+        ({"url": "x", "pol-period": "5m"}, "unknown setting: pol-period"),
+        ({"url": "x", "concurrency": True}, "sensor test.concurrency: expected int, got bool"),
+        ({"url": "x", "poll-period": "five minutes"}, "invalid interval"),
+        ({"url": "x", "poll-period": "0s"}, "interval must be positive"),
+        ({"url": "x", "concurrency": 0}, "must be at least 1"),
+        ({"url": "x", "threshold": 0}, "must be greater than 0"),
+        ({"url": "x", "mode": "fork"}, "must be one of thread, process"),
+        ({"url": "x", "schedule": ["25:00"]}, "sensor test.schedule[0]: invalid time"),
+        ({"url": "x", "timeouts": ["sauna"]}, "expected mapping"),
+    ],
+)
+def test_invalid(data, message):
+    with pytest.raises(config.ConfigException) as e:
+        parse(data)
+    assert message in str(e.value)
+
+
+def test_load(tmp_path):
+    path = tmp_path / "config.yaml"
+    path.write_text(
+        "global:\n  database_url: http://db\n"
+        "runtime:\n  workers: 2\n"
+        "sensors:\n- type: shelly2\n  name: heater\n  config:\n    url: http://device\n"
+    )
+    conf = config.load(str(path))
+    assert conf.global_config == {"database_url": "http://db"}
+    assert conf.runtime.workers == 2
+    assert [(s.type, s.name, s.config) for s in conf.sensors] == [("shelly2", "heater", {"url": "http://device"})]
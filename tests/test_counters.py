@@ -0,0 +1,61 @@
+import counters
+import prometheus
+import pytest
+
+HOUR_MSEC = 60 * 60 * 1000
+
+
+def test_reset_continues_from_previous_value():
+    tracker = counters.CounterTracker(["energy_kwh"])
+    labels = {"sensor": "heater"}
+    assert tracker.update("energy_kwh", labels, 100.0, 0) == (100.0, None)
+    assert tracker.update("energy_kwh", labels, 102.0, HOUR_MSEC) == (102.0, 2.0)
+
+    # Device rebooted and started counting from zero.
+    adjusted, rate = tracker.update("energy_kwh", labels, 1.0, 2 * HOUR_MSEC)
+    assert adjusted == 103.0
+    assert rate == pytest.approx(1.0)
+    assert tracker.resets == {"energy_kwh": 1}
+
+
+def test_jitter_is_not_reset():
+    tracker = counters.CounterTracker(["energy_kwh"])
+    tracker.update("energy_kwh", {}, 1000.0, 0)
+    adjusted, _ = tracker.update("energy_kwh", {}, 999.9, HOUR_MSEC)
+    assert adjusted == 1000.0
+    assert tracker.resets == {}
+
+
+def test_series_are_tracked_separately():
+    tracker = counters.CounterTracker(["energy_kwh"])
+    tracker.update("energy_kwh", {"sensor": "a"}, 100.0, 0)
+    tracker.update("energy_kwh", {"sensor": "b"}, 5.0, 0)
+    assert tracker.update("energy_kwh", {"sensor": "b"}, 6.0, HOUR_MSEC)[0] == 6.0
+    assert tracker.resets == {}
+
+
+def test_process_adds_derived_metrics():
+    tracker = counters.CounterTracker(["energy_kwh"], monotonic=True, rate=True)
+    for value, timestamp in ((10.0, HOUR_MSEC), (1.0, 2 * HOUR_MSEC)):
+        metrics = prometheus.Metrics()
+        metrics.counter("energy_kwh", "Energy.", labels={"sensor": "heater"}).add(value, timestamp_msec=timestamp)
+        metrics.gauge("power_w").add(500.0)
+        tracker.process(metrics)
+
+    monotonic = metrics.families["energy_kwh_monotonic"]["samples"][0].samples
+    assert [s["value"] for s in monotonic] == [11.0]
+    assert monotonic[0]["labels"] == {"sensor": "heater"}
+    rate = metrics.families["energy_kwh_rate_per_hour"]["samples"][0].samples
+    assert [s["value"] for s in rate] == [1.0]
+    assert "power_w_monotonic" not in metrics.families
+
+
+def test_state_is_persisted(tmp_path):
+    path = str(tmp_path / "counters.json")
+    tracker = counters.CounterTracker(["energy_kwh"], path=path)
+    tracker.update("energy_kwh", {}, 100.0, 0)
+    tracker.save()
+
+    # Reset while the application was not running.
+    tracker = counters.CounterTracker(["energy_kwh"], path=path)
+    assert tracker.update("energy_kwh", {}, 3.0, HOUR_MSEC)[0] == 103.0
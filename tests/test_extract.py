@@ -0,0 +1,102 @@
+import extract
+import prometheus
+import pytest
+
+DOC = {
+    "emeters": [
+        {"power": 100.0, "total": 1500.0, "is_valid": True},
+        {"power": 200.0, "total": 2500.0, "is_valid": False},
+    ],
+    "result": {"switch:0": {"aenergy": {"total": 42}}},
+    "nrg": [230, 231, 229, 0, 1, 2, 3, 1234],
+}
+
+
+def samples(metrics: prometheus.Metrics, name: str) -> list[tuple[dict, float]]:
+    family = metrics.families[name]
+    return [
+        ({**s.common_labels_for_all_samples, **sample["labels"]}, sample["value"])
+        for s in family["samples"]
+        for sample in s.samples
+    ]
+
+
+def test_selector():
+    assert extract.compile_selector("result.switch:0.aenergy.total")(DOC) == 42
+    assert extract.compile_selector("nrg[7]")(DOC) == 1234
+    assert extract.compile_selector("emeters[*].power")(DOC) == [100.0, 200.0]
+
+
+@pytest.mark.parametrize("path", ["", "a..b", "a[x]", "a[1", "."])
+def test_invalid_selector(path):
+    with pytest.raises(ValueError):
+        extract.parse_path(path)
+
+
+def test_value():
+    assert extract.compile_value({"sum": "emeters[*].power"})(DOC) == 300.0
+    assert extract.compile_value({"sum": ["emeters[0].power", "nrg[7]"]})(DOC) == 1334.0
+    assert extract.compile_value({"path": "emeters[0].total", "scale": 0.001})(DOC) == 1.5
+    assert extract.compile_value({"path": "emeters[0].total", "scale": 0.001, "integer": True})(DOC) == 1
+
+
+def test_condition():
+    spec = {"path": "emeters[1].total", "when": {"path": "emeters[1].is_valid", "equals": True}}
+    assert extract.compile_value(spec)(DOC) is None
+    assert extract.compile_value({**spec, "otherwise": 0})(DOC) == 0
+
+
+def test_metrics():
+    spec = {
+        "labels": {"sensor": "{instance_name}"},
+        "metrics": [
+            {
+                "name": "electric_power_w",
+                "samples": [
+                    {"path": "emeters[0].power", "labels": {"phase": "1"}},
+                    {"sum": "emeters[*].power", "labels": {"phase": "all"}},
+                ],
+            },
+            {
+                "name": "electric_consumption_kwh",
+                "type": "counter",
+                "samples": [{"path": "result.switch:0.aenergy.total"}],
+            },
+        ],
+    }
+    metrics = prometheus.Metrics()
+    extract.compile_metrics(spec, {"instance_name": "house"})(DOC, metrics)
+
+    assert metrics.families["electric_power_w"]["type"] == "gauge"
+    assert samples(metrics, "electric_power_w") == [
+        ({"sensor": "house", "phase": "1"}, 100.0),
+        ({"sensor": "house", "phase": "all"}, 300.0),
+    ]
+    assert metrics.families["electric_consumption_kwh"]["type"] == "counter"
+    assert samples(metrics, "electric_consumption_kwh") == [({"sensor": "house"}, 42)]
+
+
+def test_incomplete_document_adds_nothing():
+    spec = {
+        "metrics": [{"name": "a", "samples": [{"path": "nrg[0]"}]}, {"name": "b", "samples": [{"path": "missing"}]}]
+    }
+    extract_metrics = extract.compile_metrics(spec, {})
+    metrics = prometheus.Metrics()
+    with pytest.raises(KeyError):
+        extract_metrics(DOC, metrics)
+    assert metrics.num_samples() == 0
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        {},
+        {"metrics": [{"samples": []}]},
+        {"metrics": [{"name": "a", "type": "histogram"}]},
+        {"metrics": [{"name": "a", "samples": [{"scale": 2}]}]},
+        {"metrics": [{"name": "a", "samples": [{"path": "x", "when": {"path": "y"}}]}]},
+    ],
+)
+def test_invalid_spec(spec):
+    with pytest.raises(ValueError):
+        extract.compile_metrics(spec, {})
@@ -0,0 +1,100 @@
+import asyncio
+import gzip
+import struct
+
+import httpserver
+import pytest
+from aiohttp import test_utils
+
+
+def varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def field(number: int, value: bytes) -> bytes:
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def remote_write(series: list[tuple[dict[str, str], float, int]]) -> bytes:
+    """Encode a remote write request, compressed as a single snappy literal."""
+    message = b""
+    for labels, value, timestamp in series:
+        timeseries = b"".join(field(1, field(1, k.encode()) + field(2, v.encode())) for k, v in labels.items())
+        sample = varint(1 << 3 | 1) + struct.pack("<d", value) + varint(2 << 3) + varint(timestamp)
+        message += field(1, timeseries + field(2, sample))
+    n = len(message) - 1
+    return varint(len(message)) + bytes([61 << 2]) + n.to_bytes(2, "little") + message
+
+
+def test_parse_text():
+    samples = httpserver.parse_text(
+        "# HELP power_w Power.\n"
+        "# TYPE power_w gauge\n"
+        'power_w{sensor="heater",phase="1"} 100.5\n'
+        "temperature_celsius 21 1792377765853\n"
+        'electric_consumption_kwh{sensor="heatpump"} 1.5 1792377765853.026\n'
+    )
+    assert samples == [
+        httpserver.Sample("power_w", (("phase", "1"), ("sensor", "heater")), 100.5, None),
+        httpserver.Sample("temperature_celsius", (), 21.0, 1792377765853),
+        httpserver.Sample("electric_consumption_kwh", (("sensor", "heatpump"),), 1.5, 1792377765853),
+    ]
+
+
+def test_parse_text_invalid():
+    with pytest.raises(ValueError):
+        httpserver.parse_text("power_w{sensor=heater}\n")
+
+
+def test_snappy_copy():
+    # Literal "abcd" followed by a copy of 8 bytes at offset 4 (1 byte offset form).
+    data = varint(12) + bytes([3 << 2]) + b"abcd" + bytes([1 | (8 - 4) << 2, 4])
+    assert httpserver.snappy_decompress(data) == b"abcdabcdabcd"
+
+
+def test_parse_remote_write():
+    body = remote_write([({"__name__": "power_w", "sensor": "heater"}, 100.5, 1792377765853)])
+    assert httpserver.parse_remote_write(body) == [
+        httpserver.Sample("power_w", (("sensor", "heater"),), 100.5, 1792377765853)
+    ]
+
+
+def test_write_round_trip():
+    store = httpserver.SeriesStore()
+    received = []
+    server = httpserver.Server(store)
+    server.listeners.append(received.extend)
+
+    async def run():
+        async with test_utils.TestClient(test_utils.TestServer(server.app())) as client:
+            text = 'electric_consumption_kwh{sensor="heatpump"} 1.5 1792377765853.026\n'
+            response = await client.post(
+                "/api/v1/import/prometheus", data=gzip.compress(text.encode()), headers={"Content-Encoding": "gzip"}
+            )
+            assert response.status == 204
+
+            body = remote_write([({"__name__": "power_w", "sensor": "heater"}, 100.5, 1792377765853)])
+            response = await client.post("/api/v1/write", data=body)
+            assert response.status == 204
+
+            response = await client.post("/api/v1/import/prometheus", data="not a metric\n")
+            assert response.status == 400
+
+            response = await client.get("/series", params={"name": "electric_consumption_kwh"})
+            return await response.json()
+
+    series = asyncio.run(run())
+    assert series == [
+        {"name": "electric_consumption_kwh", "labels": {"sensor": "heatpump"}, "samples": [[1792377765853, 1.5]]}
+    ]
+    assert [s.name for s in received] == ["electric_consumption_kwh", "power_w"]
+    stats = store.stats()
+    assert stats["requests"] == 3
+    assert stats["errors"] == 1
+    assert stats["samples"] == 2
+    assert stats["encodings"] == {"gzip": 1, "remote-write": 1, "text": 1}
@@ -0,0 +1,38 @@
+import liveness
+
+
+def test_timer_wheel():
+    wheel = liveness.TimerWheel(tick=1.0, slots=8)
+    start = wheel.current
+    wheel.schedule("a", start + 2)
+    wheel.schedule("b", start + 5)
+
+    assert wheel.advance(start + 1) == []
+    assert wheel.advance(start + 2) == ["a"]
+    assert wheel.advance(start + 2) == []
+    assert wheel.advance(start + 6) == ["b"]
+
+
+def test_timer_wheel_deadline_in_past():
+    wheel = liveness.TimerWheel(tick=1.0, slots=8)
+    start = wheel.current
+    wheel.schedule("a", start - 100)
+    assert wheel.advance(start + 1) == ["a"]
+
+
+def test_timer_wheel_wraps_around():
+    wheel = liveness.TimerWheel(tick=1.0, slots=8)
+    start = wheel.current
+    # Same slot as start + 2, caller checks the deadline and schedules the key again.
+    wheel.schedule("far", start + 10)
+    assert wheel.advance(start + 2) == ["far"]
+
+
+def test_timer_wheel_long_pause():
+    wheel = liveness.TimerWheel(tick=1.0, slots=8)
+    start = wheel.current
+    for i in range(1, 8):
+        wheel.schedule(str(i), start + i)
+    # Each slot is visited once even if the pause is longer than the wheel.
+    assert sorted(wheel.advance(start + 100)) == [str(i) for i in range(1, 8)]
+    assert wheel.current == start + 100
@@ -0,0 +1,23 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_invalid_sensor_configuration_exits(tmp_path, workers):
+    # Passes the checks of the settings, but the task rejects it when configured.
+    path = tmp_path / "config.yaml"
+    path.write_text(
+        "global:\n  database_url: http://127.0.0.1:1/api/v1/import/prometheus\n"
+        f"runtime:\n  workers: {workers}\n"
+        "sensors:\n- type: http-poller\n  name: x\n  config: {}\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "src/main.py", "--config", str(path)], cwd=ROOT, capture_output=True, text=True, timeout=30
+    )
+    assert result.returncode == 1
+    assert "Invalid configuration: sensor http-poller:x" in result.stdout + result.stderr
@@ -0,0 +1,70 @@
+import asyncio
+import collections
+
+import mqtt
+
+
+class FakeMessages(object):
+    """Messages of aiomqtt client: async iterator that also tells how many messages are queued."""
+
+    def __init__(self):
+        self.queue = collections.deque()
+        self.received = asyncio.Event()
+
+    def put(self, message: str) -> None:
+        self.queue.append(message)
+        self.received.set()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.queue:
+            self.received.clear()
+            await self.received.wait()
+        return self.queue.popleft()
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.messages = FakeMessages()
+
+
+def test_receive_returns_queued_messages_after_stopping():
+    async def run():
+        client = FakeClient()
+        stopping = asyncio.Event()
+        received = []
+
+        async def consume():
+            async for m in mqtt.receive(client, stopping):
+                received.append(m)
+
+        consumer = asyncio.create_task(consume())
+        client.messages.put("a")
+        await asyncio.sleep(0.01)
+        assert received == ["a"]
+
+        # Messages received just before stopping are not lost.
+        client.messages.put("b")
+        client.messages.put("c")
+        stopping.set()
+        await asyncio.wait_for(consumer, 1)
+        return received
+
+    assert asyncio.run(run()) == ["a", "b", "c"]
+
+
+def test_receive_stops_while_waiting():
+    async def run():
+        stopping = asyncio.Event()
+        messages = mqtt.receive(FakeClient(), stopping)
+        waiting = asyncio.create_task(anext(messages, None))
+        await asyncio.sleep(0.01)
+        stopping.set()
+        return await asyncio.wait_for(waiting, 1)
+
+    assert asyncio.run(run()) is None
@@ -0,0 +1,75 @@
+import asyncio
+import concurrent.futures
+import gzip
+import json
+import threading
+
+import config
+import offload
+import prometheus
+import pytest
+
+
+def thread_name(data: bytes) -> str:
+    return threading.current_thread().name
+
+
+@pytest.fixture
+def pool(monkeypatch) -> concurrent.futures.ThreadPoolExecutor:
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="offload")
+    monkeypatch.setattr(offload, "pool", executor)
+    monkeypatch.setattr(offload, "threshold", 100)
+    yield executor
+    executor.shutdown()
+
+
+def test_threshold(pool):
+    async def run():
+        small = await offload.run(thread_name, b"", size=99)
+        large = await offload.run(thread_name, b"", size=100)
+        return small, large
+
+    small, large = asyncio.run(run())
+    assert small == "MainThread"
+    assert large.startswith("offload")
+
+
+def test_no_pool(monkeypatch):
+    monkeypatch.setattr(offload, "pool", None)
+    monkeypatch.setattr(offload, "threshold", 0)
+    assert asyncio.run(offload.run(thread_name, b"", size=1000)) == "MainThread"
+
+
+def test_configure(monkeypatch):
+    monkeypatch.setattr(offload, "pool", None)
+    monkeypatch.setattr(offload, "threshold", offload.threshold)
+
+    offload.configure(config.Runtime(offload_pool="none", offload_threshold=10))
+    assert offload.pool is None
+    assert offload.threshold == 10
+
+    offload.configure(config.Runtime(offload_pool="thread", offload_workers=1))
+    assert isinstance(offload.pool, concurrent.futures.ThreadPoolExecutor)
+    assert offload.threshold == 64 * 1024
+    offload.pool.shutdown()
+
+
+def test_helpers(pool):
+    data = json.dumps([{"value": i} for i in range(100)]).encode()
+    metrics = prometheus.Metrics()
+    g = metrics.gauge("temperature_celsius", labels={"sensor": "sauna"})
+    for i in range(10):
+        g.add(i, timestamp_msec=i)
+
+    async def run():
+        return (
+            await offload.json_loads(data),
+            await offload.format_metrics(metrics),
+            await offload.gzip_compress(data),
+        )
+
+    # Sizes are over the threshold, so all of these run in the pool.
+    loaded, formatted, compressed = asyncio.run(run())
+    assert loaded == json.loads(data)
+    assert formatted == metrics.format()
+    assert gzip.decompress(compressed) == data
@@ -0,0 +1,198 @@
+import asyncio
+import datetime
+
+import circuitbreaker
+import httpclient
+import httpx
+import poller
+import prometheus
+import pytest
+import task
+
+SPEC = {
+    "labels": {"sensor": "{instance_name}"},
+    "metrics": [{"name": "electric_power_w", "samples": [{"path": "power"}]}],
+}
+
+
+class FakeSink(object):
+    def __init__(self):
+        self.written: list[prometheus.Metrics] = []
+
+    async def write(self, metrics: prometheus.Metrics) -> None:
+        if metrics.num_samples():
+            self.written.append(metrics)
+
+    def values(self) -> list[dict[str, float]]:
+        """Power of each device per write."""
+        return [
+            {
+                s.common_labels_for_all_samples["sensor"]: s.samples[0]["value"]
+                for s in m.families["electric_power_w"]["samples"]
+            }
+            for m in self.written
+        ]
+
+
+@pytest.fixture
+def responses(monkeypatch) -> dict[str, object]:
+    """Responses of the devices by host, a status code or a document."""
+    responses = {}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        response = responses[request.url.host]
+        if isinstance(response, int):
+            return httpx.Response(response)
+        return httpx.Response(200, json=response)
+
+    monkeypatch.setattr(httpclient, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return responses
+
+
+def create(**settings) -> tuple[poller.HttpPoller, FakeSink]:
+    p = poller.HttpPoller()
+    p.configure("test", poller.HttpPoller.Settings(database_url="http://db", spec=SPEC, **settings))
+    p.sink = FakeSink()
+    return p, p.sink
+
+
+def test_single_device(responses):
+    p, sink = create(url="http://heater/status")
+    responses["heater"] = {"power": 100}
+    asyncio.run(p.update_metrics())
+    assert sink.values() == [{"test": 100}]
+
+
+def test_single_device_unexpected_response_is_skipped(responses):
+    p, sink = create(url="http://heater/status")
+    responses["heater"] = {"unexpected": 1}
+    asyncio.run(p.update_metrics())
+    assert sink.written == []
+
+    # The endpoint answered, so it is not counted as failure.
+    assert circuitbreaker.for_url("http://heater").failures_total == 0
+
+
+def test_single_device_failure_is_raised(responses):
+    p, _ = create(url="http://heater/status")
+    responses["heater"] = 500
+    with pytest.raises(circuitbreaker.EndpointException):
+        asyncio.run(p.update_metrics())
+
+
+def fleet(count: int, **settings) -> tuple[poller.HttpPoller, FakeSink]:
+    devices = [poller.DeviceSettings(name=f"device-{i}", url=f"http://device-{i}/status") for i in range(count)]
+    return create(devices=devices, **settings)
+
+
+def test_fleet_skips_failing_devices(responses):
+    p, sink = fleet(3)
+    responses.update({"device-0": {"power": 1}, "device-1": 500, "device-2": {"unexpected": 1}})
+    asyncio.run(p.update_metrics())
+    assert sink.values() == [{"device-0": 1}]
+
+
+def test_fleet_device_breaker_opens_alone(responses):
+    p, sink = fleet(2)
+    responses.update({"device-0": {"power": 1}, "device-1": 500})
+
+    async def run():
+        for _ in range(4):
+            await p.update_metrics()
+
+    asyncio.run(run())
+    assert sink.values() == [{"device-0": 1}] * 4
+    assert circuitbreaker.for_url("http://device-0").state == circuitbreaker.CLOSED
+    broken = circuitbreaker.for_url("http://device-1")
+    assert broken.state == circuitbreaker.OPEN
+    # After the breaker opened, the device is not called anymore.
+    assert broken.failures_total == 3
+
+
+def test_fleet_fails_when_all_devices_fail(responses):
+    p, _ = fleet(2)
+    responses.update({"device-0": 500, "device-1": 500})
+    with pytest.raises(circuitbreaker.EndpointException):
+        asyncio.run(p.update_metrics())
+
+
+def test_fleet_concurrency(responses, monkeypatch):
+    p, sink = fleet(6, concurrency=2)
+    running = []
+    peak = []
+
+    async def fetch(url):
+        running.append(url)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(url)
+        return {"power": 1}
+
+    monkeypatch.setattr(p, "fetch", fetch)
+    asyncio.run(p.update_metrics())
+    assert max(peak) == 2
+    assert len(sink.values()[0]) == 6
+
+
+ADAPTIVE_SPEC = {
+    **SPEC,
+    "adaptive": {"signal": {"path": "power"}, "change": 50, "when": {"path": "charging", "equals": True}},
+}
+
+
+def test_activity():
+    activity = poller.Activity(ADAPTIVE_SPEC["adaptive"])
+    assert not activity.update("a", {"power": 100, "charging": False})
+    assert not activity.update("a", {"power": 140, "charging": False})
+    assert activity.update("a", {"power": 200, "charging": False})
+    assert activity.update("a", {"power": 200, "charging": True})
+    # Signal is tracked per device.
+    assert not activity.update("b", {"power": 0, "charging": False})
+
+
+def test_activity_needs_signal_or_condition():
+    with pytest.raises(ValueError):
+        poller.Activity({"change": 1})
+
+
+def test_adaptive_interval(responses):
+    p = poller.HttpPoller()
+    p.configure(
+        "test",
+        poller.HttpPoller.Settings(
+            database_url="http://db",
+            spec=ADAPTIVE_SPEC,
+            url="http://heater/status",
+            poll_min=datetime.timedelta(seconds=1),
+            poll_max=datetime.timedelta(seconds=8),
+        ),
+    )
+    p.sink = FakeSink()
+
+    async def poll(docs):
+        intervals = []
+        for doc in docs:
+            responses["heater"] = doc
+            await p.update_metrics()
+            intervals.append(p.interval.total_seconds())
+        return intervals
+
+    stable = {"power": 100, "charging": False}
+    changed = {"power": 300, "charging": False}
+    docs = [stable] * 5 + [changed, {"power": 300, "charging": True}, changed]
+    # Doubled while stable up to poll-max, back to poll-min when the signal changes or the condition holds.
+    assert p.interval.total_seconds() == 1
+    assert asyncio.run(poll(docs)) == [2, 4, 8, 8, 8, 1, 1, 2]
+
+
+def test_poll_min_longer_than_poll_max():
+    p = poller.HttpPoller()
+    settings = poller.HttpPoller.Settings(
+        database_url="http://db",
+        spec=ADAPTIVE_SPEC,
+        url="http://heater/status",
+        poll_min=datetime.timedelta(seconds=10),
+        poll_max=datetime.timedelta(seconds=5),
+    )
+    with pytest.raises(task.TaskException):
+        p.configure("test", settings)
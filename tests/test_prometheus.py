@@ -0,0 +1,66 @@
+import looplag
+import prometheus
+
+
+def test_format():
+    metrics = prometheus.Metrics()
+    metrics.gauge("temperature_celsius", "Temperature", {"sensor": "sauna"}).add(80.1234, timestamp_msec=1000)
+    metrics.gauge("temperature_celsius", "Temperature", {"sensor": "porch"}).add(-5, {"unit": "c"})
+    assert metrics.num_samples() == 2
+    assert metrics.format() == (
+        "# HELP temperature_celsius Temperature\n"
+        "# TYPE temperature_celsius gauge\n"
+        'temperature_celsius {sensor="sauna"} 80.123 1000\n'
+        'temperature_celsius {sensor="porch",unit="c"} -5\n'
+    )
+
+
+def test_histogram():
+    h = prometheus.Histogram([1, 0.5, 0.25])
+    assert h.buckets == [0.25, 0.5, 1]
+    for value in [0.125, 0.25, 0.5, 0.75, 2]:
+        h.observe(value)
+
+    metrics = prometheus.Metrics()
+    metrics.histogram("lag_seconds", "Lag", h, {"instance": "a"})
+    # Histogram samples are not counted, they are written from the histogram state.
+    assert metrics.num_samples() == 0
+    assert metrics.format() == (
+        "# HELP lag_seconds Lag\n"
+        "# TYPE lag_seconds histogram\n"
+        'lag_seconds_bucket {instance="a",le="0.25"} 2\n'
+        'lag_seconds_bucket {instance="a",le="0.5"} 3\n'
+        'lag_seconds_bucket {instance="a",le="1"} 4\n'
+        'lag_seconds_bucket {instance="a",le="+Inf"} 5\n'
+        'lag_seconds_sum {instance="a"} 3.625\n'
+        'lag_seconds_count {instance="a"} 5\n'
+    )
+
+
+def test_histogram_without_labels():
+    h = prometheus.Histogram([1])
+    assert prometheus.HistogramSamples(None, h).format_lines("lag_seconds") == [
+        'lag_seconds_bucket {le="1"} 0',
+        'lag_seconds_bucket {le="+Inf"} 0',
+        "lag_seconds_sum 0.0",
+        "lag_seconds_count 0",
+    ]
+
+
+def test_looplag_collect(monkeypatch):
+    h = prometheus.Histogram([0.1])
+    h.observe(0.5)
+    monkeypatch.setattr(looplag, "histogram", h)
+    monkeypatch.setattr(looplag, "blocked_total", 1)
+
+    metrics = prometheus.Metrics()
+    looplag.collect(metrics)
+    assert metrics.format().splitlines()[2:] == [
+        'event_loop_lag_seconds_bucket {le="0.1"} 0',
+        'event_loop_lag_seconds_bucket {le="+Inf"} 1',
+        "event_loop_lag_seconds_sum 0.5",
+        "event_loop_lag_seconds_count 1",
+        "# HELP event_loop_blocked_total Times the event loop was blocked longer than threshold",
+        "# TYPE event_loop_blocked_total counter",
+        "event_loop_blocked_total 1",
+    ]
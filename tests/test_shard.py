@@ -0,0 +1,57 @@
+import asyncio
+
+import config
+import homemetrics  # noqa: F401, registers the task classes
+import shard
+
+
+def sensor(type: str, name: str = "", **settings) -> config.Sensor:
+    return config.Sensor(type=type, name=name, config=settings)
+
+
+def test_assign_is_stable():
+    sensors = [sensor("shelly2", f"device-{i}", url=f"http://device-{i}") for i in range(20)]
+    assigned = shard.assign(sensors, 3)
+    assert sorted(s.name for w in assigned for s in w) == sorted(s.name for s in sensors)
+    assert all(assigned)
+
+    # Adding a sensor does not move the others.
+    again = shard.assign(sensors + [sensor("shelly2", "new", url="http://new")], 3)
+    for before, after in zip(assigned, again):
+        assert before == [s for s in after if s.name != "new"]
+
+
+def test_assign_unnamed_sensors_by_order():
+    sensors = [sensor("spot-hinta"), sensor("spot-hinta")]
+    assert shard.assign(sensors, 8) == shard.assign(list(sensors), 8)
+    assert sum(len(w) for w in shard.assign(sensors, 8)) == 2
+
+
+def test_assign_shared_subscription():
+    zigbee = sensor("zigbee", server="mqtt", topic="zigbee2mqtt/#")
+    assigned = shard.assign([zigbee], 3)
+    assert [[s.config["topic"] for s in w] for w in assigned] == [["$share/homemetrics/zigbee2mqtt/#"]] * 3
+    assert zigbee.config["topic"] == "zigbee2mqtt/#"
+
+
+def test_worker_with_invalid_configuration_is_not_restarted(monkeypatch):
+    monkeypatch.setattr(shard, "RESTART_DELAY", 0.1)
+    worker = shard.Worker()
+    worker.configure("test", shard.Worker.Settings(sensors=[sensor("http-poller", "x")]))
+
+    async def run():
+        running = asyncio.create_task(worker.start())
+        while worker.process is None or worker.process.exitcode is None:
+            await asyncio.sleep(0.1)
+        process = worker.process
+        assert process.exitcode == shard.CONFIG_ERROR_EXIT
+
+        # Would have been restarted several times by now.
+        await asyncio.sleep(1)
+        assert worker.process is process
+        assert not running.done()
+        worker.stop()
+        await asyncio.wait_for(running, 5)
+
+    asyncio.run(asyncio.wait_for(run(), 30))
+    assert shard.restarts["test"] == 0
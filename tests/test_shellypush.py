@@ -0,0 +1,159 @@
+import asyncio
+import json
+import socket
+
+import aiohttp
+import fakeshelly
+import prometheus
+import pytest
+from homemetrics import shellypush
+
+
+class FakeSink(object):
+    def __init__(self):
+        self.written: list[prometheus.Metrics] = []
+
+    async def write(self, metrics: prometheus.Metrics) -> None:
+        if metrics.num_samples():
+            self.written.append(metrics)
+
+    def latest(self) -> dict[tuple, float]:
+        """Latest value of each series, by metric name and labels."""
+        values = {}
+        for metrics in self.written:
+            for family in metrics.families.values():
+                for samples in family["samples"]:
+                    for sample in samples.samples:
+                        labels = {**samples.common_labels_for_all_samples, **sample["labels"]}
+                        values[(family["name"], tuple(sorted(labels.items())))] = sample["value"]
+        return values
+
+
+def create(cls, **settings):
+    t = cls()
+    t.configure("test", cls.Settings(database_url="http://db", **{"flush_delay": 0, **settings}))
+    t.sink = FakeSink()
+    return t, t.sink
+
+
+def test_merge():
+    state = {"switch:0": {"apower": 1.0, "aenergy": {"total": 5.0, "by_minute": [1]}}, "sys": {"mac": "AA"}}
+    shellypush.merge(state, {"switch:0": {"apower": 2.0, "aenergy": {"total": 6.0}}, "input:0": {"state": True}})
+    assert state == {
+        "switch:0": {"apower": 2.0, "aenergy": {"total": 6.0, "by_minute": [1]}},
+        "sys": {"mac": "AA"},
+        "input:0": {"state": True},
+    }
+
+
+def test_shelly2_notifications():
+    device = fakeshelly.FakeDevices("shellyplus1pm-a")
+    t, sink = create(shellypush.Shelly2Push, mode="mqtt", server="mqtt", devices={"shellyplus1pm-a": "heater"})
+
+    async def run():
+        # Status change before the full status is not complete.
+        t.message("shellyplus1pm-a/events/rpc", json.dumps(device.notification("NotifyStatus", device.step(60))))
+        await t.flush_now()
+        assert sink.written == []
+
+        t.message(
+            "shellyplus1pm-a/events/rpc", json.dumps(device.notification("NotifyFullStatus", device.full_status()))
+        )
+        await t.flush_now()
+        t.message("shellyplus1pm-a/events/rpc", json.dumps(device.notification("NotifyStatus", device.step(60))))
+        await t.flush_now()
+        # Events do not carry status.
+        t.message("shellyplus1pm-a/events/rpc", json.dumps({"method": "NotifyEvent", "params": {"events": []}}))
+        t.message("shellyplus1pm-a/events/rpc", b"not json")
+        await t.flush_now()
+
+    asyncio.run(run())
+    assert len(sink.written) == 2
+    assert sink.latest()[("electric_power_w", (("phase", "all"), ("sensor", "heater")))] == device.switch["apower"]
+    assert sink.latest()[("electric_voltage_v", (("sensor", "heater"),))] == 230.0
+
+
+def test_shelly2_status_topic():
+    t, sink = create(shellypush.Shelly2Push, mode="mqtt", server="mqtt")
+    switch = {"id": 0, "apower": 12.5, "voltage": 231.0, "current": 0.1, "aenergy": {"total": 1500.0}}
+
+    async def run():
+        t.message("shellyplus1pm-b/status/switch:0", json.dumps(switch).encode())
+        await t.flush_now()
+
+    asyncio.run(run())
+    assert sink.latest()[("electric_consumption_kwh", (("phase", "all"), ("sensor", "shellyplus1pm-b")))] == 1.5
+
+
+def test_shelly1_topics_to_emeters():
+    device = fakeshelly.FakeDevices("a")
+    device.step(60)
+    t, sink = create(shellypush.Shelly1Mqtt, server="mqtt", devices={"shellyem3-a": "house"})
+
+    async def run():
+        for i, e in enumerate(device.emeters):
+            for k, v in e.items():
+                t.message(f"shellies/shellyem3-a/emeter/{i}/{k}", str(v).encode())
+        # Not emeter values.
+        t.message("shellies/shellyem3-a/relay/0", b"on")
+        t.message("shellies/shellyem3-a/emeter/x/power", b"1")
+        t.message("shellies/shellyem3-a/emeter/0/power", b"unavailable")
+        await t.flush_now()
+
+    asyncio.run(run())
+    assert t.states["shellyem3-a"] == {"emeters": device.emeters}
+    latest = sink.latest()
+    assert latest[("electric_power_w", (("phase", "2"), ("sensor", "house")))] == device.emeters[1]["power"]
+    assert latest[("electric_power_w", (("phase", "all"), ("sensor", "house")))] == round(
+        sum(e["power"] for e in device.emeters), 3
+    )
+
+
+def test_shelly1_incomplete_status_is_not_written():
+    t, sink = create(shellypush.Shelly1Mqtt, server="mqtt")
+
+    async def run():
+        t.message("shellies/shellyem3-a/emeter/0/power", b"100")
+        await t.flush_now()
+
+    asyncio.run(run())
+    assert sink.written == []
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_shelly2_websocket():
+    port = free_port()
+    device = fakeshelly.FakeDevices("shellyplus1pm-a")
+    t, sink = create(shellypush.Shelly2Push, listen_address="127.0.0.1", listen_port=port, flush_delay=10)
+
+    async def run():
+        running = asyncio.create_task(t.start())
+        async with aiohttp.ClientSession() as session:
+            for _ in range(50):
+                try:
+                    ws = await session.ws_connect(f"http://127.0.0.1:{port}/shelly")
+                    break
+                except aiohttp.ClientConnectionError:
+                    await asyncio.sleep(0.05)
+            await ws.send_json(device.notification("NotifyFullStatus", device.full_status()))
+            await ws.send_json(device.notification("NotifyStatus", device.step(60)))
+            await asyncio.sleep(0.1)
+            assert sink.written == []
+
+            # Stopping writes the pending changes without waiting for the flush delay, and closes the connection.
+            t.stop()
+            await asyncio.wait_for(running, 5)
+            message = await ws.receive()
+            assert message.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED)
+
+    asyncio.run(run())
+    assert len(sink.written) == 1
+    assert (
+        sink.latest()[("electric_power_w", (("phase", "all"), ("sensor", "shellyplus1pm-a")))]
+        == device.switch["apower"]
+    )
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+
+import circuitbreaker
+import httpclient
+import httpx
+import prometheus
+import pytest
+import sink
+
+URL = "http://db/api/v1/import/prometheus"
+
+
+class Database(object):
+    """Stand-in for the database, rejects samples of metric "invalid" like the database rejects bad data."""
+
+    def __init__(self):
+        self.requests: list[str] = []
+        self.stored: list[str] = []
+        # Status codes to answer the next requests with.
+        self.errors: list[int] = []
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        body = request.content.decode()
+        self.requests.append(body)
+        if self.errors:
+            return httpx.Response(self.errors.pop(0))
+        if "invalid" in body:
+            return httpx.Response(400, text="cannot parse")
+        self.stored.extend(body.splitlines())
+        return httpx.Response(204)
+
+
+@pytest.fixture
+def database(monkeypatch) -> Database:
+    db = Database()
+    monkeypatch.setattr(httpclient, "_client", httpx.AsyncClient(transport=httpx.MockTransport(db.handle)))
+    return db
+
+
+def test_batches_are_coalesced(database):
+    async def run():
+        s = sink.get(URL)
+        for i in range(3):
+            s.enqueue(f"m {i}\n")
+        await asyncio.wait_for(s.idle.wait(), 5)
+        return s
+
+    s = asyncio.run(run())
+    assert database.requests == ["m 0\nm 1\nm 2\n"]
+    assert s.written_total == 3
+
+
+def test_rejected_batch_is_dropped(database, caplog):
+    async def run():
+        s = sink.get(URL)
+        for body in ("a 1\n", "invalid 1\n", "b 1\n"):
+            s.enqueue(body)
+        await asyncio.wait_for(s.idle.wait(), 5)
+        s.enqueue("c 1\n")
+        await asyncio.wait_for(s.idle.wait(), 5)
+        return s
+
+    s = asyncio.run(run())
+    # Coalesced request is rejected, then the batches are written one by one to drop only the bad one.
+    assert database.requests == ["a 1\ninvalid 1\nb 1\n", "a 1\n", "invalid 1\n", "b 1\n", "c 1\n"]
+    assert database.stored == ["a 1", "b 1", "c 1"]
+    assert (s.written_total, s.rejected_total) == (3, 1)
+    assert s.breaker.failures_total == 0
+    assert "Database rejected batch" in caplog.text
+
+
+def test_server_error_is_retried(database):
+    database.errors = [503]
+
+    async def run():
+        s = sink.get(URL)
+        s.enqueue("a 1\n")
+        s.enqueue("b 1\n")
+        await asyncio.wait_for(s.idle.wait(), 5)
+        return s
+
+    s = asyncio.run(run())
+    assert database.stored == ["a 1", "b 1"]
+    assert (s.written_total, s.rejected_total) == (2, 0)
+    assert s.breaker.failures_total == 1
+
+
+def test_queue_overflow_drops_oldest(database):
+    async def run():
+        s = sink.Sink(URL, max_pending=2)
+        # The breaker is open, so the batches stay queued.
+        s.breaker.state = circuitbreaker.OPEN
+        s.breaker.opened_at = 1e12
+        for i in range(4):
+            s.enqueue(f"m {i}\n")
+        await asyncio.sleep(0)
+        pending = list(s.pending)
+        await s.close()
+        return s, pending
+
+    s, pending = asyncio.run(run())
+    assert pending == ["m 2\n", "m 3\n"]
+    assert s.dropped_total == 2
+
+
+def test_failing_processor_does_not_fail_write(database, caplog):
+    seen = []
+
+    def fail(metrics):
+        raise RuntimeError("broken processor")
+
+    sink.register(fail)
+    sink.register(lambda metrics: seen.append(metrics.num_samples()))
+
+    async def run():
+        metrics = prometheus.Metrics()
+        metrics.gauge("power_w").add(100)
+        s = sink.get(URL)
+        await s.write(metrics)
+        await asyncio.wait_for(s.idle.wait(), 5)
+
+    with caplog.at_level(logging.ERROR):
+        asyncio.run(run())
+    assert seen == [1]
+    assert database.stored == ["# HELP power_w ", "# TYPE power_w gauge", "power_w 100"]
+    assert "broken processor" in caplog.text
+
+
+def test_drain_writes_queued_batches(database):
+    async def run():
+        s = sink.get(URL)
+        s.enqueue("a 1\n")
+        s.enqueue("b 1\n")
+        return await sink.drain(5)
+
+    assert asyncio.run(run()) == (2, 0, 0)
+    assert database.stored == ["a 1", "b 1"]
+
+
+def test_drain_spools_and_restores(database, tmp_path):
+    spool = str(tmp_path / "spool.jsonl")
+    database.errors = [503] * 10
+
+    async def stop():
+        s = sink.get(URL)
+        s.enqueue("a 1\n")
+        s.enqueue("b 1\n")
+        return await sink.drain(0.2, spool)
+
+    assert asyncio.run(stop()) == (0, 2, 0)
+    assert database.stored == []
+
+    async def start():
+        # Next start of the application.
+        sink.sinks.clear()
+        database.errors = []
+        assert sink.restore(spool) == 2
+        return await sink.drain(5)
+
+    assert asyncio.run(start()) == (2, 0, 0)
+    assert database.stored == ["a 1", "b 1"]
+    assert not (tmp_path / "spool.jsonl").exists()
+
+
+def test_drain_without_spool_drops(database):
+    database.errors = [503] * 10
+
+    async def run():
+        sink.get(URL).enqueue("a 1\n")
+        return await sink.drain(0.2)
+
+    assert asyncio.run(run()) == (0, 0, 1)
+
+
+def test_restore_without_spool_file(tmp_path):
+    assert sink.restore(str(tmp_path / "missing.jsonl")) == 0
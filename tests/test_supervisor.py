@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import circuitbreaker
+import pytest
+import supervisor
+import task
+
+
+class FailingTask(object):
+    """Task that raises the given exceptions from start(), one per start."""
+
+    def __init__(self, *exceptions: BaseException):
+        self.exceptions = list(exceptions)
+        self.started: list[float] = []
+
+    async def start(self):
+        self.started.append(time.monotonic())
+        if self.exceptions:
+            raise self.exceptions.pop(0)
+        await asyncio.Event().wait()
+
+
+def run_until(s: supervisor.Supervisor, done, timeout: float = 5) -> None:
+    async def run():
+        s.start()
+        deadline = time.monotonic() + timeout
+        while not done() and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await s.stop(1)
+
+    asyncio.run(run())
+
+
+def gaps(times: list[float]) -> list[float]:
+    return [b - a for a, b in zip(times, times[1:])]
+
+
+def test_unexpected_failure_backs_off_exponentially(monkeypatch):
+    monkeypatch.setattr(supervisor, "INITIAL_BACKOFF", 0.05)
+    monkeypatch.setattr(supervisor, "MAX_BACKOFF", 0.1)
+    t = FailingTask(*(ValueError("bug") for _ in range(3)))
+    s = supervisor.Supervisor()
+    s.add(t)
+    run_until(s, lambda: len(t.started) == 4)
+
+    # Doubled after each failure, up to the maximum.
+    for gap, expected in zip(gaps(t.started), (0.05, 0.1, 0.1)):
+        assert expected <= gap < expected + 0.04
+    assert s.restarts["FailingTask"] == 3
+
+
+def test_endpoint_failure_waits_for_breaker(monkeypatch):
+    monkeypatch.setattr(supervisor, "MIN_RESTART_DELAY", 0)
+    breaker = circuitbreaker.CircuitBreaker("http://device", failure_threshold=1, reset_timeout=0.1)
+
+    async def fail():
+        raise OSError("connection refused")
+
+    class PollingTask(FailingTask):
+        async def start(self):
+            self.started.append(time.monotonic())
+            await breaker.call(fail)
+
+    t = PollingTask()
+    s = supervisor.Supervisor()
+    s.add(t)
+    run_until(s, lambda: len(t.started) == 3)
+
+    # Restarted when the breaker lets the probe through, with doubled reset timeout after the failed probe.
+    first, second = gaps(t.started)
+    assert 0.1 <= first < 0.18
+    assert 0.2 <= second < 0.3
+    assert breaker.failures_total == 3
+
+
+def test_rejected_credentials_wait_long(monkeypatch):
+    monkeypatch.setattr(supervisor, "AUTH_RETRY_DELAY", 0.2)
+    monkeypatch.setattr(supervisor, "INITIAL_BACKOFF", 0.01)
+    t = FailingTask(task.AuthenticationException("failed to login: 401"))
+    s = supervisor.Supervisor()
+    s.add(t)
+    run_until(s, lambda: len(t.started) == 2)
+    assert gaps(t.started)[0] >= 0.2
+
+
+def test_stop_asks_tasks_to_finish():
+    class FinishingTask(object):
+        def __init__(self):
+            self.stopping = asyncio.Event()
+            self.finished = False
+
+        def stop(self):
+            self.stopping.set()
+
+        async def start(self):
+            await self.stopping.wait()
+            self.finished = True
+
+    finishing = FinishingTask()
+    other = FailingTask()
+    s = supervisor.Supervisor()
+    s.add(finishing)
+    s.add(other)
+    run_until(s, lambda: other.started)
+
+    assert finishing.finished
+    assert all(r.done() for r in s.running)
+    assert s.restarts == {"FinishingTask": 0, "FailingTask": 0}
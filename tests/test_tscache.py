@@ -0,0 +1,108 @@
+import asyncio
+import json
+import time
+
+import config
+import prometheus
+import pytest
+import tscache
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+MINUTE_MSEC = 60 * 1000
+
+
+def now_msec() -> int:
+    return int(time.time() * 1000)
+
+
+def series(capacity: int = 4, window_msec: int = 15 * MINUTE_MSEC) -> tscache.Series:
+    return tscache.Series("power_w", "gauge", "", {"sensor": "heater"}, capacity, window_msec)
+
+
+def test_ring_keeps_newest_samples():
+    s = series(capacity=3)
+    t = now_msec()
+    for i in range(5):
+        s.append(t + i, float(i))
+    assert s.points(0) == [(t + 2, 2.0), (t + 3, 3.0), (t + 4, 4.0)]
+    assert s.latest() == (t + 4, 4.0)
+    assert s.points(t + 3) == [(t + 3, 3.0), (t + 4, 4.0)]
+
+
+def test_same_timestamp_replaces_value():
+    s = series()
+    t = now_msec()
+    s.append(t, 1.0)
+    s.append(t + 1, 2.0)
+    # Forecasts are polled again, with the same timestamps.
+    s.append(t, 3.0)
+    s.append(t + 1, 4.0)
+    assert s.points(0) == [(t, 3.0), (t + 1, 4.0)]
+
+
+def test_out_of_order_sample_is_inserted():
+    s = series()
+    t = now_msec()
+    s.append(t, 1.0)
+    s.append(t + 2, 3.0)
+    s.append(t + 1, 2.0)
+    assert s.points(0) == [(t, 1.0), (t + 1, 2.0), (t + 2, 3.0)]
+
+
+def test_samples_older_than_window_are_dropped():
+    s = series(window_msec=5 * MINUTE_MSEC)
+    t = now_msec()
+    s.append(t - 10 * MINUTE_MSEC, 1.0)
+    s.append(t - MINUTE_MSEC, 2.0)
+    s.append(t + 60 * MINUTE_MSEC, 3.0)
+    assert s.points(0) == [(t - MINUTE_MSEC, 2.0), (t + 60 * MINUTE_MSEC, 3.0)]
+
+
+def test_cache_records_and_selects():
+    cache = tscache.Cache(capacity=4)
+    t = now_msec()
+    metrics = prometheus.Metrics()
+    power = metrics.gauge("power_w", "Power.", labels={"sensor": "heater"})
+    power.add(100.0, labels={"phase": "1"}, timestamp_msec=t)
+    power.add(200.0, labels={"phase": "2"}, timestamp_msec=t)
+    metrics.gauge("temperature_celsius", labels={"sensor": "sauna"}).add(80.0)
+    cache.record(metrics)
+
+    assert len(cache.select("power_w", {"sensor": "heater"})) == 2
+    [s] = cache.select("power_w", {"phase": "2"})
+    assert s.latest() == (t, 200.0)
+    assert [s.name for s in cache.select(None, {"sensor": "sauna"})] == ["temperature_celsius"]
+
+
+def test_cache_expires_series_that_are_not_updated():
+    cache = tscache.Cache(retention=60)
+    metrics = prometheus.Metrics()
+    metrics.gauge("power_w").add(1.0)
+    cache.record(metrics)
+    for s in cache.series.values():
+        s.updated -= 61
+    cache.expire()
+    assert cache.series == {}
+
+
+def test_server_range():
+    server = tscache.CacheServer()
+    server.configure("", config.Runtime())
+    t = now_msec()
+    metrics = prometheus.Metrics()
+    metrics.gauge("power_w", labels={"sensor": "heater"}).add(1.0, timestamp_msec=t - 10 * MINUTE_MSEC)
+    metrics.gauge("power_w", labels={"sensor": "heater"}).add(2.0, timestamp_msec=t)
+    server.cache.record(metrics)
+
+    async def get(query: str):
+        return await server.handle_range(make_mocked_request("GET", f"/api/v1/range?{query}"))
+
+    response = asyncio.run(get("name=power_w&sensor=heater"))
+    assert json.loads(response.text) == [{"name": "power_w", "labels": {"sensor": "heater"}, "samples": [[t, 2.0]]}]
+    response = asyncio.run(get("since=15m"))
+    assert len(json.loads(response.text)[0]["samples"]) == 2
+
+    for since in ["", "m", "5", "5x"]:
+        with pytest.raises(web.HTTPBadRequest):
+            asyncio.run(get(f"since={since}"))
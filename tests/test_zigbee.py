@@ -0,0 +1,101 @@
+import asyncio
+
+import prometheus
+from homemetrics import zigbee
+
+
+class FakeSink(object):
+    def __init__(self):
+        self.written: list[prometheus.Metrics] = []
+
+    async def write(self, metrics: prometheus.Metrics) -> None:
+        if metrics.num_samples():
+            self.written.append(metrics)
+
+
+def values(metrics: prometheus.Metrics) -> dict[str, float]:
+    return {name: f["samples"][0].samples[0]["value"] for name, f in metrics.families.items()}
+
+
+def extract(attributes: dict[str, zigbee.Attribute], event: dict) -> prometheus.Metrics:
+    metrics = prometheus.Metrics()
+    zigbee.compile_mapping(attributes)(event, "sauna", metrics)
+    return metrics
+
+
+def test_default_mapping():
+    metrics = extract(
+        zigbee.ATTRIBUTES,
+        {"temperature": 21.5, "humidity": 40, "battery": 90, "contact": False, "voltage": 3000, "unknown": 1},
+    )
+    assert values(metrics) == {
+        "temperature_celsius": 21.5,
+        "humidity_percentage": 40,
+        "battery_percentage": 90,
+        "contact_boolean": 0,
+    }
+    assert metrics.families["temperature_celsius"]["samples"][0].common_labels_for_all_samples == {"sensor": "sauna"}
+
+
+def test_values():
+    attributes = {
+        "state": zigbee.Attribute(name="switch_on_boolean"),
+        "update.installed_version": zigbee.Attribute(name="firmware_version"),
+        "energy": zigbee.Attribute(name="electric_consumption_kwh", type="counter"),
+        "voltage": zigbee.Attribute(name="battery_voltage_v", scale=0.001),
+        "color": zigbee.Attribute(name="color"),
+    }
+    metrics = extract(
+        attributes,
+        {"state": "ON", "update": {"installed_version": 42}, "energy": 1.5, "voltage": 2950, "color": {"x": 1}},
+    )
+    assert values(metrics) == {
+        "switch_on_boolean": 1,
+        "firmware_version": 42,
+        "electric_consumption_kwh": 1.5,
+        "battery_voltage_v": 2.95,
+    }
+    assert metrics.families["electric_consumption_kwh"]["type"] == "counter"
+
+    # Missing nested attribute is skipped.
+    assert values(extract(attributes, {"update": None, "state": "unknown"})) == {}
+
+
+def create(**settings) -> tuple[zigbee.Zigbee, FakeSink]:
+    t = zigbee.Zigbee()
+    t.configure("", zigbee.Zigbee.Settings(database_url="http://db", server="mqtt", **settings))
+    t.sink = FakeSink()
+    return t, t.sink
+
+
+def test_models():
+    t, sink = create(
+        topic="$share/homemetrics/zigbee2mqtt/#",
+        attributes={"update.installed_version": zigbee.Attribute(name="firmware_version")},
+        models={
+            "SP 120": {"voltage": zigbee.Attribute(name="electric_voltage_v"), "linkquality": None},
+            "WSDCGQ11LM": {"voltage": zigbee.Attribute(name="battery_voltage_v", scale=0.001)},
+        },
+    )
+    assert t.base_topic == "zigbee2mqtt"
+    t.update_devices(
+        [
+            {"friendly_name": "Coordinator", "definition": None},
+            {"friendly_name": "plug", "definition": {"model": "SP 120"}},
+            {"friendly_name": "sauna", "definition": {"model": "WSDCGQ11LM"}},
+        ]
+    )
+    assert t.models == {"plug": "SP 120", "sauna": "WSDCGQ11LM"}
+
+    async def run():
+        event = {"voltage": 231, "linkquality": 100, "update": {"installed_version": 7}}
+        await t.sensor_event("plug", event)
+        await t.sensor_event("sauna", {**event, "voltage": 2950})
+        await t.sensor_event("other", event)
+
+    asyncio.run(run())
+    plug, sauna, other = (values(m) for m in sink.written)
+    assert plug == {"electric_voltage_v": 231, "firmware_version": 7}
+    assert sauna == {"battery_voltage_v": 2.95, "linkquality_dbm": 100, "firmware_version": 7}
+    # Voltage is not mapped for devices without model mapping.
+    assert other == {"linkquality_dbm": 100, "firmware_version": 7}